@@ -17,85 +17,680 @@
 # along with pyvmomi ansible more.  If not, see <http://www.gnu.org/licenses/>.
 
 from abc import abstractmethod
+from collections import OrderedDict
+import concurrent.futures
+from concurrent.futures import Future
 from contextlib import contextmanager
+import copy
+import functools
 import logging
-from time import sleep
+import heapq
+import math
+import threading
+import random
+import time
 import uuid
+import weakref
 
 from pyVim import connect
 from pyVmomi import vim
 from pyVmomi import vmodl
 
+import journal
+import metrics
+import session
+import thumbprints
+
 
 LOG = logging.getLogger(__name__)
 
+# Per-connection state, keyed by the stub adapter of the service instance so
+# that it goes away together with the connection.
+_SESSIONS = weakref.WeakKeyDictionary()
 
-def wait_for_tasks(service_instance, tasks):
-    """Given the service instance si and tasks, it returns after all the
-   tasks are complete
-   """
-    property_collector = service_instance.content.propertyCollector
-    task_list = [str(task) for task in tasks]
-    # Create filter
-    obj_specs = [vmodl.query.PropertyCollector.ObjectSpec(obj=task)
-                 for task in tasks]
-    property_spec = vmodl.query.PropertyCollector.PropertySpec(type=vim.Task,
-                                                               pathSet=[],
-                                                               all=True)
-    filter_spec = vmodl.query.PropertyCollector.FilterSpec()
-    filter_spec.objectSet = obj_specs
-    filter_spec.propSet = [property_spec]
-    pcfilter = property_collector.CreateFilter(filter_spec, True)
-    try:
-        version, state = None, None
-        # Loop looking for updates till the state moves to a completed state.
-        while len(task_list):
-            update = property_collector.WaitForUpdates(version)
+
+def session_state(service_instance):
+    """Return the dict holding the state shared by all the actions of the
+    connection the service instance belongs to.
+    """
+    return _SESSIONS.setdefault(service_instance._stub, {})
+
+
+def service_content(service_instance):
+    """Return the service content of the connection, retrieved once rather
+    than on every access of service_instance.content.
+    """
+    state = session_state(service_instance)
+    if 'service_content' not in state:
+        state['service_content'] = service_instance.content
+    return state['service_content']
+
+
+class TaskTimeout(Exception):
+    pass
+
+
+class _WatchedTask(object):
+    def __init__(self, task, progress):
+        self.task = task
+        self.progress = progress
+        self.future = Future()
+        self.info = {}
+
+
+class TaskMonitor(object):
+    """Tracks the tasks of one connection with a single property filter.
+
+    The filter lives on a private property collector and traverses a
+    ListView, so watching or forgetting a task is a ModifyListView call
+    instead of a filter of its own. Any number of tasks is then followed
+    by one WaitForUpdatesEx loop, which resolves a future per task.
+
+    Only the properties of TaskInfo needed to follow the tasks are
+    subscribed to. A wait gives up after `timeout` seconds unless it sets
+    its own. The tasks watched in a batched block get added by one call.
+    """
+
+    PATHS = ['info.state', 'info.error', 'info.progress', 'info.result']
+
+    def __init__(self, si, timeout=None):
+        self.si = si
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._pump_lock = threading.Lock()
+        self._watched = {}
+        self._collector = None
+        self._view = None
+        self._version = None
+        self._batching = 0
+        self._deferred = []
+
+    def _create_filter(self):
+        # The monitor gets the collector and the view only once the filter
+        # is there too, so a failure leaves it to try again on next watch.
+        content = service_content(self.si)
+        pc = vmodl.query.PropertyCollector
+        collector = view = None
+        try:
+            collector = content.propertyCollector.CreatePropertyCollector()
+            view = content.viewManager.CreateListView([])
+            traversal = pc.TraversalSpec(name='traverseTasks',
+                                         type=vim.view.ListView,
+                                         path='view', skip=False)
+            filter_spec = pc.FilterSpec(
+                objectSet=[pc.ObjectSpec(obj=view, skip=True,
+                                         selectSet=[traversal])],
+                propSet=[pc.PropertySpec(type=vim.Task,
+                                         pathSet=self.PATHS)])
+            collector.CreateFilter(filter_spec, True)
+        except Exception:
+            for partial in (view, collector):
+                if partial is not None:
+                    try:
+                        partial.Destroy()
+                    except Exception as ex:
+                        LOG.debug("Failed to destroy %s: %s", partial, ex)
+            raise
+        self._collector, self._view = collector, view
+        self._version = None
+
+    def watch(self, tasks, progress=None):
+        """Start tracking the tasks, returning a future for each of them.
+
+        The progress callback gets called with the task and its percentage
+        whenever it changes.
+        """
+        futures, added = [], []
+        with self._lock, metrics.attributed(type(self).__name__):
+            if self._collector is None:
+                self._create_filter()
+            for task in tasks:
+                if task._moId not in self._watched:
+                    self._watched[task._moId] = _WatchedTask(task, progress)
+                    added.append(task)
+                futures.append(self._watched[task._moId].future)
+            if self._batching:
+                self._deferred.extend(added)
+            elif added:
+                self._view.ModifyListView(add=added)
+        return futures
+
+    @contextmanager
+    def batched(self):
+        """Defer adding the tasks watched meanwhile to the filter, to add
+        all of them by one call on exit.
+
+        The futures of the tasks fail if that call does.
+        """
+        with self._lock:
+            self._batching += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._batching -= 1
+                added = []
+                if not self._batching:
+                    added, self._deferred = self._deferred, []
+                failed = []
+                if added:
+                    try:
+                        with metrics.attributed(type(self).__name__):
+                            self._view.ModifyListView(add=added)
+                    except Exception as ex:
+                        LOG.error("Failed to watch %d tasks: %s",
+                                  len(added), ex)
+                        failed = [(self._watched.pop(task._moId), ex)
+                                  for task in added
+                                  if task._moId in self._watched]
+            for watched, error in failed:
+                watched.future.set_exception(error)
+
+    def pending(self):
+        """Return how many watched tasks have not finished yet."""
+        with self._lock:
+            return len(self._watched)
+
+    def pump(self, max_wait_seconds=None, blocking=True):
+        """Process one batch of updates, resolving the finished tasks.
+
+        Only one thread at a time pumps the updates, with blocking false
+        this returns False right away when another one does.
+        """
+        if not self._pump_lock.acquire(blocking):
+            return False
+        try:
+            with metrics.attributed(type(self).__name__):
+                self._pump(max_wait_seconds)
+        finally:
+            self._pump_lock.release()
+        return True
+
+    def _pump(self, max_wait_seconds):
+        options = vmodl.query.PropertyCollector.WaitOptions(
+            maxWaitSeconds=max_wait_seconds)
+        update = self._collector.WaitForUpdatesEx(self._version, options)
+        if update is None:
+            return
+        changed = []
+        with self._lock:
             for filter_set in update.filterSet:
                 for obj_set in filter_set.objectSet:
-                    task = obj_set.obj
+                    watched = self._watched.get(obj_set.obj._moId)
+                    if watched is None:
+                        continue
                     for change in obj_set.changeSet:
-                        if change.name == 'info':
-                            state = change.val.state
-                        elif change.name == 'info.state':
-                            state = change.val
-                        else:
-                            continue
-
-                        if not str(task) in task_list:
-                            continue
-
-                        if state == vim.TaskInfo.State.success:
-                            # Remove task from taskList
-                            task_list.remove(str(task))
-                        elif state == vim.TaskInfo.State.error:
-                            raise task.info.error
-            # Move to next version
-            version = update.version
-    finally:
-        if pcfilter:
-            pcfilter.Destroy()
+                        watched.info[change.name] = change.val
+                    changed.append(watched)
+            finished = [watched for watched in changed
+                        if watched.info.get('info.state') in (
+                            vim.TaskInfo.State.success,
+                            vim.TaskInfo.State.error)]
+            for watched in finished:
+                del self._watched[watched.task._moId]
+            if finished:
+                self._view.ModifyListView(
+                    remove=[watched.task for watched in finished])
+        self._version = update.version
+
+        for watched in changed:
+            if watched.progress and 'info.progress' in watched.info:
+                watched.progress(watched.task,
+                                 watched.info.pop('info.progress') or 0)
+        for watched in finished:
+            if watched.info['info.state'] == vim.TaskInfo.State.success:
+                watched.future.set_result(watched.info.get('info.result'))
+            else:
+                watched.future.set_exception(watched.info.get('info.error'))
+
+    def wait(self, futures, return_when=concurrent.futures.ALL_COMPLETED,
+             timeout=None):
+        """Pump the updates until the futures are done, or until one of
+        them is done with FIRST_COMPLETED, returning the done futures.
+
+        Raises TaskTimeout when that does not happen in timeout seconds.
+        """
+        futures = list(futures)
+        if timeout is None:
+            timeout = self.timeout
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            done = [future for future in futures if future.done()]
+            if len(done) == len(futures) or (
+                    done and
+                    return_when == concurrent.futures.FIRST_COMPLETED):
+                return done
+            max_wait_seconds = 10
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise TaskTimeout("{} of the tasks did not finish in "
+                                      "{} s.".format(len(futures) - len(done),
+                                                     timeout))
+                max_wait_seconds = max(1, min(10, int(math.ceil(remaining))))
+            if not self.pump(max_wait_seconds, blocking=False):
+                # Another thread resolves the futures meanwhile.
+                concurrent.futures.wait(futures, timeout=1,
+                                        return_when=return_when)
+
+    def abort(self, error):
+        """Fail the futures of all the watched tasks with the error."""
+        with self._lock:
+            watched, self._watched = self._watched, {}
+        for task in watched.values():
+            task.future.set_exception(error)
+
+    def close(self):
+        with self._lock:
+            if self._collector is not None:
+                self._collector.Destroy()
+                self._view.Destroy()
+                self._collector = self._view = None
+
+
+def task_monitor(si):
+    """Return the task monitor shared by the connection of si."""
+    state = session_state(si)
+    if 'task_monitor' not in state:
+        state['task_monitor'] = TaskMonitor(si)
+    return state['task_monitor']
+
+
+def wait_for_tasks(service_instance, tasks, timeout=None, progress=None):
+    """Given the service instance si and tasks, it returns after all the
+   tasks are complete
+   """
+    monitor = task_monitor(service_instance)
+    futures = monitor.watch(tasks, progress)
+    monitor.wait(futures, timeout=timeout)
+    return [future.result() for future in futures]
 
 
 @contextmanager
-def disconnecting(connection):
+def disconnecting(connection, logout=True):
+    """Log out the connection on exit, unless logout is false to keep its
+    sessions alive for the next run. Those then get rid of the objects the
+    connection created in them, like the filter of the task monitor.
+    """
     try:
         yield connection
     finally:
-        connect.Disconnect(connection)
+        if logout:
+            for si in session.sessions(connection):
+                connect.Disconnect(si)
+        elif 'task_monitor' in session_state(connection):
+            try:
+                session_state(connection)['task_monitor'].close()
+            except Exception as ex:
+                LOG.warning("Failed to close the task monitor: %s", ex)
 
 
 class NotFound(Exception):
     pass
 
 
+class LostRace(Exception):
+    """An action lost a race with another client, like to a VM both
+    claimed, and is to be built anew rather than retried as it is.
+    """
+
+
+class InventoryIndex(object):
+    """Maps the inventory paths of one connection to the managed objects.
+
+    The map is filled by a single ContainerView sweep over the whole
+    inventory and is bounded, evicting the least recently used paths. A
+    path missing from a map that has not evicted anything does not exist;
+    otherwise the lookup falls back to FindByInventoryPath. With a
+    `miss_ttl`, the misses are trusted only that many seconds after the
+    sweep, for a long living connection to find what other clients create.
+    """
+
+    def __init__(self, si, maxsize=4096, miss_ttl=None):
+        self.si = si
+        self.maxsize = maxsize
+        self.miss_ttl = miss_ttl
+        self._lock = threading.Lock()
+        self._paths = None
+        self._complete = False
+        self._swept_time = None
+
+    def invalidate(self):
+        with self._lock:
+            self._paths = None
+
+    def added(self, obj=None, parent=None, name=None):
+        """Note new entities, keeping the cached paths but no longer
+        trusting the misses. The entity created in the parent under the
+        name gets cached by its path, if that of the parent is.
+        """
+        with self._lock:
+            self._complete = False
+            if obj is None or self._paths is None:
+                return
+            parent_path = next(iter(self._paths_of(parent)), None)
+            if parent_path is not None:
+                self._store('{}/{}'.format(parent_path, name), obj)
+
+    def moved(self, obj, parent=None, name=None):
+        """Note the entity got moved to the parent or renamed to the name,
+        or maybe either when given neither. Its cached path follows it if
+        known, it is dropped otherwise. The paths of its children, if any,
+        stay.
+        """
+        with self._lock:
+            if self._paths is None:
+                return
+            old = self._paths_of(obj)
+            for path in old:
+                del self._paths[path]
+            new = None
+            if old and (parent is not None or name is not None):
+                parent_path, _, old_name = old[0].rpartition('/')
+                if parent is not None:
+                    parent_path = next(iter(self._paths_of(parent)), None)
+                if parent_path is not None:
+                    new = '{}/{}'.format(parent_path, name or old_name)
+            if new is None:
+                self._complete = False
+            else:
+                self._store(new, obj)
+
+    def removed(self, obj, maybe=False):
+        """Note the entity got destroyed, with its children, or maybe only
+        some of them when `maybe`, no longer trusting the misses then.
+        """
+        with self._lock:
+            if self._paths is None:
+                return
+            old = self._paths_of(obj)
+            if not old and not self._complete:
+                # Its children may still be cached by their paths.
+                self._paths = None
+                return
+            prefixes = tuple(path + '/' for path in old)
+            for path in [path for path in self._paths
+                         if path in old or path.startswith(prefixes)]:
+                del self._paths[path]
+            if maybe:
+                self._complete = False
+
+    def _paths_of(self, obj):
+        return [path for path, cached in self._paths.items()
+                if cached._moId == obj._moId]
+
+    def find(self, path):
+        key = path.rstrip('/')
+        with self._lock:
+            if self._paths is None:
+                self._paths = OrderedDict()
+                self._complete = True
+                self._swept_time = time.time()
+                for entity_path, obj in self._sweep():
+                    self._store(entity_path, obj)
+            obj = self._paths.pop(key, None)
+            if obj is not None:
+                self._paths[key] = obj
+                return obj
+            if self._complete and (
+                    self.miss_ttl is None or
+                    time.time() - self._swept_time < self.miss_ttl):
+                return None
+        obj = service_content(self.si).searchIndex.FindByInventoryPath(
+            path)
+        if obj:
+            with self._lock:
+                if self._paths is not None:
+                    self._store(key, obj)
+        return obj
+
+    def find_typed(self, path, type_):
+        """Return the entity of the type at the path, looking it up among
+        all those of the type when another entity has the same path, like a
+        DVS and a port group of its name in the network folder.
+        """
+        obj = self.find(path)
+        if obj is None or isinstance(obj, type_):
+            return obj
+        parent_path, _, name = path.rstrip('/').rpartition('/')
+        parent = self.find(parent_path)
+        for candidate, props in retrieve_all(
+                self.si, type_, ['name', 'parent']).items():
+            if props.get('name') == name and props.get('parent') == parent:
+                return candidate
+        return None
+
+    def _store(self, path, obj):
+        self._paths[path] = obj
+        while len(self._paths) > self.maxsize:
+            self._paths.popitem(last=False)
+            self._complete = False
+
+    def _sweep(self):
+        found = retrieve_all(self.si, vim.ManagedEntity, ['name', 'parent'])
+        entities = {}
+        for obj, props in found.items():
+            entities[obj._moId] = (obj, props.get('name'),
+                                   props.get('parent'))
+        LOG.debug("Indexed %d inventory entities.", len(entities))
+
+        paths = {}
+        for moid in entities:
+            # Walk up to the root folder, which is not part of the view.
+            chain = []
+            while moid is not None and moid not in paths:
+                obj, name, parent = entities[moid]
+                chain.append((moid, name))
+                if parent is None:
+                    # vApp children have no parent folder, nor an
+                    # inventory path we could build.
+                    chain = []
+                    break
+                moid = parent._moId
+                if moid not in entities:
+                    moid = None
+            prefix = paths.get(moid) if moid is not None else None
+            for moid, name in reversed(chain):
+                prefix = name if prefix is None else prefix + '/' + name
+                paths[moid] = prefix
+        return [(path, entities[moid][0]) for moid, path in paths.items()]
+
+
+def retrieve_properties(si, objects, path_sets):
+    """Return the properties of the managed objects retrieved in one call,
+    as {object: {path: value}}. The path_sets map the managed object types
+    to the property paths to retrieve for them.
+    """
+    pc = vmodl.query.PropertyCollector
+    filter_spec = pc.FilterSpec(
+        objectSet=[pc.ObjectSpec(obj=obj) for obj in objects],
+        propSet=[pc.PropertySpec(type=type_, pathSet=list(paths))
+                 for type_, paths in path_sets.items()])
+    return dict(
+        (object_content.obj,
+         dict((prop.name, prop.val) for prop in object_content.propSet))
+        for object_content
+        in service_content(si).propertyCollector.RetrieveContents(
+            [filter_spec]))
+
+
+def retrieve_all(si, type_, paths):
+    """Return the properties of all the managed objects of the type in the
+    inventory, retrieved in one call, as {object: {path: value}}.
+    """
+    content = service_content(si)
+    pc = vmodl.query.PropertyCollector
+    view = content.viewManager.CreateContainerView(
+        content.rootFolder, [type_], True)
+    try:
+        traversal = pc.TraversalSpec(
+            name='traverseView', type=vim.view.ContainerView,
+            path='view', skip=False)
+        filter_spec = pc.FilterSpec(
+            objectSet=[pc.ObjectSpec(obj=view, skip=True,
+                                     selectSet=[traversal])],
+            propSet=[pc.PropertySpec(type=type_, pathSet=list(paths))])
+        contents = content.propertyCollector.RetrieveContents([filter_spec])
+    finally:
+        view.Destroy()
+    return dict(
+        (object_content.obj,
+         dict((prop.name, prop.val) for prop in object_content.propSet))
+        for object_content in contents)
+
+
+def inventory_index(si):
+    """Return the inventory index shared by the connection of si."""
+    state = session_state(si)
+    if 'inventory_index' not in state:
+        state['inventory_index'] = InventoryIndex(si)
+    return state['inventory_index']
+
+
+class HardwareCache(object):
+    """Caches the devices, the host and the datastores of the VMs of one
+    connection, by their moref and config.changeVersion.
+
+    The devices of any number of VMs come from one RetrieveContents call
+    of config.hardware.device only, rather than of the whole config of
+    each VM, together with their hosts and datastores, and those of the
+    VMs only located, for the concurrency limits of BatchExecutor. A
+    cached VM gets its changeVersion and host checked again, in the same
+    call, once they are older than `ttl` seconds, and its devices fetched
+    again only if it changed. The callers get copies of the devices, theirs
+    to edit into the specs.
+    """
+
+    LOCATION_PATHS = ['config.changeVersion', 'runtime.host', 'datastore']
+    PATHS = LOCATION_PATHS + ['config.hardware.device']
+    CHECK_PATHS = ['config.changeVersion', 'runtime.host']
+
+    def __init__(self, si, ttl=60):
+        self.si = si
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # {moid: (time, {path: value})}
+        self._vms = {}
+
+    def prefetch(self, vms, located=()):
+        """Fetch the devices of the VMs, and the host and datastores of the
+        `located` ones, not cached yet, and check the changeVersion of the
+        ones cached too long ago, in one call.
+        """
+        vms, located = list(vms), list(located)
+        now = time.time()
+        with self._lock:
+            batches = {'config.hardware.device': {}, 'datastore': {},
+                       'check': {}}
+            for needed, batch in (('datastore', located),
+                                  ('config.hardware.device', vms)):
+                for vm in batch:
+                    cached = self._vms.get(vm._moId)
+                    if cached is None or needed not in cached[1]:
+                        batches['check'].pop(vm._moId, None)
+                        batches['datastore'].pop(vm._moId, None)
+                        batches[needed][vm._moId] = vm
+                    elif cached[0] + self.ttl <= now:
+                        batches['check'][vm._moId] = vm
+        if not any(batches.values()):
+            return
+        pc = vmodl.query.PropertyCollector
+        filter_specs = [
+            pc.FilterSpec(objectSet=[pc.ObjectSpec(obj=vm)
+                                     for vm in batch.values()],
+                          propSet=[pc.PropertySpec(type=vim.VirtualMachine,
+                                                   pathSet=paths)])
+            for batch, paths in (
+                (batches['config.hardware.device'], self.PATHS),
+                (batches['datastore'], self.LOCATION_PATHS),
+                (batches['check'], self.CHECK_PATHS)) if batch]
+        with metrics.attributed(type(self).__name__):
+            contents = service_content(
+                self.si).propertyCollector.RetrieveContents(filter_specs)
+        wanted_devices = set(vm._moId for vm in vms)
+        changed = []
+        with self._lock:
+            for content in contents:
+                fetched = dict((prop.name, prop.val)
+                               for prop in content.propSet)
+                moid = content.obj._moId
+                props = self._vms.get(moid, (now, {}))[1]
+                if fetched.get('config.changeVersion') != \
+                        props.get('config.changeVersion'):
+                    devices = props.pop('config.hardware.device', None)
+                    if devices is not None and moid in batches['check'] \
+                            and moid in wanted_devices:
+                        changed.append(content.obj)
+                props.update(fetched)
+                self._vms[moid] = (now, props)
+        if changed:
+            LOG.debug("The hardware of %d VMs changed.", len(changed))
+            self.prefetch(changed)
+
+    def _get(self, vm, path):
+        if path == 'config.hardware.device':
+            self.prefetch([vm])
+        else:
+            self.prefetch([], [vm])
+        with self._lock:
+            return self._vms[vm._moId][1].get(path)
+
+    def devices(self, vm):
+        """Return a copy of the devices of the VM."""
+        devices = list(self._get(vm, 'config.hardware.device'))
+        # The managed objects the devices refer to keep their stub.
+        return copy.deepcopy(devices, {id(self.si._stub): self.si._stub})
+
+    def host(self, vm):
+        """Return the host of the VM."""
+        return self._get(vm, 'runtime.host')
+
+    def datastores(self, vm):
+        """Return the datastores of the VM."""
+        return list(self._get(vm, 'datastore') or [])
+
+    def note(self, vm, host, datastores):
+        """Note the host and the datastores of a VM the caller retrieved,
+        sparing their fetch.
+        """
+        with self._lock:
+            props = self._vms.get(vm._moId, (None, {}))[1]
+            props.update({'runtime.host': host, 'datastore': datastores})
+            self._vms[vm._moId] = (time.time(), props)
+
+    def forget(self, vm):
+        """Drop the devices of the VM, which got reconfigured."""
+        with self._lock:
+            cached = self._vms.get(vm._moId)
+            if cached is not None:
+                cached[1].pop('config.hardware.device', None)
+
+
+def hardware_cache(si):
+    """Return the hardware cache shared by the connection of si."""
+    state = session_state(si)
+    if 'hardware_cache' not in state:
+        state['hardware_cache'] = HardwareCache(si)
+    return state['hardware_cache']
+
+
 class Action(object):
+    # Whether the action changes inventory entities in a way the inventory
+    # index cannot follow, making it stale, or only creates new ones, which
+    # the index looks up on the first miss. The actions destroying, moving
+    # or renaming entities update the index themselves.
+    changes_inventory = False
+    adds_to_inventory = False
+
     def __init__(self, si):
         self.si = si
         self.tasks = []
+        self.progress_callback = None
+        self._futures = []
 
     def _find_obj(self, path):
-        obj = self.si.content.searchIndex.FindByInventoryPath(path)
+        with metrics.attributed(type(self).__name__):
+            obj = inventory_index(self.si).find(path)
         if not obj:
             raise NotFound(str(path))
         return obj
@@ -105,16 +700,85 @@ class Action(object):
         LOG.info("The action %s started.", self)
         return self
 
-    def wait(self):
-        if self.tasks:
-            wait_for_tasks(self.si, self.tasks)
+    def on_progress(self, callback):
+        """Have callback(action, percent) called as the tasks progress."""
+        self.progress_callback = callback
+        return self
+
+    def _task_progress(self, task, percent):
+        self.progress_callback(self, percent)
+
+    def futures(self):
+        """Return the futures of the tasks the action started."""
+        unwatched = self.tasks[len(self._futures):]
+        if unwatched:
+            self._futures.extend(task_monitor(self.si).watch(
+                unwatched,
+                self.progress_callback and self._task_progress))
+        return self._futures
+
+    def wait(self, timeout=None):
+        try:
+            if self.tasks:
+                futures = self.futures()
+                task_monitor(self.si).wait(futures, timeout=timeout)
+                for future in futures:
+                    future.result()
+        finally:
+            if self.changes_inventory:
+                inventory_index(self.si).invalidate()
+            elif self.adds_to_inventory:
+                inventory_index(self.si).added()
         LOG.info("The action %s have finished all the tasks.", self)
 
+    def attach(self, tasks):
+        """Follow the tasks an earlier run of the action started, instead
+        of starting it.
+        """
+        LOG.info("The action %s re-attached to its tasks.", self)
+        self.tasks = list(tasks)
+        self._futures = []
+        return self
+
+    def reset(self):
+        """Forget the tasks of a failed run, to start the action again."""
+        self.tasks = []
+        self._futures = []
+        return self
+
     def make_so(self):
-        self.start().wait()
+        with metrics.attributed(type(self).__name__):
+            self.start().wait()
+
+    def resources(self):
+        """Return the (kind, managed object) pairs of the resources the
+        action loads, for the concurrency limits of BatchExecutor.
+        """
+        return []
+
+    def hardware(self):
+        """Return the VMs whose devices the action reads on start, for
+        BatchExecutor to prefetch.
+        """
+        return []
+
+    def located(self):
+        """Return the VMs whose host or datastores the resources of the
+        action are, for BatchExecutor to prefetch.
+        """
+        return []
+
+    def hosts(self):
+        """Return the (thumbprints.ThumbprintStore, host) pairs of the hosts
+        whose thumbprints the action looks up on start, for BatchExecutor
+        to prefetch.
+        """
+        return []
 
 
 class CreateCluster(Action):
+    adds_to_inventory = True
+
     def name(self, name):
         self.name = name
         return self
@@ -130,6 +794,25 @@ class CreateCluster(Action):
 
 
 class CloneVm(Action):
+    """Clones a VM, by default copying all of its disks.
+
+    The linked mode creates delta disks on top of a snapshot of the source,
+    the one named LINKED_CLONE_SNAPSHOT, or else its current one. A source
+    without snapshots gets one on the first linked clone, unless it is a
+    template, which vSphere cannot snapshot. The instant mode forks the
+    running source, it cannot change the memory size and needs a backend
+    and pyVmomi of 6.7 or newer.
+
+    With a placement engine, the clone goes to the datastore and the host
+    the engine picks by their load.
+    """
+    adds_to_inventory = True
+
+    FULL = 'full'
+    LINKED = 'linked'
+    INSTANT = 'instant'
+    LINKED_CLONE_SNAPSHOT = 'vomit-linked-clone-base'
+
     def name(self, name):
         self.name_ = name
         return self
@@ -150,6 +833,50 @@ class CloneVm(Action):
         self.to_template = to_template
         return self
 
+    def placement(self, engine):
+        """Place the clone on the datastore and the host the
+        placement.Placement engine picks, instead of the datastore of the
+        source.
+        """
+        self.placement_ = engine
+        return self
+
+    def _place(self):
+        engine = getattr(self, 'placement_', None)
+        if engine is None:
+            return None
+        if getattr(self, '_placed', None) is None:
+            size, memoryMB = engine.footprint(self.source)
+            if getattr(self, 'mode_', self.FULL) != self.FULL:
+                # The delta disks start empty.
+                size = 0
+            memoryMB = getattr(self, 'memoryMB', None) or memoryMB
+            self._placed = engine.place(size, memoryMB)
+            self._charged = (size, memoryMB)
+        return self._placed
+
+    def _unplace(self):
+        # A failed clone does not load the place it got, a retry of it
+        # gets placed anew.
+        placed = getattr(self, '_placed', None)
+        if placed is not None:
+            self.placement_.release(placed[0], placed[1], *self._charged)
+            self._placed = None
+
+    def _location(self, location):
+        placed = self._place()
+        if placed:
+            location.datastore, location.host = placed
+        return location
+
+    def mode(self, mode):
+        if mode not in (self.FULL, self.LINKED, self.INSTANT):
+            raise ValueError("Unknown clone mode {}".format(mode))
+        if mode == self.INSTANT and not hasattr(vim.vm, 'InstantCloneSpec'):
+            raise ValueError("The instant clone needs pyVmomi 6.7 or newer.")
+        self.mode_ = mode
+        return self
+
     def _mac(self, mac):
         if mac:
             self.mac_ = str(mac)
@@ -160,46 +887,161 @@ class CloneVm(Action):
             self.memoryMB = int(memoryMB)
         return self
 
+    def _nic_changes(self):
+        mac = getattr(self, 'mac_', None)
+        if not mac:
+            return []
+        nics = [vm_device for vm_device
+                in hardware_cache(self.si).devices(self.source)
+                if isinstance(vm_device,
+                              vim.vm.device.VirtualEthernetCard)]
+        LOG.debug('Found ethernet devices %s', nics)
+        device = nics[0]
+
+        nicspec = vim.vm.device.VirtualDeviceSpec()
+        nicspec.operation = vim.vm.device.VirtualDeviceSpec.Operation.edit
+        nicspec.device = device
+        device.addressType = "manual"
+        device.macAddress = mac
+        return [nicspec]
+
+    def _find_snapshot(self, snapshots, name):
+        for snapshot in snapshots:
+            if snapshot.name == name:
+                return snapshot.snapshot
+            found = self._find_snapshot(snapshot.childSnapshotList, name)
+            if found:
+                return found
+        return None
+
+    def _linked_clone_snapshot(self):
+        # Only the first linked clone of a source looks the snapshot up, or
+        # creates it, the clones started at once by the workers of
+        # BatchExecutor wait for it and the later ones reuse it.
+        state = session_state(self.si)
+        snapshots = state.setdefault('linked_clone_snapshots', {})
+        snapshot = snapshots.get(self.source._moId)
+        if snapshot is not None:
+            return snapshot
+        locks = state.setdefault('snapshot_locks', {})
+        with locks.setdefault(self.source._moId, threading.Lock()):
+            snapshot = snapshots.get(self.source._moId)
+            if snapshot is None:
+                snapshot = self._find_or_create_snapshot()
+                snapshots[self.source._moId] = snapshot
+        return snapshot
+
+    def _find_or_create_snapshot(self):
+        props = retrieve_properties(
+            self.si, [self.source],
+            {vim.VirtualMachine: ['name', 'snapshot', 'config.template']}
+        ).get(self.source, {})
+        snapshot_info = props.get('snapshot')
+        if snapshot_info:
+            snapshot = self._find_snapshot(
+                snapshot_info.rootSnapshotList,
+                self.LINKED_CLONE_SNAPSHOT) or snapshot_info.currentSnapshot
+            if snapshot:
+                return snapshot
+        if props.get('config.template'):
+            raise ValueError(
+                "The template {} has no snapshot to create linked clones "
+                "of, and vSphere cannot snapshot templates.".format(
+                    props.get('name')))
+        LOG.info("Creating the snapshot %s of %s for linked clones.",
+                 self.LINKED_CLONE_SNAPSHOT, props.get('name'))
+        task = self.source.CreateSnapshot(
+            name=self.LINKED_CLONE_SNAPSHOT,
+            description="The base of linked clones.",
+            memory=False, quiesce=False)
+        snapshot, = wait_for_tasks(self.si, [task])
+        return snapshot
+
     def start(self):
+        try:
+            return self._start()
+        except Exception:
+            self._unplace()
+            raise
+
+    def wait(self, timeout=None):
+        try:
+            Action.wait(self, timeout)
+        except TaskTimeout:
+            # The clone may still finish on its place.
+            raise
+        except Exception:
+            self._unplace()
+            raise
+        # The later actions on the clone find it without a lookup.
+        inventory_index(self.si).added(self._futures[-1].result(),
+                                       self.folder, self.name_)
+
+    def _start(self):
         Action.start(self)
+        mode = getattr(self, 'mode_', self.FULL)
+        if mode == self.INSTANT:
+            return self._start_instant()
 
-        cs = vim.vm.ConfigSpec(deviceChange=[])
+        cs = vim.vm.ConfigSpec(deviceChange=self._nic_changes())
 
-        mac = getattr(self, 'mac_', None)
         memoryMB = getattr(self, 'memoryMB', None)
-
-        if mac:
-            nics = [vm_device for vm_device
-                    in self.source.config.hardware.device
-                    if isinstance(vm_device,
-                                  vim.vm.device.VirtualEthernetCard)]
-            LOG.debug('Found ethernet devices %s', nics)
-            device = nics[0]
-
-            nicspec = vim.vm.device.VirtualDeviceSpec()
-            nicspec.operation = vim.vm.device.VirtualDeviceSpec.Operation.edit
-            nicspec.device = device
-            device.addressType = "manual"
-            device.macAddress = str(self.mac_)
-            cs.deviceChange.append(nicspec)
-
         if memoryMB:
             cs.memoryMB = memoryMB
 
+        location = self._location(
+            vim.vm.RelocateSpec(pool=self.resource_pool))
         clone_spec = vim.vm.CloneSpec(
-            location=vim.vm.RelocateSpec(pool=self.resource_pool),
+            location=location,
             template=self.to_template,
             config=cs)
+        if mode == self.LINKED:
+            location.diskMoveType = 'createNewChildDiskBacking'
+            clone_spec.snapshot = self._linked_clone_snapshot()
         self.tasks.append(self.source.Clone(
             self.folder, self.name_, clone_spec))
         return self
 
+    def resources(self):
+        placed = self._place()
+        if placed:
+            datastore, host = placed
+            return [('pool', self.resource_pool), ('datastore', datastore),
+                    ('host', host)]
+        return ([('pool', self.resource_pool)] +
+                [('datastore', datastore) for datastore
+                 in hardware_cache(self.si).datastores(self.source)])
+
+    def located(self):
+        if getattr(self, 'placement_', None) is not None:
+            return []
+        return [self.source]
+
+    def hardware(self):
+        return [self.source] if getattr(self, 'mac_', None) else []
+
+    def _start_instant(self):
+        if getattr(self, 'memoryMB', None):
+            raise ValueError("The instant clone {} cannot change the memory "
+                             "size.".format(self.name_))
+        spec = vim.vm.InstantCloneSpec(
+            name=self.name_,
+            location=self._location(vim.vm.RelocateSpec(
+                pool=self.resource_pool, folder=self.folder,
+                deviceChange=self._nic_changes())))
+        self.tasks.append(self.source.InstantClone(spec))
+        return self
+
 
 class PowerOnVm(Action):
     def vm_path(self, path):
         self.vm = self._find_obj(path)
         return self
 
+    def vm_ref(self, vm):
+        self.vm = vm
+        return self
+
     def source_path(self, path):
         self.source = self._find_obj(path)
         return self
@@ -217,6 +1059,12 @@ class PowerOnVm(Action):
         self.tasks.append(self.vm.PowerOn())
         return self
 
+    def resources(self):
+        return [('host', hardware_cache(self.si).host(self.vm))]
+
+    def located(self):
+        return [self.vm]
+
 
 class PowerOffVm(PowerOnVm):
     def start(self):
@@ -226,6 +1074,21 @@ class PowerOffVm(PowerOnVm):
 
 
 class CreateVm(Action):
+    """Creates a VM.
+
+    The disks are provisioned thin, lazily zeroed thick or eagerly zeroed
+    thick. The disks get spread round-robin over the PVSCSI controllers
+    added by scsi() once the action starts.
+    """
+    adds_to_inventory = True
+
+    THIN = 'thin'
+    LAZY_ZEROED = 'lazy'
+    EAGER_ZEROED = 'eager'
+    MAX_SCSI_CONTROLLERS = 4
+    # The controller itself takes the unit 7 of its bus.
+    SCSI_UNITS = [unit for unit in range(16) if unit != 7]
+
     def __init__(self, si):
         Action.__init__(self, si)
         self.spec = vim.vm.ConfigSpec()
@@ -233,8 +1096,9 @@ class CreateVm(Action):
         self.spec.cpuHotAddEnabled = True
         self.spec.deviceChange = []
         self.spec.guestId = "rhel6_64Guest"
-        self._disk_no = 1
-        self._disk_controller_no = 1
+        self._disks = []
+        self._scsi_controllers = 0
+        self._disks_attached = False
 
     def name(self, name):
         self.spec.name = name
@@ -260,6 +1124,7 @@ class CreateVm(Action):
 
     def start(self):
         Action.start(self)
+        self._attach_disks()
         self.spec.files = vim.vm.FileInfo(
             vmPathName="[{datastore_name}] {name}".format(
                 datastore_name=self.datastore_name,
@@ -268,6 +1133,9 @@ class CreateVm(Action):
             config=self.spec, pool=self.host.resourcePool))
         return self
 
+    def resources(self):
+        return [('pool', self.host.resourcePool)]
+
     def network(self, net_name, mac=None):
         device = vim.vm.device.VirtualVmxnet3()
         device.backing = (
@@ -279,18 +1147,21 @@ class CreateVm(Action):
         self._add_dev(device)
         return self
 
-    def disk(self, size):
+    def disk(self, size, provisioning=LAZY_ZEROED):
+        if provisioning not in (self.THIN, self.LAZY_ZEROED,
+                                self.EAGER_ZEROED):
+            raise ValueError("Unknown disk provisioning {}".format(
+                provisioning))
         dev = vim.vm.device
         disk_uuid = uuid.uuid4()
 
         diskspec = dev.VirtualDisk(capacityInKB=int(size))
-        diskspec.controllerKey = self._disk_controller_no
-        diskspec.unitNumber = self._disk_no
-        self._disk_no += 1
         diskspec.backing = dev.VirtualDisk.FlatVer2BackingInfo()
         diskspec.backing.diskMode = \
             vim.vm.device.VirtualDiskOption.DiskMode.persistent
-        diskspec.backing.uuid = str(uuid)
+        diskspec.backing.thinProvisioned = provisioning == self.THIN
+        diskspec.backing.eagerlyScrub = provisioning == self.EAGER_ZEROED
+        diskspec.backing.uuid = str(disk_uuid)
         diskspec.backing.fileName = (
             '[{store}] {vm_name}/{disk_name}.vmdk'.format(
                 store=self.datastore_name,
@@ -298,15 +1169,45 @@ class CreateVm(Action):
                 disk_name="disk-{}".format(disk_uuid)))
         self._add_dev(diskspec).fileOperation = (
             dev.VirtualDeviceSpec.FileOperation.create)
+        self._disks.append(diskspec)
         return self
 
-    def scsi(self):
-        vctl1 = vim.vm.device.ParaVirtualSCSIController()
-        vctl1.key = 1
-        vctl1.sharedBus = "noSharing"
-        self._add_dev(vctl1)
+    def scsi(self, count=None):
+        """Add PVSCSI controllers, by default one per disk up to the
+        maximum of four.
+        """
+        if count is not None and not 1 <= count <= self.MAX_SCSI_CONTROLLERS:
+            raise ValueError("A VM can have 1 to {} SCSI controllers".format(
+                self.MAX_SCSI_CONTROLLERS))
+        self._scsi_controllers = count or -1
         return self
 
+    def _attach_disks(self):
+        if self._disks_attached:
+            return
+        self._disks_attached = True
+        count = self._scsi_controllers
+        if count < 0:
+            count = max(1, min(len(self._disks), self.MAX_SCSI_CONTROLLERS))
+        for bus in range(count):
+            controller = vim.vm.device.ParaVirtualSCSIController()
+            controller.key = bus + 1
+            controller.busNumber = bus
+            controller.sharedBus = "noSharing"
+            self._add_dev(controller)
+        # The controllers go first, before the disks referring to them.
+        self.spec.deviceChange = (self.spec.deviceChange[-count:] +
+                                  self.spec.deviceChange[:-count])
+
+        # Without a controller of its own, the disks go to the one of key 1.
+        buses = max(count, 1)
+        if len(self._disks) > buses * len(self.SCSI_UNITS):
+            raise ValueError("{} disks do not fit {} SCSI controllers".format(
+                len(self._disks), buses))
+        for i, disk in enumerate(self._disks):
+            disk.controllerKey = i % buses + 1
+            disk.unitNumber = self.SCSI_UNITS[i // buses]
+
     def _add_dev(self, device):
         spec = vim.vm.device.VirtualDeviceSpec()
         spec.device = device
@@ -316,11 +1217,15 @@ class CreateVm(Action):
 
 
 class CreateHost(Action):
+    adds_to_inventory = True
+
     ANY_THUMBPRINT = object()
 
     def __init__(self, si):
         super(CreateHost, self).__init__(si)
         self.spec = vim.host.ConnectSpec()
+        self.thumbprint_ = None
+        self.store = None
 
     def name(self, name):
         self.spec.hostName = name
@@ -336,34 +1241,70 @@ class CreateHost(Action):
         return self
 
     def thumbprint(self, thumbprint):
-        self.thumbprint = thumbprint
+        """Set the SSL thumbprint of the host, or ANY_THUMBPRINT to trust
+        the one of the thumbprint store.
+        """
+        self.thumbprint_ = thumbprint
+        return self
+
+    def thumbprint_store(self, store):
+        """Use the thumbprints.ThumbprintStore instead of the in-memory
+        one of the connection.
+        """
+        self.store = store
         return self
 
     def start(self):
         Action.start(self)
-        if self.thumbprint is self.ANY_THUMBPRINT:
+        if self.thumbprint_ is self.ANY_THUMBPRINT:
             self.spec.sslThumbprint = self.get_host_thumbprint()
-            self.tasks.append(self.cluster.AddHost(self.spec, True))
         else:
-            self.spec.sslThumbprint = self.thumbprint
+            self.spec.sslThumbprint = self.thumbprint_
+        if not self.tasks:
+            # Unless asking the vCenter for the thumbprint added the host.
             self.tasks.append(self.cluster.AddHost(self.spec, True))
         return self
 
+    def hosts(self):
+        if self.thumbprint_ is self.ANY_THUMBPRINT:
+            return [(self._thumbprint_store(), self.spec.hostName)]
+        return []
+
+    def _thumbprint_store(self):
+        return self.store or session_state(self.si).setdefault(
+            'thumbprints', thumbprints.ThumbprintStore())
+
     def get_host_thumbprint(self):
-        task = self.cluster.AddHost(self.spec, True)
-        while task.info.state == "running":
-            sleep(1)
-        if isinstance(task.info.error, vim.fault.SSLVerifyFault):
-            thumbprint = task.info.error.thumbprint
-            LOG.warning("Using thumbprint '{}' for host {} from non-secured "
-                        "source.".format(thumbprint,
-                                         self.spec.hostName))
-            return thumbprint
-        else:
-            raise task.info.error
+        host = self.spec.hostName
+        store = self._thumbprint_store()
+        try:
+            return store.lookup([host])[host]
+        except (IOError, OSError) as ex:
+            LOG.warning("Failed the TLS handshake with the host %s, taking "
+                        "its thumbprint from the vCenter: %s", host, ex)
+        thumbprint = self._vcenter_thumbprint()
+        if thumbprint:
+            store.remember(host, thumbprint)
+        return thumbprint
+
+    def _vcenter_thumbprint(self):
+        # The vCenter refuses to add a host without its thumbprint, telling
+        # the one the host presented. One adding it anyway adds it for the
+        # action.
+        spec = copy.copy(self.spec)
+        spec.sslThumbprint = None
+        task = self.cluster.AddHost(spec, True)
+        try:
+            wait_for_tasks(self.si, [task])
+        except vim.fault.SSLVerifyFault as fault:
+            return fault.thumbprint
+        self.tasks.append(task)
+        return None
 
 
 class CreateDVSwitch(Action):
+    adds_to_inventory = True
+
     def name(self, name):
         spec = vim.dvs.VmwareDistributedVirtualSwitch.ConfigSpec(name=name)
         self.switch_spec = vim.DistributedVirtualSwitch.CreateSpec(
@@ -376,12 +1317,14 @@ class CreateDVSwitch(Action):
 
     def start(self):
         Action.start(self)
-        self.task = self.network_folder.CreateDistributedVirtualSwitch(
-            self.switch_spec)
+        self.tasks.append(self.network_folder.CreateDistributedVirtualSwitch(
+            self.switch_spec))
         return self
 
 
 class CreateDVSwitchPortGroup(Action):
+    adds_to_inventory = True
+
     def __init__(self, si):
         Action.__init__(self, si)
         self.spec = vim.dvs.DistributedVirtualPortgroup.ConfigSpec()
@@ -406,7 +1349,25 @@ class CreateDVSwitchPortGroup(Action):
 
     def start(self):
         Action.start(self)
-        self.task = self.vswitch.AddPortgroup(self.spec)
+        self.tasks.append(self.vswitch.AddPortgroup(self.spec))
+        return self
+
+
+class ReconfigureDVSwitchPortGroup(CreateDVSwitchPortGroup):
+    adds_to_inventory = False
+
+    def path(self, path):
+        self.portgroup = self._find_obj(path)
+        return self
+
+    def ref(self, portgroup):
+        self.portgroup = portgroup
+        return self
+
+    def start(self):
+        Action.start(self)
+        self.spec.configVersion = self.portgroup.config.configVersion
+        self.tasks.append(self.portgroup.Reconfigure(self.spec))
         return self
 
 
@@ -419,12 +1380,29 @@ class DestroyEntity(Action):
             pass
         return self
 
+    def ref(self, entity):
+        self.entity = entity
+        return self
+
     def start(self):
         Action.start(self)
         if self.entity:
             self.tasks.append(self.entity.Destroy())
         return self
 
+    def wait(self, timeout=None):
+        try:
+            Action.wait(self, timeout)
+        except Exception:
+            # A task failing or timing out may still destroy some of it.
+            self._removed(maybe=True)
+            raise
+        self._removed()
+
+    def _removed(self, maybe=False):
+        if self.entity:
+            inventory_index(self.si).removed(self.entity, maybe)
+
 
 class DestroyVM(DestroyEntity):
     pass
@@ -441,6 +1419,10 @@ class DisconnectHost(DestroyEntity):
             self.tasks.append(self.entity.Disconnect())
         return self
 
+    def _removed(self, maybe=False):
+        # The host stays in the inventory.
+        pass
+
 
 class DestroyCluster(DestroyEntity):
     pass
@@ -451,6 +1433,8 @@ class DestroyDVSwitch(DestroyEntity):
 
 
 class ChangeMAC(Action):
+    _mac = None
+
     def path(self, path):
         self.entity = self._find_obj(path)
         return self
@@ -459,9 +1443,9 @@ class ChangeMAC(Action):
         self._mac = mac
         return self
 
-    def start(self):
-        Action.start(self)
-        device = [device for device in self.entity.config.hardware.device
+    def _spec(self):
+        device = [device for device
+                  in hardware_cache(self.si).devices(self.entity)
                   if isinstance(device, vim.vm.device.VirtualEthernetCard)][0]
         cs = vim.vm.ConfigSpec(deviceChange=[])
 
@@ -471,20 +1455,572 @@ class ChangeMAC(Action):
         device.addressType = "manual"
         device.macAddress = self._mac
         cs.deviceChange.append(nicspec)
+        return cs
+
+    def start(self):
+        Action.start(self)
+        self.tasks.append(self.entity.Reconfigure(self._spec()))
+        return self
+
+    def wait(self, timeout=None):
+        try:
+            Action.wait(self, timeout)
+        finally:
+            hardware_cache(self.si).forget(self.entity)
+
+    def resources(self):
+        return [('host', hardware_cache(self.si).host(self.entity))]
+
+    def located(self):
+        return [self.entity]
 
-        self.tasks.append(self.entity.Reconfigure(cs))
+    def hardware(self):
+        return [self.entity] if self._mac else []
+
+
+class ReconfigureVm(ChangeMAC):
+    """Changes the memory and the MAC of a VM in a single Reconfigure."""
+    memoryMB = None
+
+    def memory(self, memoryMB):
+        if memoryMB:
+            self.memoryMB = int(memoryMB)
+        return self
+
+    def _spec(self):
+        cs = ChangeMAC._spec(self) if self._mac else vim.vm.ConfigSpec()
+        if self.memoryMB:
+            cs.memoryMB = self.memoryMB
+        return cs
+
+
+class RenameEntity(Action):
+    def path(self, path):
+        self.entity = self._find_obj(path)
+        return self
+
+    def ref(self, entity):
+        self.entity = entity
+        return self
+
+    def name(self, name):
+        self.name_ = name
+        return self
+
+    def start(self):
+        Action.start(self)
+        self.tasks.append(self.entity.Rename(self.name_))
         return self
 
+    def wait(self, timeout=None):
+        index = inventory_index(self.si)
+        try:
+            Action.wait(self, timeout)
+        except Exception:
+            # A task timing out may still rename it.
+            index.moved(self.entity)
+            raise
+        self._moved(index)
+
+    def _moved(self, index):
+        index.moved(self.entity, name=self.name_)
+
+
+class MoveEntity(RenameEntity):
+    def into(self, folder_path):
+        self.folder = self._find_obj(folder_path)
+        return self
+
+    def start(self):
+        Action.start(self)
+        self.tasks.append(self.folder.MoveInto([self.entity]))
+        return self
+
+    def _moved(self, index):
+        index.moved(self.entity, parent=self.folder)
+
+
+class RetryPolicy(object):
+    """Which faults of an action are worth retrying, and when.
+
+    The `faults` map the fault classes to how many times an action failing
+    with them gets retried. The n-th retry waits `base` * 2 ** n seconds,
+    at most `cap`, varied by the `jitter` fraction so the retries of a
+    batch do not all hit the vCenter at once.
+    """
+
+    TRANSIENT_FAULTS = {
+        vim.fault.TaskInProgress: 5,
+        vim.fault.ResourceInUse: 5,
+        vim.fault.ConcurrentAccess: 3,
+        vim.fault.FileLocked: 3,
+        vmodl.fault.HostCommunication: 3,
+    }
+
+    def __init__(self, faults=None, base=1.0, cap=60.0, jitter=0.5):
+        self.faults = self.TRANSIENT_FAULTS if faults is None else faults
+        self.base = base
+        self.cap = cap
+        self.jitter = jitter
+
+    def delay(self, error, retries):
+        """Return the seconds to wait before retrying an action failed
+        with the error after the number of retries, None to give up.
+        """
+        limits = [limit for fault, limit in self.faults.items()
+                  if isinstance(error, fault)]
+        if not limits or retries >= max(limits):
+            return None
+        delay = min(self.cap, self.base * 2 ** retries)
+        return delay * (1 + self.jitter * (2 * random.random() - 1))
+
+
+class _Step(object):
+    def __init__(self, action, after, key=None):
+        self.action = action
+        self.key = key
+        self.build = None
+        self.retries = 0
+        self.after = after
+        self.dependents = []
+        self.resources = None
+        self.started = False
+        self.finished = False
+        self.error = None
+        self.progress = 0
+        self.start_time = None
+        self.finish_time = None
+
+    def __str__(self):
+        return self.key or str(self.action)
+
+
 class BatchExecutor(object):
+    """Starts the submitted actions and waits for all of them on exit.
+
+    An action submitted with the step of another one as `after` starts as
+    soon as that predecessor finishes, so a chain of actions on one entity
+    advances at its own pace instead of waiting for the whole batch. Such
+    an action can be given as a callable building it, for the actions
+    looking up an entity the predecessor creates.
+
+    At most `limit` actions run at once, and at most
+    `per_resource_limits[kind]` of them on one resource of the kind the
+    actions report by their `resources` method ('host', 'datastore' or
+    'pool'). The actions over the limits queue up in the submission order.
+
+    An action not done in `task_timeout` seconds, or the timeout of the
+    task monitor, fails. The `progress` callback gets the percentage of
+    the submitted actions done whenever a task progresses.
+
+    Large batches can be fed instead of submitted, see feed.
+
+    An action failing with a fault the `retry` RetryPolicy deems transient
+    starts again after a backoff, built anew when it was given as a
+    callable. Only the failed actions are retried, their dependents wait.
+    An action given as a callable failing with LostRace gets built anew
+    and started right away, with or without a `retry`.
+
+    The actions submitted with a key get recorded by the `journal`, see
+    the journal module. The ones an earlier run recorded as done are
+    skipped, the ones it started follow their tasks if the vCenter
+    still knows them.
+
+    With `workers`, the actions ready at once get started by that many
+    threads at once, rather than one after another, and their tasks get
+    watched by one call. The actions then start only once the submitting
+    is done, on exit, or as the earlier ones finish. Over a service
+    instance of session.connect_pool, each thread makes its calls over a
+    session of its own.
+    """
+
+    def __init__(self, limit=None, per_resource_limits=None,
+                 task_timeout=None, progress=None, backlog=256, retry=None,
+                 journal=None, workers=None):
+        self.limit = limit
+        self.workers = workers
+        self.task_timeout = task_timeout
+        self.progress = progress
+        self.backlog = backlog
+        self.retry = retry
+        self.journal = journal
+        self.per_resource_limits = dict(
+            (kind, value) for kind, value
+            in (per_resource_limits or {}).items() if value)
+
     def __enter__(self):
-        self.actions = []
+        self.steps = []
+        self.errors = []
+        self.queue = []
+        self._feeds = []
+        self._finished = 0
+        self._delayed = []
+        self._resumed_lock = threading.Lock()
+        self._resumed = 0
+        self._running = 0
+        self._peak_running = 0
+        self._usage = {}
+        self._enter_time = time.time()
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
-        while self.actions:
-            action = self.actions.pop()
-            action.wait()
-
-    def submit(self, action):
-        action.start()
-        self.actions.append(action)
+        if exc_type is None:
+            self._pull()
+            if self.workers:
+                self._dispatch()
+        running = [step for step in self.steps if step.started]
+        while running or self._delayed:
+            for step in running:
+                if all(future.done() for future in step.action.futures()):
+                    self._finish(step)
+            self._restart_due()
+            if exc_type is None:
+                self._pull()
+            if self.workers:
+                self._dispatch()
+            running = [step for step in self.steps
+                       if step.started and not step.finished]
+            self._sync_journal()
+            if running:
+                # Steps of another connection get their turn once this one
+                # is done with the step it waits for.
+                monitor = task_monitor(running[0].action.si)
+                timeout = self.task_timeout or monitor.timeout
+                remaining = None
+                if timeout:
+                    deadline = min(step.start_time for step in running) + \
+                        timeout
+                    remaining = max(0, deadline - time.time())
+                if self._delayed:
+                    due = max(0, self._delayed[0][0] - time.time())
+                    remaining = due if remaining is None else min(remaining,
+                                                                  due)
+                try:
+                    monitor.wait(
+                        [future for step in running
+                         if task_monitor(step.action.si) is monitor
+                         for future in step.action.futures()],
+                        return_when=concurrent.futures.FIRST_COMPLETED,
+                        timeout=remaining)
+                except TaskTimeout:
+                    for step in running:
+                        if timeout and \
+                                step.start_time + timeout <= time.time():
+                            self._finish(step, TaskTimeout(
+                                "The action {} did not finish in {} "
+                                "s.".format(step, timeout)))
+            elif self._delayed:
+                time.sleep(max(0, self._delayed[0][0] - time.time()))
+        self._sync_journal()
+        report = self.report()
+        LOG.info("Finished %(actions)d actions (%(failed)d failed) in "
+                 "%(seconds).1f s, %(actions_per_minute).1f actions/min, "
+                 "%(mean_action_seconds).1f s per action, at most "
+                 "%(peak_running)d at once.", report)
+        if self.errors and exc_type is None:
+            raise self.errors[0]
+
+    def submit(self, action, after=None, key=None):
+        """Submit the action, or a callable building it, to start once
+        the `after` step finishes, returning its step. The key identifies
+        the action in the journal.
+        """
+        step = _Step(action, after, key)
+        self.steps.append(step)
+        if after is None or after.finished and after.error is None:
+            self._ready(step)
+        elif after.finished:
+            self._skip(step)
+        else:
+            after.dependents.append(step)
+        return step
+
+    def feed(self, chains):
+        """Submit the actions of an iterable of callables, each of which
+        submits one chain of actions when called with the executor.
+
+        The callables are pulled only while fewer than `backlog` submitted
+        actions are unfinished, so the actions of a large batch get built
+        as the earlier ones finish rather than all up front.
+        """
+        self._feeds.append(iter(chains))
+        self._pull()
+
+    def _pull(self):
+        while self._feeds and len(self.steps) - self._finished < self.backlog:
+            try:
+                submit_chain = next(self._feeds[0])
+            except StopIteration:
+                self._feeds.pop(0)
+                continue
+            submit_chain(self)
+
+    def report(self):
+        """Return the throughput measured so far, to tune the limits."""
+        finished = [step for step in self.steps
+                    if step.finish_time is not None]
+        seconds = time.time() - self._enter_time
+        durations = [step.finish_time - step.start_time for step in finished]
+        return {
+            'actions': len(finished),
+            'failed': len([step for step in self.steps if step.error]),
+            'seconds': seconds,
+            'actions_per_minute': len(finished) * 60.0 / seconds,
+            'mean_action_seconds': (
+                sum(durations) / len(durations) if durations else 0.0),
+            'peak_running': self._peak_running,
+            'resumed': self._resumed,
+        }
+
+    def _record(self, step, state, tasks=None):
+        if self.journal is not None and step.key:
+            self.journal.record(step.key, state, tasks)
+
+    def _sync_journal(self):
+        # Once per pass of the loop, for the records of all its steps.
+        if self.journal is not None:
+            self.journal.sync()
+
+    def _ready(self, step):
+        if self.journal is not None and step.key and \
+                self.journal.done(step.key):
+            LOG.info("Skipping the action %s, done by an earlier run.", step)
+            self._resumed += 1
+            self._mark_finished(step)
+            for dependent in step.dependents:
+                self._ready(dependent)
+            return
+        try:
+            if not isinstance(step.action, Action):
+                step.build = step.action
+                step.action = step.action()
+        except Exception as ex:
+            self._retry_or_fail(step, ex)
+            return
+        step.resources = None
+        self.queue.append(step)
+        if not self.workers:
+            self._dispatch()
+
+    def _fits(self, step):
+        if self.limit and self._running >= self.limit:
+            return False
+        return all(self._usage.get(resource, 0) <
+                   self.per_resource_limits[resource[0]]
+                   for resource in step.resources)
+
+    def _dispatch(self):
+        self._prefetch(self.queue)
+        self._locate(self.queue)
+        while self.queue:
+            starting = []
+            for step in list(self.queue):
+                if self._fits(step) or not self._running:
+                    self.queue.remove(step)
+                    self._claim(step)
+                    starting.append(step)
+            if not starting:
+                return
+            # The steps failing to start leave room for the next ones.
+            self._start(starting)
+
+    def _claim(self, step):
+        self._running += 1
+        self._peak_running = max(self._peak_running, self._running)
+        for resource in step.resources:
+            self._usage[resource] = self._usage.get(resource, 0) + 1
+
+    def _release(self, step):
+        self._running -= 1
+        for resource in step.resources:
+            self._usage[resource] -= 1
+
+    def _prefetch(self, steps):
+        # The devices the queued actions read on start, and the hosts and
+        # datastores of their resources, of any number of them, come by one
+        # call per connection. The thumbprints of the hosts the newly queued
+        # ones add come by one lookup per store, handshaking in parallel.
+        vms = {}
+        hosts = {}
+        for step in steps:
+            batches = vms.setdefault(step.action.si._stub,
+                                     (step.action.si, [], []))
+            batches[1].extend(step.action.hardware())
+            if step.resources is None:
+                if self.per_resource_limits:
+                    batches[2].extend(step.action.located())
+                for store, host in step.action.hosts():
+                    hosts.setdefault(store, []).append(host)
+        for si, batch, located in vms.values():
+            if batch or located:
+                hardware_cache(si).prefetch(batch, located)
+        for store, batch in hosts.items():
+            try:
+                store.lookup(batch)
+            except Exception as ex:
+                # The actions of the hosts failing the handshake fail on
+                # start by themselves.
+                LOG.debug("Failed to prefetch the thumbprints: %s", ex)
+
+    def _locate(self, steps):
+        for step in list(steps):
+            if step.resources is not None:
+                continue
+            if not self.per_resource_limits:
+                step.resources = []
+                continue
+            try:
+                with metrics.attributed(type(step.action).__name__):
+                    step.resources = [
+                        (kind, obj._moId) for kind, obj
+                        in step.action.resources()
+                        if kind in self.per_resource_limits]
+            except Exception as ex:
+                steps.remove(step)
+                step.resources = []
+                self._retry_or_fail(step, ex)
+
+    def percent_complete(self):
+        if not self.steps:
+            return 100.0
+        return sum(100 if step.finished else step.progress
+                   for step in self.steps) / float(len(self.steps))
+
+    def _step_progress(self, step, action, percent):
+        step.progress = percent
+        self.progress(self.percent_complete())
+
+    def _start(self, steps):
+        for step in steps:
+            if self.progress:
+                step.action.on_progress(
+                    functools.partial(self._step_progress, step))
+        if self.workers and len(steps) > 1:
+            with concurrent.futures.ThreadPoolExecutor(
+                    min(self.workers, len(steps))) as workers:
+                errors = list(workers.map(self._start_action, steps))
+        else:
+            errors = [self._start_action(step) for step in steps]
+
+        started = OrderedDict()
+        for step, error in zip(steps, errors):
+            if error is None:
+                started.setdefault(step.action.si._stub, []).append(step)
+            else:
+                self._release(step)
+                self._retry_or_fail(step, error)
+        for batch in started.values():
+            # Watch the tasks right away, all the waits then share the
+            # updates.
+            with task_monitor(batch[0].action.si).batched():
+                for step in batch:
+                    try:
+                        self._record(step, journal.STARTED,
+                                     [task._moId
+                                      for task in step.action.tasks])
+                        step.action.futures()
+                    except Exception as ex:
+                        self._release(step)
+                        self._retry_or_fail(step, ex)
+                        continue
+                    step.started = True
+                    step.start_time = time.time()
+
+    def _start_action(self, step):
+        # Runs in a thread of the workers, returning the error.
+        try:
+            with metrics.attributed(type(step.action).__name__):
+                if not self._reattach(step):
+                    step.action.start()
+        except Exception as ex:
+            return ex
+        return None
+
+    def _reattach(self, step):
+        moids = self.journal and step.key and \
+            self.journal.started_tasks(step.key)
+        if not moids:
+            return False
+        # The tasks outlive the recent tasks of the task manager by far,
+        # they are looked up by their morefs.
+        si = step.action.si
+        tasks = [vim.Task(moid, si._stub) for moid in moids]
+        try:
+            found = retrieve_properties(si, tasks, {vim.Task: ['info.state']})
+        except vmodl.fault.ManagedObjectNotFound:
+            found = {}
+        if len(found) < len(tasks):
+            LOG.warning("Starting the action %s again, the vCenter no "
+                        "longer knows its tasks.", step)
+            return False
+        with self._resumed_lock:
+            self._resumed += 1
+        step.action.attach(tasks)
+        return True
+
+    def _mark_finished(self, step):
+        if not step.finished:
+            step.finished = True
+            self._finished += 1
+
+    def _finish(self, step, error=None):
+        step.finish_time = time.time()
+        self._release(step)
+        if error is None:
+            try:
+                step.action.wait()
+            except Exception as ex:
+                error = ex
+        if error is not None:
+            self._retry_or_fail(step, error)
+        else:
+            self._record(step, journal.DONE)
+            self._mark_finished(step)
+            for dependent in step.dependents:
+                self._ready(dependent)
+        if self.progress:
+            self.progress(self.percent_complete())
+        if not self.workers:
+            self._dispatch()
+
+    def _retry_or_fail(self, step, error):
+        self._record(step, journal.FAILED)
+        if isinstance(error, LostRace) and step.build is not None:
+            LOG.info("Building the action %s anew: %s", step, error)
+            delay = 0
+        else:
+            delay = None
+            if self.retry is not None:
+                delay = self.retry.delay(error, step.retries)
+            if delay is None:
+                self._fail(step, error)
+                return
+            LOG.warning("Retrying the action %s in %.1f s, it failed: %s",
+                        step, delay, error)
+            step.retries += 1
+        step.started = False
+        step.progress = 0
+        heapq.heappush(self._delayed, (time.time() + delay, id(step), step))
+
+    def _restart_due(self):
+        while self._delayed and self._delayed[0][0] <= time.time():
+            _, _, step = heapq.heappop(self._delayed)
+            if step.build is not None:
+                step.action = step.build
+            else:
+                step.action.reset()
+            self._ready(step)
+
+    def _fail(self, step, error):
+        LOG.error("The action %s failed: %s", step, error)
+        step.error = error
+        self._mark_finished(step)
+        self.errors.append(error)
+        for dependent in step.dependents:
+            self._skip(dependent)
+
+    def _skip(self, step):
+        LOG.warning("Skipping the action %s, its predecessor failed.", step)
+        self._mark_finished(step)
+        for dependent in step.dependents:
+            self._skip(dependent)
@@ -0,0 +1,116 @@
+#!/usr/bin/python
+
+# Copyright (C) 2015  Jaroslav Henner
+#
+# This file is part of pyvmomi ansible module.
+#
+# pyvmomi_ansible module is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+#
+# pyvmomi ansible module is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pyvmomi ansible more.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Awaitable versions of the start, wait and make_so of the actions.
+
+    action = ac.CloneVm(si).name(...)...
+    await aioactions.make_so(action)
+
+The SOAP calls of starting an action run in the default executor of the
+loop. The tasks are awaited through the shared task monitor of the
+connection, whose updates one thread per connection pumps while any
+task is awaited, for all the loops.
+"""
+
+import asyncio
+import logging
+import threading
+
+import actions as ac
+import metrics
+
+
+LOG = logging.getLogger(__name__)
+
+
+class AsyncTaskMonitor(object):
+    """Resolves the tasks of one connection for the coroutines of any loop.
+
+    A daemon thread runs the WaitForUpdatesEx loop of the task monitor
+    with a bounded wait while any task is watched, so any number of tasks
+    can be awaited at once without a thread per wait. The thread ends once
+    no task is watched, and the next wait starts another.
+    """
+
+    def __init__(self, si, max_wait_seconds=10):
+        self.monitor = ac.task_monitor(si)
+        self.max_wait_seconds = max_wait_seconds
+        self._lock = threading.Lock()
+        self._thread = None
+
+    async def wait(self, futures):
+        """Return the results of the task futures of the monitor once all
+        of them are done.
+        """
+        self._pump()
+        return await asyncio.gather(
+            *[asyncio.wrap_future(future) for future in futures])
+
+    def _pump(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name='vomit-task-monitor')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self.monitor.pending():
+                    self._thread = None
+                    return
+            try:
+                self.monitor.pump(max_wait_seconds=self.max_wait_seconds)
+            except Exception as ex:
+                LOG.exception("Waiting for the task updates failed.")
+                self.monitor.abort(ex)
+
+
+def async_task_monitor(si):
+    """Return the async task monitor of the connection of si."""
+    state = ac.session_state(si)
+    if 'async_task_monitor' not in state:
+        state['async_task_monitor'] = AsyncTaskMonitor(si)
+    return state['async_task_monitor']
+
+
+def _start(action):
+    with metrics.attributed(type(action).__name__):
+        action.start()
+
+
+async def start(action):
+    loop = asyncio.get_event_loop()
+    await loop.run_in_executor(None, _start, action)
+    return action
+
+
+async def wait(action):
+    loop = asyncio.get_event_loop()
+    futures = await loop.run_in_executor(None, action.futures)
+    if futures:
+        await async_task_monitor(action.si).wait(futures)
+    # The tasks are done already, this only finishes the bookkeeping.
+    action.wait()
+    return action
+
+
+async def make_so(action):
+    await start(action)
+    return await wait(action)
@@ -18,119 +18,356 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
 # USA.
 
-try:
-    from oslo.config import cfg
-except ImportError:
-    from oslo_config import cfg
-
-from pyVim import connect
+import functools
+import json
+import logging
+import time
 
 import actions as ac
+from all_in_one_cli import CONF
+from all_in_one_cli import vcenter_opts
+import daemon
+import fanout
+import guest
+import journal
+import metrics
+import placement
+import pool
+import session
+import teardown
+import topology
+
+LOG = logging.getLogger(__name__)
+
+
+class _ProgressLog(object):
+    def __init__(self):
+        self.logged = -1
+
+    def __call__(self, percent):
+        if int(percent) // 10 > self.logged:
+            self.logged = int(percent) // 10
+            LOG.info("%d%% of the batch done.", percent)
+
+
+def _executor(si, journal=None):
+    workers = len(session.sessions(si))
+    return ac.BatchExecutor(
+        progress=_ProgressLog(),
+        workers=workers if workers > 1 else None,
+        retry=ac.RetryPolicy() if CONF.retry_transient_faults else None,
+        journal=journal,
+        limit=CONF.max_concurrent_actions,
+        per_resource_limits={
+            'host': CONF.max_actions_per_host,
+            'datastore': CONF.max_actions_per_datastore,
+            'pool': CONF.max_actions_per_resource_pool,
+        })
+
+
+def _vm_path(node):
+    return "New Datacenter/vm/{}/{}".format(node.folder, node.name)
+
+
+def _change_mac(si, node):
+    return ac.ChangeMAC(si).path(_vm_path(node)).mac(node.mac)
+
+
+def _template_path(node):
+    return "New Datacenter/vm/{}".format(node.template)
+
+
+def _resource_pool_path():
+    return 'New Datacenter/host/{}/Resources'.format(CONF.vm_cluster_name)
+
+
+def _pool_folder_path():
+    return "New Datacenter/vm/{}".format(CONF.pool_folder)
+
+
+def _move_claimed(si, node):
+    return (ac.MoveEntity(si)
+            .path("{}/{}".format(_pool_folder_path(), node.name))
+            .into("New Datacenter/vm/{}".format(node.folder)))
+
+
+def _power_on(si, node, vms):
+    # Noting the VM for present_vms to wait for its guest.
+    power_on = ac.PowerOnVm(si).vm_path(_vm_path(node))
+    vms[power_on.vm] = node.name
+    return power_on
+
+
+def _vms():
+    """Generate the topology.Node of the VMs of the deployment."""
+    if CONF.topology_file:
+        return topology.nodes(topology.load(CONF.topology_file),
+                              prefix=CONF.deployment_prefix,
+                              folder=CONF.vm_folder_path,
+                              template=CONF.template_name)
+    for name in ('controller_vm_mac', 'tester_vm_mac'):
+        if not CONF[name]:
+            raise ValueError("The {} is required without a "
+                             "topology_file.".format(name))
+    return iter([
+        topology.Node("{}controller".format(CONF.deployment_prefix),
+                      CONF.controller_vm_memory, CONF.controller_vm_mac,
+                      CONF.vm_folder_path, CONF.template_name),
+        topology.Node("{}tester".format(CONF.deployment_prefix),
+                      CONF.tester_vm_memory, CONF.tester_vm_mac,
+                      CONF.vm_folder_path, CONF.template_name),
+    ])
+
+
+def _clone(si, node, engine, folder_path):
+    clone = (
+        ac.CloneVm(si)
+        .name(node.name)
+        .to_template(False)
+        .mode(CONF.clone_mode)
+        ._memory(node.memory)
+        .vm_folder_path(folder_path)
+        .source_path(_template_path(node))
+        .resource_pool_path(_resource_pool_path())
+    )
+    if engine:
+        clone.placement(engine)
+    return clone
+
+
+def _claim(si, node, engine, members):
+    # Built anew by the executor for each claim lost to another run. With
+    # all the members lost, the VM gets cloned into the pool folder
+    # instead, for the move and power on to follow either.
+    try:
+        return (pool.ClaimVm(si)
+                .members(members)
+                .name(node.name)
+                .memory(node.memory)
+                .mac(node.mac))
+    except pool.Exhausted:
+        LOG.info("The other runs claimed the rest of the pool, cloning "
+                 "%s.", node.name)
+        return _clone(si, node, engine, _pool_folder_path())._mac(node.mac)
+
 
-opts = [
-    cfg.StrOpt('controller_vm_mac', required=True),
-    cfg.StrOpt('controller_vm_memory'),
-    cfg.StrOpt('tester_vm_mac', required=True),
-    cfg.StrOpt('tester_vm_memory'),
-    cfg.StrOpt('vm_folder_path', default='khaleesi'),
-    cfg.StrOpt('vm_cluster_name', default='bar'),
-    cfg.StrOpt('template_name', default="rhel-guest-image"),
-    cfg.StrOpt('deployment_prefix', default=""),
-    cfg.BoolOpt(
-        'workaround_pyvmomi_235',
-        default=False,
-        help='Workaround https://github.com/vmware/pyvmomi/issues/235'),
-]
-
-vcenter_opts = [
-    cfg.StrOpt('host', required=True,
-               help='The address of the vcenter.'),
-    cfg.StrOpt('user', default='root'),
-    cfg.StrOpt('password', required=True, secret=True),
-]
-
-
-CONF = cfg.ConfigOpts()
-CONF.register_opts(opts)
-CONF.register_opts(vcenter_opts, group="vcenter")
-
-
-def state_present(si):
-    controller_vm_name = "{}controller".format(CONF.deployment_prefix)
-    tester_vm_name = "{}tester".format(CONF.deployment_prefix)
-
-    with ac.BatchExecutor() as be:
-        for name, memory in ((controller_vm_name, CONF.controller_vm_memory),
-                             (tester_vm_name, CONF.tester_vm_memory)):
-            be.submit(
-                ac.CloneVm(si)
-                .name(name)
-                .to_template(False)
-                ._memory(memory)
-                .vm_folder_path("New Datacenter/vm/{}".format(
-                    CONF.vm_folder_path))
-                .source_path("New Datacenter/vm/{}".format(CONF.template_name))
-                .resource_pool_path('New Datacenter/host/{}/Resources'.format(
-                    CONF.vm_cluster_name))
-            )
-    with ac.BatchExecutor() as be:
-        for name, mac in ((controller_vm_name, CONF.controller_vm_mac),
-                          (tester_vm_name, CONF.tester_vm_mac)):
-            be.submit(
-                ac.ChangeMAC(si)
-                .path('New Datacenter/vm/{}/{}'.format(CONF.vm_folder_path, name))
-                .mac(mac)
-            )
-    with ac.BatchExecutor() as be:
-        for name in (controller_vm_name, tester_vm_name):
-            be.submit(ac.PowerOnVm(si).vm_path(
-                "New Datacenter/vm/{}/{}".format(CONF.vm_folder_path, name)))
+def _submit_claim(si, node, engine, members, vms, be):
+    # The later actions look the VM up by its new path, rather than use
+    # the member, for a resumed run to find them.
+    path = _vm_path(node)
+    step = be.submit(functools.partial(_claim, si, node, engine, members),
+                     key='claim ' + path)
+    step = be.submit(functools.partial(_move_claimed, si, node), after=step,
+                     key='move ' + path)
+    be.submit(functools.partial(_power_on, si, node, vms), after=step,
+              key='power-on ' + path)
+
+
+def _submit_present(si, node, engine, members, vms, be):
+    if members:
+        _submit_claim(si, node, engine, members, vms, be)
+        return
+
+    # Each VM advances as soon as its own previous action is done. The VM
+    # does not exist before its clone finishes, hence the later actions
+    # get built only when it is their turn.
+    clone = _clone(si, node, engine,
+                   "New Datacenter/vm/{}".format(node.folder))
+    path = _vm_path(node)
+    step = be.submit(clone, key='clone ' + path)
+    if node.mac:
+        step = be.submit(functools.partial(_change_mac, si, node),
+                         after=step, key='change-mac ' + path)
+    be.submit(functools.partial(_power_on, si, node, vms), after=step,
+              key='power-on ' + path)
+
+
+def present_vms(si, nodes, journal=None):
+    """Clone, configure and power on the VMs of the topology.Node
+    iterable, consuming it only as the earlier VMs get done.
+
+    The VMs claim the members of the pool_folder, if set, as long as
+    there are any, and get cloned only then. With a journal.Journal, the
+    actions an earlier run did are skipped.
+
+    With wait_for_guests, returns the IP addresses of the guests by the
+    name of the VM, once all of them are ready.
+    """
+    names = []
+    vms = {}
+    members = None
+    if CONF.pool_folder:
+        folder = ac.inventory_index(si).find(_pool_folder_path())
+        if folder is None:
+            raise ac.NotFound(_pool_folder_path())
+        members = pool.members(si, folder)
+        LOG.info("Claiming from the %d VMs of the pool.", len(members))
+    engine = None
+    if CONF.clone_placement == 'spread':
+        engine = placement.Placement(si, ac.inventory_index(si).find(
+            'New Datacenter/host/{}'.format(CONF.vm_cluster_name)))
+    with _executor(si, journal) as be:
+        be.feed(functools.partial(_submit_present, si, node, engine,
+                                  members, vms)
+                for node in _noting(nodes, names))
+    if not CONF.wait_for_guests:
+        return None
+
+    # Only the VMs powered on by an earlier run, per the journal, are
+    # looked up again.
+    powered_on = set(vms.values())
+    index = ac.inventory_index(si)
+    vms.update((index.find(path), name) for name, path in names
+               if name not in powered_on)
+    ready = guest.wait_ready(si, vms, CONF.guest_timeout,
+                             lambda vm, addresses: LOG.info(
+                                 "The guest of %s is ready at %s.",
+                                 vms[vm], ', '.join(addresses)))
+    return dict((vms[vm], addresses) for vm, addresses in ready.items())
+
+
+def _noting(nodes, names):
+    for node in nodes:
+        names.append((node.name, _vm_path(node)))
+        yield node
+
+
+def absent_vms(si, nodes):
+    """Power off and destroy the VMs of the topology.Node iterable."""
+    index = ac.inventory_index(si)
+    vms = [index.find(_vm_path(node)) for node in nodes]
+    teardown.destroy(si, teardown.describe(si, [vm for vm in vms if vm]),
+                     _executor(si))
+
+
+def state_present(si, journal=None):
+    return present_vms(si, _vms(), journal)
 
 
 def state_absent(si):
-    controller_vm_name = "{}controller".format(CONF.deployment_prefix)
-    tester_vm_name = "{}tester".format(CONF.deployment_prefix)
-    with ac.BatchExecutor() as be:
-        for name in (controller_vm_name, tester_vm_name):
-            be.submit(ac.PowerOffVm(si).vm_path(
-                "New Datacenter/vm/{}/{}".format(CONF.vm_folder_path, name)))
-    with ac.BatchExecutor() as be:
-        for name in (controller_vm_name, tester_vm_name):
-            be.submit(ac.DestroyVM(si).path(
-                'New Datacenter/vm/{}/{}'.format(CONF.vm_folder_path, name),
-                False)
-            )
-
-
-def add_actions(subparsers):
-    subparsers.add_parser('present')
-    subparsers.add_parser('absent')
-
-
-def cli_main():
-    import logging
-    logging.basicConfig(level=logging.DEBUG)
-    CONF.register_cli_opt(cfg.SubCommandOpt('action', handler=add_actions))
-    CONF(project="vomit", prog="all-in-one")
+    absent_vms(si, _vms())
 
+
+def state_pool(si):
+    """Keep the pool_folder filled with pool_size clones of the template,
+    refilling it every pool_refill_interval seconds unless --once.
+    """
+    template_path = "New Datacenter/vm/{}".format(CONF.template_name)
+    while True:
+        pool.fill(si, _pool_folder_path(), template_path,
+                  _resource_pool_path(), CONF.pool_size, _executor(si),
+                  CONF.clone_mode)
+        if CONF.action.once:
+            return
+        time.sleep(CONF.pool_refill_interval)
+
+
+def _request_nodes(request):
+    """Return the topology.Node of the topology of the request to the
+    daemon, or those of the config without one.
+    """
+    if 'topology' not in request:
+        return _vms()
+    return topology.nodes(request['topology'],
+                          prefix=request.get('prefix',
+                                             CONF.deployment_prefix),
+                          folder=CONF.vm_folder_path,
+                          template=CONF.template_name)
+
+
+def state_serve(si):
+    """Serve present and absent of the topologies of the requests over
+    HTTP, see the daemon module.
+    """
+    server = daemon.Daemon(si, {
+        'present': lambda si, request: present_vms(
+            si, _request_nodes(request)),
+        'absent': lambda si, request: absent_vms(
+            si, _request_nodes(request)),
+    }, keepalive=CONF.keepalive_interval)
+    server.warm_up()
+    server.serve((CONF.action.host, CONF.action.port),
+                 CONF.action.unix_socket)
+
+
+def state_gc(si):
+    """Tear down the VMs the deployments left behind, by the name pattern
+    and the age given on the command line.
+    """
+    pattern = CONF.action.pattern
+    if not pattern:
+        if not CONF.deployment_prefix:
+            raise ValueError("The gc needs a --pattern or a "
+                             "deployment_prefix.")
+        pattern = '{}*'.format(CONF.deployment_prefix)
+    older_than = CONF.action.older_than
+    teardown.destroy(
+        si, teardown.scan(si, pattern,
+                          older_than * 3600 if older_than else None),
+        _executor(si))
+
+
+def _write_metrics(recorder, group):
+    if CONF.metrics_json:
+        recorder.write_json(CONF.metrics_json.format(vcenter=group))
+    if CONF.metrics_textfile:
+        recorder.write_textfile(CONF.metrics_textfile.format(vcenter=group))
+
+
+def _write_addresses(addresses, group):
+    if addresses is not None and CONF.guest_addresses_file:
+        with open(CONF.guest_addresses_file.format(vcenter=group),
+                  'w') as addresses_file:
+            json.dump(addresses, addresses_file, indent=2, sort_keys=True)
+
+
+def run_on(group):
+    """Run the action against the vCenter of the option group."""
+    vcenter = CONF[group]
     if CONF.workaround_pyvmomi_235:
         import ssl
         default_context = ssl._create_default_https_context
         ssl._create_default_https_context = ssl._create_unverified_context
 
     with ac.disconnecting(
-        connect.SmartConnect(host=CONF.vcenter.host,
-                             user=CONF.vcenter.user,
-                             pwd=CONF.vcenter.password)) as si:
+            session.connect_pool(host=vcenter.host,
+                                 user=vcenter.user,
+                                 pwd=vcenter.password,
+                                 size=vcenter.sessions,
+                                 cache_path=vcenter.session_cache),
+            logout=not vcenter.session_cache) as si:
         if CONF.workaround_pyvmomi_235:
             ssl._create_default_https_context = default_context
+        ac.task_monitor(si).timeout = vcenter.task_timeout
+        recorder = metrics.instrument(si, {'vcenter': vcenter.host})
 
         action = CONF.action.name
-        globals().get("state_" + action)(si)
+        run_journal = None
+        if action == 'present' and CONF.journal_file:
+            run_journal = journal.Journal(
+                CONF.journal_file.format(vcenter=group),
+                resume=CONF.action.resume)
+        try:
+            if action == 'present':
+                _write_addresses(state_present(si, run_journal), group)
+            else:
+                globals().get("state_" + action)(si)
+        finally:
+            if run_journal is not None:
+                run_journal.close()
+            _write_metrics(recorder, group)
+
 
+def main():
+    """Run the action of the parsed command line on the vCenters."""
+    if CONF.vcenters and CONF.action.name == 'serve':
+        raise ValueError("The serve action serves the vcenter section "
+                         "only, not the vcenters.")
+    if not CONF.vcenters:
+        run_on('vcenter')
+        return
 
-def list_opts():
-    return [
-        ['DEFAULT', opts],
-        ['vcenter', vcenter_opts]
-    ]
+    for group in CONF.vcenters:
+        CONF.register_opts(vcenter_opts, group=group)
+    if not fanout.log_report(fanout.run(run_on, CONF.vcenters)):
+        return 1
@@ -0,0 +1,185 @@
+#!/usr/bin/python
+
+# This module prepares the environment for testing OpenStack with VMWare
+# Copyright (C) 2015  Jaroslav Henner
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+"""The options and the command line of all-in-one.
+
+Parsing them, for the sample config or a --help, needs no pyVmomi, whose
+types take a while to load; the all_in_one module, which does, gets
+imported only once the command line has been parsed.
+"""
+
+import logging
+
+try:
+    from oslo.config import cfg
+except ImportError:
+    from oslo_config import cfg
+
+opts = [
+    cfg.StrOpt('controller_vm_mac',
+               help='Required without a topology_file.'),
+    cfg.StrOpt('controller_vm_memory'),
+    cfg.StrOpt('tester_vm_mac',
+               help='Required without a topology_file.'),
+    cfg.StrOpt('tester_vm_memory'),
+    cfg.StrOpt('vm_folder_path', default='khaleesi'),
+    cfg.StrOpt('vm_cluster_name', default='bar'),
+    cfg.StrOpt('template_name', default="rhel-guest-image"),
+    cfg.StrOpt('clone_mode', default='full',
+               choices=['full', 'linked'],
+               help='Copy the template disks, or create delta disks on top '
+                    'of its snapshot, which the template needs to have.'),
+    cfg.StrOpt('clone_placement', default='template',
+               choices=['template', 'spread'],
+               help='Clone onto the datastores of the template, or spread '
+                    'the clones over the datastores and hosts of the '
+                    'cluster by their load.'),
+    cfg.StrOpt('deployment_prefix', default=""),
+    cfg.StrOpt('topology_file',
+               help='A JSON or YAML file with the roles of the nodes to '
+                    'deploy instead of the controller and the tester.'),
+    cfg.StrOpt('pool_folder',
+               help='A folder of powered off clones of the template, kept '
+                    'full by the pool action, for present to claim instead '
+                    'of cloning. No pool if unset.'),
+    cfg.IntOpt('pool_size', default=10,
+               help='How many clones the pool action keeps in the pool.'),
+    cfg.IntOpt('pool_refill_interval', default=60,
+               help='Seconds between the refills of the pool action.'),
+    cfg.StrOpt('journal_file',
+               help='A file to journal the actions of present in, for '
+                    'present --resume to continue an interrupted run. A '
+                    '{vcenter} in it is replaced by the section of the '
+                    'vCenter.'),
+    cfg.BoolOpt('wait_for_guests', default=False,
+                help='Have present wait for the guests of the VMs to run '
+                     'the VMware Tools and get an IP address.'),
+    cfg.IntOpt('guest_timeout', default=600,
+               help='Seconds to wait for the guests to get ready.'),
+    cfg.StrOpt('guest_addresses_file',
+               help='A file to write the IP addresses of the guests to as '
+                    'JSON, by the name of the VM. A {vcenter} in it is '
+                    'replaced by the section of the vCenter.'),
+    cfg.IntOpt('keepalive_interval', default=600,
+               help='Seconds between the keepalives of the session of '
+                    'serve.'),
+    cfg.BoolOpt('retry_transient_faults', default=True,
+                help='Retry the actions failing with faults of an overloaded '
+                     'vCenter, like TaskInProgress or ResourceInUse, with '
+                     'an exponential backoff.'),
+    cfg.IntOpt('max_concurrent_actions',
+               help='How many actions can run at once, unlimited if unset.'),
+    cfg.IntOpt('max_actions_per_host', default=8,
+               help='How many actions can load one host at once.'),
+    cfg.IntOpt('max_actions_per_datastore', default=8,
+               help='How many actions can load one datastore at once.'),
+    cfg.IntOpt('max_actions_per_resource_pool',
+               help='How many actions can load one resource pool at once, '
+                    'unlimited if unset.'),
+    cfg.BoolOpt(
+        'workaround_pyvmomi_235',
+        default=False,
+        help='Workaround https://github.com/vmware/pyvmomi/issues/235'),
+]
+
+fanout_opts = [
+    cfg.ListOpt('vcenters', default=[],
+                help='Sections with the vcenter options of the vCenters to '
+                     'deploy to at once, the vcenter section if unset.'),
+]
+
+metrics_opts = [
+    cfg.StrOpt('metrics_json',
+               help='A file to write the SOAP calls of the run to as JSON. '
+                    'A {vcenter} in it is replaced by the section of the '
+                    'vCenter.'),
+    cfg.StrOpt('metrics_textfile',
+               help='A file to write the SOAP calls of the run to in the '
+                    'Prometheus text format. A {vcenter} in it is replaced '
+                    'by the section of the vCenter.'),
+]
+
+vcenter_opts = [
+    cfg.StrOpt('host', required=True,
+               help='The address of the vcenter.'),
+    cfg.StrOpt('user', default='root'),
+    cfg.StrOpt('password', required=True, secret=True),
+    cfg.IntOpt('task_timeout',
+               help='Seconds to wait for a vCenter task before failing, '
+                    'forever if unset.'),
+    cfg.StrOpt('session_cache',
+               help='A file to keep the session in between the runs, '
+                    'logging in and out on every run if unset.'),
+    cfg.IntOpt('sessions', default=1,
+               help='How many sessions to log in, for that many threads to '
+                    'start the actions at once over them.'),
+]
+
+
+CONF = cfg.ConfigOpts()
+CONF.register_opts(opts)
+CONF.register_opts(fanout_opts)
+CONF.register_opts(metrics_opts)
+CONF.register_opts(vcenter_opts, group="vcenter")
+
+
+def add_actions(subparsers):
+    present = subparsers.add_parser('present')
+    present.add_argument('--resume', action='store_true',
+                         help='Continue the run journaled in the '
+                              'journal_file instead of starting over.')
+    subparsers.add_parser('absent')
+    pool = subparsers.add_parser(
+        'pool', help='Keep the pool_folder filled with clones to claim.')
+    pool.add_argument('--once', action='store_true',
+                      help='Fill the pool once instead of refilling it '
+                           'every pool_refill_interval.')
+    serve = subparsers.add_parser(
+        'serve', help='Serve present and absent over HTTP from one session '
+                      'to the vcenter.')
+    serve.add_argument('--host', default='127.0.0.1',
+                       help='The address to listen on.')
+    serve.add_argument('--port', type=int, default=8080,
+                       help='The port to listen on.')
+    serve.add_argument('--unix-socket',
+                       help='A Unix socket to listen on instead of the port.')
+    gc = subparsers.add_parser(
+        'gc', help='Tear down the VMs left behind by the deployments.')
+    gc.add_argument('--pattern',
+                    help='The shell pattern of the names of the VMs, those '
+                         'starting with the deployment_prefix by default.')
+    gc.add_argument('--older-than', type=float, metavar='HOURS',
+                    help='Only the VMs created at least this long ago.')
+
+
+def cli_main():
+    logging.basicConfig(level=logging.DEBUG)
+    CONF.register_cli_opt(cfg.SubCommandOpt('action', handler=add_actions))
+    CONF(project="vomit", prog="all-in-one")
+
+    import all_in_one
+    return all_in_one.main()
+
+
+def list_opts():
+    return [
+        ['DEFAULT', opts + fanout_opts + metrics_opts],
+        ['vcenter', vcenter_opts]
+    ]
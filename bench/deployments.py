@@ -0,0 +1,197 @@
+# Copyright (C) 2015  Jaroslav Henner
+#
+# This file is part of pyvmomi ansible module.
+#
+# pyvmomi_ansible module is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+#
+# pyvmomi ansible module is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pyvmomi ansible more.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmarks of the deployments against the fake vCenter.
+
+    python -m bench.deployments --sizes 2,50,500 --latency 0.001
+
+With --sessions, all-in-one submits the actions over a session.PooledStub
+of that many sessions of the fake vCenter.
+
+Reports the wall time, the SOAP round trips and the peak of the memory
+traced by tracemalloc of present and absent of all-in-one, with full and
+linked clones, for each of the sizes of deployments, and of deployment.
+The fake vCenter runs in the same process, so the memory includes its
+inventory.
+"""
+
+import argparse
+import json
+import logging
+import os
+import tempfile
+import time
+import tracemalloc
+
+from pyVmomi import vim
+
+import all_in_one
+import deployment
+import pool
+import session
+import topology
+from bench.fakevc import FakeVCenter
+
+
+def _configure(conf, overrides):
+    for name, value in overrides.items():
+        group, _, name = name.rpartition('.')
+        conf.set_override(name, value, group=group or None)
+    conf(args=[], project='vomit', default_config_files=[])
+
+
+def _measure(results, scenario, size, vcenter, func):
+    calls = vcenter.call_count
+    tracemalloc.start()
+    start = time.time()
+    try:
+        func()
+    finally:
+        seconds = time.time() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    result = {'scenario': scenario, 'vms': size, 'seconds': seconds,
+              'soap_calls': vcenter.call_count - calls,
+              'peak_mib': peak / 2.0 ** 20}
+    results.append(result)
+    print("{scenario:<26} {vms:>5} {seconds:>9.2f} {soap_calls:>11} "
+          "{peak_mib:>9.1f}".format(**result))
+
+
+def all_in_one_vcenter(args):
+    vcenter = FakeVCenter(latency=args.latency, jitter=args.jitter)
+    vcenter.add_datacenter('New Datacenter', datastores=4)
+    vcenter.add_cluster('New Datacenter', 'bar', hosts=8)
+    vcenter.add_folder('New Datacenter/vm/khaleesi')
+    # vSphere cannot snapshot a template, the linked clones need it to have
+    # one already.
+    vcenter.add_vm('New Datacenter/vm', 'rhel-guest-image', template=True,
+                   snapshot='base')
+    return vcenter
+
+
+def deployment_vcenter(args):
+    vcenter = FakeVCenter(latency=args.latency, jitter=args.jitter)
+    vcenter.add_datacenter('New Datacenter')
+    vcenter.add_cluster('New Datacenter', 'foo', hosts=2)
+    vcenter.add_vm('New Datacenter/vm', 'rhel-guest-image-template2',
+                   template=True)
+    return vcenter
+
+
+def bench_all_in_one(args, results):
+    _configure(all_in_one.CONF, {
+        'controller_vm_mac': '52:54:00:00:00:01',
+        'tester_vm_mac': '52:54:00:00:00:02',
+        'clone_placement': args.placement,
+        'pool_folder': 'pool' if args.pool else None,
+        'vcenter.host': 'fake',
+        'vcenter.password': 'fake',
+    })
+    for size in args.sizes:
+        vcenter = all_in_one_vcenter(args)
+        si = vcenter.service_instance()
+        if args.sessions > 1:
+            si = vim.ServiceInstance("ServiceInstance", session.PooledStub(
+                [vcenter] * args.sessions))
+        vms = {'roles': [{'role': 'vm', 'count': size, 'memory': 1024,
+                          'mac_range': '52:54:00:00:00:00'}]}
+
+        def nodes():
+            return topology.nodes(vms, folder='khaleesi',
+                                  template='rhel-guest-image')
+        if args.pool:
+            vcenter.add_folder('New Datacenter/vm/pool')
+            _measure(results, 'all-in-one pool fill', size, vcenter,
+                     lambda: pool.fill(
+                         si, 'New Datacenter/vm/pool',
+                         'New Datacenter/vm/rhel-guest-image',
+                         'New Datacenter/host/bar/Resources', size,
+                         all_in_one._executor(si)))
+        _measure(results, 'all-in-one present', size, vcenter,
+                 lambda: all_in_one.present_vms(si, nodes()))
+        _measure(results, 'all-in-one absent', size, vcenter,
+                 lambda: all_in_one.absent_vms(si, nodes()))
+        all_in_one.CONF.set_override('clone_mode', 'linked')
+        try:
+            _measure(results, 'all-in-one present linked', size, vcenter,
+                     lambda: all_in_one.present_vms(si, nodes()))
+            _measure(results, 'all-in-one absent linked', size, vcenter,
+                     lambda: all_in_one.absent_vms(si, nodes()))
+        finally:
+            all_in_one.CONF.clear_override('clone_mode')
+
+
+def bench_deployment(args, results):
+    # The fake host cannot be handshaken with, so it is known already.
+    fd, store_path = tempfile.mkstemp(suffix='.json')
+    with os.fdopen(fd, 'w') as store_file:
+        json.dump({'esx.example.com': ':'.join(['AB'] * 20)}, store_file)
+    _configure(deployment.CONF, {
+        'thumbprint_store': store_path,
+        'esxi_host_address': 'esx.example.com',
+        'esxi_host_username': 'root',
+        'esxi_host_password': 'fake',
+        'vcenter.host': 'fake',
+        'vcenter.password': 'fake',
+    })
+    vcenter = deployment_vcenter(args)
+    si = vcenter.service_instance()
+    _measure(results, 'deployment present', 2, vcenter,
+             lambda: deployment.state_present(si))
+    _measure(results, 'deployment present again', 2, vcenter,
+             lambda: deployment.state_present(si))
+    _measure(results, 'deployment absent', 2, vcenter,
+             lambda: deployment.state_absent(si))
+    os.remove(store_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', default='2,50,500',
+                        type=lambda sizes: [int(size) for size
+                                            in sizes.split(',')],
+                        help='The numbers of VMs of all-in-one.')
+    parser.add_argument('--latency', type=float, default=0.001,
+                        help='The seconds every SOAP call takes.')
+    parser.add_argument('--jitter', type=float, default=0.5,
+                        help='How much the task durations vary, as a '
+                             'fraction of them.')
+    parser.add_argument('--placement', default='template',
+                        choices=['template', 'spread'],
+                        help='The clone_placement of all-in-one.')
+    parser.add_argument('--pool', action='store_true',
+                        help='Fill a pool of clones for all-in-one present '
+                             'to claim first.')
+    parser.add_argument('--sessions', type=int, default=1,
+                        help='The sessions of all-in-one to submit the '
+                             'actions over at once.')
+    parser.add_argument('--json', help='A file to write the results to.')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    print("{:<26} {:>5} {:>9} {:>11} {:>9}".format(
+        'scenario', 'vms', 'seconds', 'soap_calls', 'peak_mib'))
+    results = []
+    bench_all_in_one(args, results)
+    bench_deployment(args, results)
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(results, json_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
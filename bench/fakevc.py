@@ -0,0 +1,845 @@
+# Copyright (C) 2015  Jaroslav Henner
+#
+# This file is part of pyvmomi ansible module.
+#
+# pyvmomi_ansible module is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+#
+# pyvmomi ansible module is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pyvmomi ansible more.  If not, see <http://www.gnu.org/licenses/>.
+
+"""An in-process stand-in of a vCenter.
+
+FakeVCenter plays the stub adapter of the pyVmomi managed objects, so the
+actions run unchanged against it:
+
+    vc = FakeVCenter(latency=0.001)
+    vc.add_datacenter('New Datacenter')
+    vc.add_cluster('New Datacenter', 'bar', hosts=4)
+    vc.add_vm('New Datacenter/vm', 'rhel-guest-image')
+    si = vc.service_instance()
+
+Every method call and property read counts as one SOAP round trip, sleeps
+the latency and is counted in `calls`. The tasks finish after the duration
+configured for their method, and only the parts of the API the actions use
+are there.
+"""
+
+import collections
+import copy
+import datetime
+import heapq
+import itertools
+import random
+import threading
+import time
+
+from pyVmomi import vim
+from pyVmomi import vmodl
+from pyVmomi.Iso8601 import TZManager
+
+
+# The default task durations in seconds, by the WSDL name of the method.
+TASK_DURATIONS = {
+    'CloneVM_Task': 0.2,
+    'LinkedClone': 0.02,
+    'InstantClone_Task': 0.01,
+    'CreateVM_Task': 0.05,
+    'PowerOnVM_Task': 0.02,
+    'PowerOffVM_Task': 0.02,
+    'ReconfigVM_Task': 0.02,
+    'Destroy_Task': 0.02,
+    'AddHost_Task': 0.1,
+}
+
+DEFAULT_TASK_DURATION = 0.02
+# What the VMs without disks of their own take on their datastore.
+VM_BYTES = 10 * 2 ** 30
+
+_PC = vmodl.query.PropertyCollector
+
+utc = TZManager.GetTZInfo()
+
+
+class _Entity(object):
+    def __init__(self, mo, props):
+        self.mo = mo
+        self.props = props
+        self.version = 0
+
+
+class _Filter(object):
+    def __init__(self, mo, spec):
+        self.mo = mo
+        self.spec = spec
+        # The versions of the objects last reported to the client.
+        self.reported = {}
+
+
+class FakeVCenter(object):
+    """The inventory, tasks and property collectors of a fake vCenter.
+
+    The durations of the tasks vary randomly by `jitter`, a fraction of
+    their duration, to mimic datastores and hosts of uneven speed. The
+    `busy_rates` map the task names to the fraction of them failing with
+    a TaskInProgress, as on an overloaded vCenter.
+    """
+
+    def __init__(self, latency=0.0, task_durations=None, jitter=0.0,
+                 guest_boot_seconds=0.05, seed=0, busy_rates=None):
+        self.latency = latency
+        self.task_durations = dict(TASK_DURATIONS, **(task_durations or {}))
+        self.busy_rates = busy_rates or {}
+        self.jitter = jitter
+        self.guest_boot_seconds = guest_boot_seconds
+        self.calls = collections.Counter()
+        self._random = random.Random(seed)
+        self._lock = threading.RLock()
+        self._changed = threading.Condition(self._lock)
+        self._entities = {}
+        self._filters = {}
+        self._events = []
+        self._ids = itertools.count(1)
+        self._versions = itertools.count(1)
+
+        with self._lock:
+            self.root = self._create(vim.Folder, 'group-d1',
+                                     name='Datacenters', parent=None,
+                                     childEntity=[])
+            self.content = vim.ServiceInstanceContent(
+                rootFolder=self.root.mo,
+                propertyCollector=self._create(
+                    _PC, 'propertyCollector', filters=[]).mo,
+                viewManager=self._create(vim.view.ViewManager,
+                                         'ViewManager').mo,
+                searchIndex=self._create(vim.SearchIndex, 'SearchIndex').mo,
+                sessionManager=self._create(
+                    vim.SessionManager, 'SessionManager',
+                    currentSession=vim.UserSession(key='session',
+                                                   userName='root')).mo,
+                taskManager=self._create(vim.TaskManager, 'TaskManager',
+                                         recentTask=[]).mo)
+            self._create(vim.ServiceInstance, 'ServiceInstance',
+                         content=self.content)
+
+    def service_instance(self):
+        return vim.ServiceInstance('ServiceInstance', self)
+
+    @property
+    def call_count(self):
+        return sum(self.calls.values())
+
+    # Building the inventory.
+
+    def find(self, path):
+        """Return the entity at the inventory path, or None."""
+        entity = self.root
+        for name in [name for name in path.split('/') if name]:
+            entity = next((self._entities[child._moId]
+                           for child in self._children(entity)
+                           if self._entities[child._moId].props['name'] ==
+                           name), None)
+            if entity is None:
+                return None
+        return entity
+
+    def add_datacenter(self, name, datastores=1):
+        with self._lock:
+            dc = self._create(vim.Datacenter, name=name, parent=self.root.mo)
+            for folder, child in (('vmFolder', 'vm'), ('hostFolder', 'host'),
+                                  ('networkFolder', 'network'),
+                                  ('datastoreFolder', 'datastore')):
+                dc.props[folder] = self._create(
+                    vim.Folder, name=child, parent=dc.mo, childEntity=[]).mo
+            self._add_child(self.root, dc)
+            for number in range(1, datastores + 1):
+                self.add_datastore(name, 'datastore{}'.format(number))
+            return dc
+
+    def add_datastore(self, datacenter, name, capacity=2 ** 40):
+        with self._lock:
+            folder = self.find(datacenter + '/datastore')
+            datastore = self._create(
+                vim.Datastore, name=name, parent=folder.mo,
+                summary=vim.Datastore.Summary(
+                    name=name, capacity=capacity, freeSpace=capacity,
+                    uncommitted=0, accessible=True, type='VMFS'))
+            self._add_child(folder, datastore)
+            return datastore
+
+    def add_folder(self, path):
+        with self._lock:
+            parent_path, _, name = path.rstrip('/').rpartition('/')
+            parent = self.find(parent_path)
+            folder = self._create(vim.Folder, name=name, parent=parent.mo,
+                                  childEntity=[])
+            self._add_child(parent, folder)
+            return folder
+
+    def add_cluster(self, datacenter, name, hosts=1):
+        with self._lock:
+            folder = self.find(datacenter + '/host')
+            cluster = self._create_cluster(folder, name)
+            for number in range(1, hosts + 1):
+                self._create_host(cluster, '{}-esx{}'.format(name, number))
+            return cluster
+
+    def add_vm(self, folder_path, name, cluster_path=None, memory_mb=512,
+               mac=None, powered_on=False, template=False, snapshot=None):
+        with self._lock:
+            folder = self.find(folder_path)
+            cluster = self.find(cluster_path) if cluster_path else next(
+                entity for entity in self._entities.values()
+                if isinstance(entity.mo, vim.ClusterComputeResource))
+            nic = vim.vm.device.VirtualVmxnet3(
+                key=4000, addressType='generated',
+                macAddress=mac or self._mac())
+            config = vim.vm.ConfigSpec(
+                name=name, memoryMB=memory_mb,
+                deviceChange=[vim.vm.device.VirtualDeviceSpec(
+                    operation='add', device=nic)])
+            vm = self._create_vm(folder, config, cluster.props['resourcePool'],
+                                 template=template)
+            if powered_on:
+                vm.props['runtime'].powerState = 'poweredOn'
+            if snapshot:
+                self._snapshot(vm, snapshot, '')
+            return vm
+
+    # The pyVmomi stub adapter interface.
+
+    def InvokeMethod(self, mo, info, args, outerStub=None):
+        # Like the SOAP stub adapter, with an outer stub, like the
+        # session.PooledStub, return the status and the result or the fault
+        # instead of raising it, and bind the result to the outer stub.
+        if outerStub is None:
+            return self._invoke(mo, info, args, self)
+        try:
+            return 200, self._invoke(mo, info, args, outerStub)
+        except vmodl.MethodFault as fault:
+            return 500, fault
+
+    def _invoke(self, mo, info, args, stub):
+        if info.wsdlName == 'Fetch':
+            return self._fetch(mo, args[0], stub)
+        self._round_trip(info.wsdlName)
+        with self._lock:
+            self._run_due_events()
+            handler = getattr(self, '_' + info.wsdlName, None)
+            if handler is None:
+                raise vmodl.fault.NotSupported(
+                    msg='The fake vCenter has no {}.'.format(info.wsdlName))
+            entity = self._entities.get(mo._moId)
+            if entity is None:
+                raise vmodl.fault.ManagedObjectNotFound(obj=mo)
+            return self._copy(handler(entity, *args), stub)
+
+    def InvokeAccessor(self, mo, info):
+        return self._fetch(mo, info.name, self)
+
+    def _fetch(self, mo, name, stub):
+        self._round_trip('{}.{}'.format(type(mo).__name__.split('.')[-1],
+                                        name))
+        with self._lock:
+            self._run_due_events()
+            entity = self._entities.get(mo._moId)
+            if entity is None:
+                raise vmodl.fault.ManagedObjectNotFound(obj=mo)
+            return self._copy(entity.props.get(name), stub)
+
+    def _round_trip(self, name):
+        with self._lock:
+            self.calls[name] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _copy(self, value, stub=None):
+        # Like over the wire, the client gets its own copies of the data.
+        return copy.deepcopy(value, {id(self): stub or self})
+
+    # Entities.
+
+    def _create(self, type_, moid=None, **props):
+        if moid is None:
+            moid = '{}-{}'.format(type_.__name__.split('.')[-1].lower(),
+                                  next(self._ids))
+        entity = _Entity(type_(moid, self), props)
+        self._entities[moid] = entity
+        self._touch(entity)
+        return entity
+
+    def _touch(self, entity):
+        entity.version = next(self._versions)
+        self._changed.notify_all()
+
+    def _add_child(self, parent, child):
+        parent.props['childEntity'].append(child.mo)
+        self._touch(parent)
+
+    def _children(self, entity):
+        props = entity.props
+        if isinstance(entity.mo, vim.Datacenter):
+            return [props['vmFolder'], props['hostFolder'],
+                    props['networkFolder'], props['datastoreFolder']]
+        if isinstance(entity.mo, vim.ComputeResource):
+            return props['host'] + [props['resourcePool']]
+        return props.get('childEntity', [])
+
+    def _descendants(self, entity):
+        for child in self._children(entity):
+            child = self._entities[child._moId]
+            yield child
+            for descendant in self._descendants(child):
+                yield descendant
+
+    def _remove(self, entity):
+        for child in list(self._children(entity)):
+            self._remove(self._entities[child._moId])
+        parent = self._entities.get(entity.props['parent']._moId)
+        if parent and entity.mo in parent.props.get('childEntity', []):
+            parent.props['childEntity'].remove(entity.mo)
+            self._touch(parent)
+        if parent and entity.mo in parent.props.get('host', []):
+            parent.props['host'].remove(entity.mo)
+            self._touch(parent)
+        del self._entities[entity.mo._moId]
+        self._changed.notify_all()
+
+    def _mac(self):
+        number = next(self._ids)
+        return '00:50:56:{:02x}:{:02x}:{:02x}'.format(
+            number >> 16 & 0xff, number >> 8 & 0xff, number & 0xff)
+
+    def _check_name(self, folder, name, type_=vim.ManagedEntity):
+        # A DVS and a port group, a network, can share the name.
+        for child in self._children(folder):
+            if isinstance(child, type_) and \
+                    self._entities[child._moId].props['name'] == name:
+                raise vim.fault.DuplicateName(name=name, object=child)
+
+    def _create_cluster(self, folder, name):
+        self._check_name(folder, name)
+        cluster = self._create(vim.ClusterComputeResource, name=name,
+                               parent=folder.mo, host=[], datastore=[])
+        cluster.props['resourcePool'] = self._create(
+            vim.ResourcePool, name='Resources', parent=cluster.mo,
+            owner=cluster.mo).mo
+        self._add_child(folder, cluster)
+        return cluster
+
+    def _create_host(self, cluster, name):
+        datacenter = self._datacenter_of(cluster)
+        datastores = list(self._entities[
+            datacenter.props['datastoreFolder']._moId].props['childEntity'])
+        host = self._create(
+            vim.HostSystem, name=name, parent=cluster.mo,
+            datastore=datastores,
+            runtime=vim.host.RuntimeInfo(connectionState='connected',
+                                         powerState='poweredOn'),
+            summary=vim.host.Summary(
+                hardware=vim.host.Summary.HardwareSummary(
+                    cpuMhz=2000, numCpuCores=16, memorySize=2 ** 37),
+                quickStats=vim.host.Summary.QuickStats(
+                    overallCpuUsage=0, overallMemoryUsage=0)))
+        cluster.props['host'].append(host.mo)
+        cluster.props['datastore'] = datastores
+        self._touch(cluster)
+        return host
+
+    def _datacenter_of(self, entity):
+        while not isinstance(entity.mo, vim.Datacenter):
+            entity = self._entities[entity.props['parent']._moId]
+        return entity
+
+    def _create_vm(self, folder, config, pool, template=False, source=None,
+                   datastore=None, host=None):
+        self._check_name(folder, config.name)
+        pool = self._entities[pool._moId]
+        cluster = self._entities[pool.props['owner']._moId]
+        devices = []
+        if source is not None:
+            devices = copy.deepcopy(
+                source.props['config'].hardware.device, {id(self): self})
+        for change in config.deviceChange or []:
+            device = copy.deepcopy(change.device, {id(self): self})
+            devices = [existing for existing in devices
+                       if existing.key != device.key or change.operation
+                       not in ('edit', 'remove')]
+            if change.operation != 'remove':
+                devices.append(device)
+        for device in devices:
+            if isinstance(device, vim.vm.device.VirtualEthernetCard) and \
+                    not device.macAddress:
+                device.macAddress = self._mac()
+        memory_mb = config.memoryMB or (
+            source.props['config'].hardware.memoryMB if source else 512)
+        datastore = datastore or (source.props['datastore'][0] if source
+                                  else cluster.props['datastore'][0])
+        committed = sum(device.capacityInKB * 1024 for device in devices
+                        if isinstance(device, vim.vm.device.VirtualDisk))
+        if not committed:
+            committed = (source.props['summary'].storage.committed
+                         if source else VM_BYTES)
+        vm = self._create(
+            vim.VirtualMachine, name=config.name, parent=folder.mo,
+            resourcePool=pool.mo, datastore=[datastore],
+            snapshot=None,
+            config=vim.vm.ConfigInfo(
+                name=config.name, template=template,
+                changeVersion=str(next(self._versions)),
+                createDate=datetime.datetime.now(utc),
+                hardware=vim.vm.VirtualHardware(memoryMB=memory_mb,
+                                                device=devices)),
+            runtime=vim.vm.RuntimeInfo(
+                powerState='poweredOff',
+                host=host or cluster.props['host'][0]),
+            guest=vim.vm.GuestInfo(toolsRunningStatus='guestToolsNotRunning',
+                                   net=[]),
+            summary=vim.vm.Summary(
+                config=vim.vm.Summary.ConfigSummary(
+                    name=config.name, template=template,
+                    memorySizeMB=memory_mb),
+                storage=vim.vm.Summary.StorageSummary(
+                    committed=committed, uncommitted=0, unshared=committed)))
+        self._add_child(folder, vm)
+        return vm
+
+    # Tasks.
+
+    def _schedule(self, delay, event):
+        heapq.heappush(self._events,
+                       (time.time() + delay, next(self._ids), event))
+        self._changed.notify_all()
+
+    def _run_due_events(self):
+        while self._events and self._events[0][0] <= time.time():
+            _, _, event = heapq.heappop(self._events)
+            event()
+
+    def _task(self, entity, name, work, duration_key=None):
+        """Start a task on the entity, calling work at its end for the
+        result, or for the fault it raises.
+        """
+        task = self._create(vim.Task)
+        self._entities['TaskManager'].props['recentTask'].append(task.mo)
+        task.props['info'] = vim.TaskInfo(
+            key=task.mo._moId, task=task.mo, descriptionId=name,
+            entity=entity.mo, state='running', progress=0,
+            cancelable=False, cancelled=False)
+        if entity.props.get('name'):
+            task.props['info'].entityName = entity.props['name']
+        duration = self.task_durations.get(duration_key or name,
+                                           DEFAULT_TASK_DURATION)
+        duration *= 1 + self.jitter * (2 * self._random.random() - 1)
+
+        def progress():
+            if task.props['info'].state == 'running':
+                task.props['info'].progress = 50
+                self._touch(task)
+
+        busy = self._random.random() < self.busy_rates.get(name, 0)
+
+        def finish():
+            info = task.props['info']
+            try:
+                if busy:
+                    raise vim.fault.TaskInProgress(task=task.mo)
+                result = work()
+            except vmodl.MethodFault as fault:
+                info.state, info.error = 'error', fault
+            else:
+                info.state, info.result, info.progress = (
+                    'success', result, 100)
+            self._touch(task)
+
+        self._schedule(duration / 2, progress)
+        self._schedule(duration, finish)
+        return task.mo
+
+    # The methods, by their WSDL names.
+
+    def _RetrieveServiceContent(self, si):
+        return self.content
+
+    def _Logout(self, session_manager):
+        pass
+
+    def _CurrentTime(self, si):
+        return datetime.datetime.now(utc)
+
+    def _FindByInventoryPath(self, search_index, path):
+        entity = self.find(path)
+        return entity.mo if entity else None
+
+    def _CreateContainerView(self, view_manager, container, types, recursive):
+        return self._create(vim.view.ContainerView, container=container,
+                            type=types, recursive=recursive).mo
+
+    def _CreateListView(self, view_manager, objects):
+        return self._create(vim.view.ListView, view=list(objects or [])).mo
+
+    def _ModifyListView(self, view, add=None, remove=None):
+        view.props['view'] = [obj for obj in view.props['view'] + list(
+            add or []) if obj not in (remove or [])]
+        self._touch(view)
+        return []
+
+    def _DestroyView(self, view):
+        del self._entities[view.mo._moId]
+
+    def _CreatePropertyCollector(self, collector):
+        return self._create(_PC, filters=[]).mo
+
+    def _DestroyPropertyCollector(self, collector):
+        for filter_mo in collector.props['filters']:
+            self._filters.pop(filter_mo._moId, None)
+        del self._entities[collector.mo._moId]
+
+    def _CreateFilter(self, collector, spec, partial_updates):
+        filter_ = self._create(_PC.Filter, collector=collector.mo)
+        self._filters[filter_.mo._moId] = _Filter(filter_.mo, spec)
+        collector.props['filters'].append(filter_.mo)
+        return filter_.mo
+
+    def _DestroyPropertyFilter(self, filter_):
+        self._filters.pop(filter_.mo._moId, None)
+        collector = self._entities[filter_.props['collector']._moId]
+        collector.props['filters'].remove(filter_.mo)
+        del self._entities[filter_.mo._moId]
+
+    def _RetrieveProperties(self, collector, spec_set):
+        contents = []
+        for spec in spec_set:
+            for entity in self._selected(spec):
+                if not any(isinstance(entity.mo, prop_spec.type)
+                           for prop_spec in spec.propSet):
+                    continue
+                contents.append(_PC.ObjectContent(
+                    obj=entity.mo,
+                    propSet=[vmodl.DynamicProperty(name=path, val=value)
+                             for path, value
+                             in self._properties(entity, spec)]))
+        return contents
+
+    def _WaitForUpdatesEx(self, collector, version, options):
+        max_wait = options.maxWaitSeconds if options else None
+        deadline = None if max_wait is None else time.time() + max_wait
+        while True:
+            update = self._updates(collector)
+            if update.filterSet or (
+                    deadline is not None and time.time() >= deadline):
+                break
+            timeouts = [deadline] if deadline is not None else []
+            if self._events:
+                timeouts.append(self._events[0][0])
+            self._changed.wait(
+                max(0, min(timeouts) - time.time()) if timeouts else None)
+            self._run_due_events()
+        return update if update.filterSet else None
+
+    def _CloneVM_Task(self, vm, folder, name, spec):
+        folder = self._entities[folder._moId]
+        location = spec.location
+        linked = location.diskMoveType == 'createNewChildDiskBacking'
+        if linked and not spec.snapshot:
+            raise vmodl.fault.InvalidArgument(invalidProperty='snapshot')
+        config = copy.deepcopy(spec.config or vim.vm.ConfigSpec(),
+                               {id(self): self})
+        config.name = name
+        return self._task(
+            vm, 'CloneVM_Task',
+            lambda: self._create_vm(
+                folder, config, location.pool or vm.props['resourcePool'],
+                template=bool(spec.template), source=vm,
+                datastore=location.datastore, host=location.host).mo,
+            'LinkedClone' if linked else None)
+
+    def _InstantClone_Task(self, vm, spec):
+        location = spec.location
+        config = vim.vm.ConfigSpec(name=spec.name,
+                                   deviceChange=location.deviceChange)
+
+        def work():
+            clone = self._create_vm(
+                self._entities[location.folder._moId], config,
+                location.pool or vm.props['resourcePool'], source=vm,
+                datastore=location.datastore, host=location.host)
+            clone.props['runtime'].powerState = 'poweredOn'
+            return clone.mo
+        return self._task(vm, 'InstantClone_Task', work)
+
+    def _CreateVM_Task(self, folder, config, pool, host=None):
+        return self._task(folder, 'CreateVM_Task',
+                          lambda: self._create_vm(folder, config, pool,
+                                                  host=host).mo)
+
+    def _snapshot(self, vm, name, description):
+        snapshot = self._create(vim.vm.Snapshot, vm=vm.mo)
+        tree = vim.vm.SnapshotTree(name=name, description=description,
+                                   snapshot=snapshot.mo, vm=vm.mo,
+                                   childSnapshotList=[])
+        if vm.props['snapshot'] is None:
+            vm.props['snapshot'] = vim.vm.SnapshotInfo(rootSnapshotList=[tree])
+        else:
+            vm.props['snapshot'].rootSnapshotList.append(tree)
+        vm.props['snapshot'].currentSnapshot = snapshot.mo
+        self._touch(vm)
+        return snapshot
+
+    def _CreateSnapshot_Task(self, vm, name, description, memory, quiesce):
+        def work():
+            # Like vSphere, which snapshots the VMs only.
+            if vm.props['config'].template:
+                raise vmodl.fault.NotSupported()
+            return self._snapshot(vm, name, description).mo
+        return self._task(vm, 'CreateSnapshot_Task', work)
+
+    def _power(self, vm, state):
+        runtime = vm.props['runtime']
+        if runtime.powerState == state:
+            raise vim.fault.InvalidPowerState(
+                requestedState=state, existingState=runtime.powerState)
+        runtime.powerState = state
+        guest = vm.props['guest']
+        guest.toolsRunningStatus = 'guestToolsNotRunning'
+        guest.ipAddress, guest.net = None, []
+        self._touch(vm)
+        if state == 'poweredOn':
+            self._schedule(self.guest_boot_seconds,
+                           lambda: self._boot_guest(vm))
+
+    def _boot_guest(self, vm):
+        if vm.mo._moId not in self._entities or \
+                vm.props['runtime'].powerState != 'poweredOn':
+            return
+        number = next(self._ids)
+        address = '10.{}.{}.{}'.format(number >> 16 & 0xff,
+                                       number >> 8 & 0xff, number & 0xff)
+        guest = vm.props['guest']
+        guest.toolsRunningStatus = 'guestToolsRunning'
+        guest.ipAddress = address
+        guest.net = [vim.vm.GuestInfo.NicInfo(
+            connected=True, ipAddress=[address],
+            macAddress=device.macAddress)
+            for device in vm.props['config'].hardware.device
+            if isinstance(device, vim.vm.device.VirtualEthernetCard)]
+        self._touch(vm)
+
+    def _PowerOnVM_Task(self, vm, host=None):
+        return self._task(vm, 'PowerOnVM_Task',
+                          lambda: self._power(vm, 'poweredOn'))
+
+    def _PowerOffVM_Task(self, vm):
+        return self._task(vm, 'PowerOffVM_Task',
+                          lambda: self._power(vm, 'poweredOff'))
+
+    def _ReconfigVM_Task(self, vm, spec):
+        def work():
+            if spec.changeVersion and \
+                    spec.changeVersion != vm.props['config'].changeVersion:
+                raise vim.fault.ConcurrentAccess()
+            if spec.name and spec.name != vm.props['name']:
+                self._check_name(self._entities[vm.props['parent']._moId],
+                                 spec.name)
+                vm.props['name'] = vm.props['config'].name = spec.name
+            hardware = vm.props['config'].hardware
+            if spec.memoryMB:
+                hardware.memoryMB = spec.memoryMB
+            for change in spec.deviceChange or []:
+                device = copy.deepcopy(change.device, {id(self): self})
+                hardware.device = [
+                    existing for existing in hardware.device
+                    if existing.key != device.key] + (
+                    [device] if change.operation != 'remove' else [])
+            vm.props['config'].changeVersion = str(next(self._versions))
+            self._touch(vm)
+        return self._task(vm, 'ReconfigVM_Task', work)
+
+    def _Rename_Task(self, entity, new_name):
+        def work():
+            parent = self._entities[entity.props['parent']._moId]
+            self._check_name(parent, new_name)
+            entity.props['name'] = new_name
+            if 'config' in entity.props:
+                entity.props['config'].name = new_name
+            self._touch(entity)
+        return self._task(entity, 'Rename_Task', work)
+
+    def _MoveIntoFolder_Task(self, folder, objects):
+        def work():
+            for obj in objects:
+                entity = self._entities[obj._moId]
+                self._check_name(folder, entity.props['name'])
+                parent = self._entities[entity.props['parent']._moId]
+                parent.props['childEntity'].remove(entity.mo)
+                self._touch(parent)
+                entity.props['parent'] = folder.mo
+                self._add_child(folder, entity)
+                self._touch(entity)
+        return self._task(folder, 'MoveIntoFolder_Task', work)
+
+    def _Destroy_Task(self, entity):
+        def work():
+            if isinstance(entity.mo, vim.VirtualMachine) and \
+                    entity.props['runtime'].powerState == 'poweredOn':
+                raise vim.fault.InvalidPowerState(
+                    requestedState='poweredOff', existingState='poweredOn')
+            # A switch takes its port groups with it.
+            for portgroup in entity.props.get('portgroup', []):
+                self._remove(self._entities[portgroup._moId])
+            self._remove(entity)
+        return self._task(entity, 'Destroy_Task', work)
+
+    def _CreateClusterEx(self, folder, name, spec):
+        return self._create_cluster(folder, name).mo
+
+    _CreateCluster = _CreateClusterEx
+
+    def _AddHost_Task(self, cluster, spec, as_connected, resource_pool=None,
+                      license=None):
+        def work():
+            if not spec.sslThumbprint:
+                raise vim.fault.SSLVerifyFault(
+                    selfSigned=True, thumbprint=':'.join(
+                        ['AB'] * 20))
+            if spec.hostName in [self._entities[host._moId].props['name']
+                                 for host in cluster.props['host']]:
+                raise vim.fault.DuplicateName(name=spec.hostName)
+            return self._create_host(cluster, spec.hostName).mo
+        return self._task(cluster, 'AddHost_Task', work)
+
+    def _DisconnectHost_Task(self, host):
+        def work():
+            host.props['runtime'].connectionState = 'disconnected'
+            self._touch(host)
+        return self._task(host, 'DisconnectHost_Task', work)
+
+    def _CreateDVS_Task(self, folder, spec):
+        def work():
+            name = spec.configSpec.name
+            self._check_name(folder, name, vim.DistributedVirtualSwitch)
+            switch = self._create(vim.dvs.VmwareDistributedVirtualSwitch,
+                                  name=name, parent=folder.mo, portgroup=[])
+            self._add_child(folder, switch)
+            return switch.mo
+        return self._task(folder, 'CreateDVS_Task', work)
+
+    def _CreateDVPortgroup_Task(self, switch, spec):
+        def work():
+            folder = self._entities[switch.props['parent']._moId]
+            self._check_name(folder, spec.name, vim.Network)
+            portgroup = self._create(
+                vim.dvs.DistributedVirtualPortgroup, name=spec.name,
+                parent=folder.mo,
+                config=vim.dvs.DistributedVirtualPortgroup.ConfigInfo(
+                    name=spec.name, configVersion='1',
+                    distributedVirtualSwitch=switch.mo,
+                    defaultPortConfig=spec.defaultPortConfig))
+            switch.props['portgroup'].append(portgroup.mo)
+            self._add_child(folder, portgroup)
+        return self._task(switch, 'CreateDVPortgroup_Task', work)
+
+    def _ReconfigureDVPortgroup_Task(self, portgroup, spec):
+        def work():
+            config = portgroup.props['config']
+            if spec.configVersion != config.configVersion:
+                raise vim.fault.ConcurrentAccess()
+            if spec.defaultPortConfig:
+                config.defaultPortConfig = spec.defaultPortConfig
+            config.configVersion = str(int(config.configVersion) + 1)
+            self._touch(portgroup)
+        return self._task(portgroup, 'ReconfigureDVPortgroup_Task', work)
+
+    # The property collector.
+
+    def _selected(self, spec):
+        """Return the entities the object specs of the filter spec select,
+        following a single level of traversals.
+        """
+        selected = collections.OrderedDict()
+        for object_spec in spec.objectSet:
+            entity = self._entities.get(object_spec.obj._moId)
+            if entity is None:
+                continue
+            if not object_spec.skip:
+                selected[entity.mo._moId] = entity
+            for traversal in object_spec.selectSet or []:
+                if traversal.path == 'view':
+                    members = self._view(entity)
+                elif isinstance(entity.mo, traversal.type):
+                    members = [self._entities[obj._moId] for obj
+                               in entity.props.get(traversal.path) or []]
+                else:
+                    members = []
+                for member in members:
+                    selected[member.mo._moId] = member
+        return list(selected.values())
+
+    def _view(self, view):
+        if isinstance(view.mo, vim.view.ListView):
+            return [self._entities[obj._moId] for obj in view.props['view']
+                    if obj._moId in self._entities]
+        container = self._entities[view.props['container']._moId]
+        members = (self._descendants(container) if view.props['recursive']
+                   else [self._entities[child._moId]
+                         for child in self._children(container)])
+        return [member for member in members
+                if isinstance(member.mo, tuple(view.props['type']))]
+
+    def _properties(self, entity, spec):
+        for prop_spec in spec.propSet:
+            if not isinstance(entity.mo, prop_spec.type):
+                continue
+            paths = (sorted(entity.props) if prop_spec.all
+                     else prop_spec.pathSet)
+            for path in paths:
+                value = self._value(entity, path)
+                if value is not None:
+                    yield path, value
+
+    def _value(self, entity, path):
+        name, _, rest = path.partition('.')
+        value = entity.props.get(name)
+        parent, attribute = entity.mo, name
+        for attribute in rest.split('.') if rest else []:
+            if value is None:
+                return None
+            parent, value = value, getattr(value, attribute, None)
+        if type(value) is list:
+            # The properties and the data objects keep the lists as they
+            # are, while a DynamicProperty wants them typed.
+            value = parent._GetPropertyInfo(attribute).type(value)
+        return value
+
+    def _updates(self, collector):
+        filter_updates = []
+        for filter_mo in collector.props['filters']:
+            filter_ = self._filters[filter_mo._moId]
+            selected = self._selected(filter_.spec)
+            object_updates = []
+            for entity in selected:
+                reported = filter_.reported.get(entity.mo._moId)
+                if reported == entity.version:
+                    continue
+                object_updates.append(_PC.ObjectUpdate(
+                    kind='modify' if reported else 'enter',
+                    obj=entity.mo,
+                    changeSet=[_PC.Change(name=path, op='assign', val=value)
+                               for path, value
+                               in self._properties(entity, filter_.spec)]))
+                filter_.reported[entity.mo._moId] = entity.version
+            left = set(filter_.reported) - set(
+                entity.mo._moId for entity in selected)
+            for moid in left:
+                del filter_.reported[moid]
+            if object_updates:
+                filter_updates.append(_PC.FilterUpdate(
+                    filter=filter_mo, objectSet=object_updates))
+        return _PC.UpdateSet(version=str(next(self._versions)),
+                             filterSet=filter_updates)
@@ -0,0 +1,100 @@
+# Copyright (C) 2015  Jaroslav Henner
+#
+# This file is part of pyvmomi ansible module.
+#
+# pyvmomi_ansible module is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+#
+# pyvmomi ansible module is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pyvmomi ansible more.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmarks of the startup of the command lines.
+
+    python -m bench.startup --runs 10
+
+Reports the median wall time of a fresh interpreter generating the sample
+config, printing the --help and failing on a bad argument, of deployment
+and all-in-one, and whether that imported pyVmomi. Importing the vSphere
+modules is the baseline those paths should stay well under.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Run in a fresh interpreter, the statement reports whether pyVmomi got
+# imported on the last line of the standard error.
+CHILD = """
+import sys
+sys.argv = {argv!r}
+try:
+    {statement}
+except SystemExit:
+    pass
+sys.stderr.write('\\n' + str('pyVmomi' in sys.modules) + '\\n')
+"""
+
+SCENARIOS = [
+    ('{prog} list_opts', 'import {cli}; {cli}.list_opts()', []),
+    ('{prog} --help', 'import {cli}; {cli}.cli_main()', ['--help']),
+    ('{prog} bad argument', 'import {cli}; {cli}.cli_main()', ['bogus']),
+    ('{prog} vSphere import', 'import {module}', []),
+]
+
+PROGRAMS = [
+    ('deployment', 'deployment_cli', 'deployment'),
+    ('all-in-one', 'all_in_one_cli', 'all_in_one'),
+]
+
+
+def _run(prog, statement, args):
+    code = CHILD.format(argv=[prog] + args, statement=statement)
+    start = time.time()
+    process = subprocess.Popen([sys.executable, '-c', code], cwd=ROOT,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+    _, err = process.communicate()
+    seconds = time.time() - start
+    return seconds, err.decode().strip().splitlines()[-1] == 'True'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--runs', type=int, default=5,
+                        help='How many times to run each scenario.')
+    parser.add_argument('--json', help='A file to write the results to.')
+    args = parser.parse_args()
+
+    print("{:<32} {:>9} {:>8}".format('scenario', 'seconds', 'pyvmomi'))
+    results = []
+    for prog, cli, module in PROGRAMS:
+        for scenario, statement, argv in SCENARIOS:
+            runs = [_run(prog, statement.format(cli=cli, module=module),
+                         argv)
+                    for _ in range(args.runs)]
+            seconds = sorted(run[0] for run in runs)[len(runs) // 2]
+            result = {'scenario': scenario.format(prog=prog),
+                      'seconds': seconds,
+                      'pyvmomi': any(run[1] for run in runs)}
+            results.append(result)
+            print("{scenario:<32} {seconds:>9.3f} {pyvmomi!s:>8}".format(
+                **result))
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(results, json_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,240 @@
+#!/usr/bin/python
+
+# Copyright (C) 2015  Jaroslav Henner
+#
+# This file is part of pyvmomi ansible module.
+#
+# pyvmomi_ansible module is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+#
+# pyvmomi ansible module is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pyvmomi ansible more.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Serving the actions over HTTP from one long living session.
+
+    POST /present     {"topology": {...}, "prefix": "ci-42-"}
+    POST /absent      {"topology": {...}, "prefix": "ci-42-"}
+    GET  /jobs/<id>
+    GET  /status
+
+A POST starts a job running the action in a thread of its own and answers
+with its id right away, a GET of the job answers with its state and, once
+finished, its result or error. All the jobs share the connection, and so
+its inventory index and task monitor, which stay warm between them; a
+keepalive keeps the session from timing out meanwhile. The index trusts
+the paths it misses only for a while, the other clients of the vCenter
+may create them meanwhile.
+
+The server listens on a TCP address, or on a Unix socket to rely on the
+permissions of the socket file instead of an open port.
+"""
+
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler
+from http.server import HTTPServer
+from socketserver import ThreadingMixIn
+from socketserver import UnixStreamServer
+
+import actions as ac
+
+
+LOG = logging.getLogger(__name__)
+
+
+class Job(object):
+    def __init__(self, job_id, action, request):
+        self.id = job_id
+        self.action = action
+        self.request = request
+        self.state = 'running'
+        self.result = None
+        self.error = None
+        self.start_time = time.time()
+        self.finish_time = None
+
+    def as_dict(self):
+        return {
+            'id': self.id,
+            'action': self.action,
+            'state': self.state,
+            'result': self.result,
+            'error': self.error,
+            'start_time': self.start_time,
+            'finish_time': self.finish_time,
+        }
+
+
+class Daemon(object):
+    """Runs the jobs of the actions on the connection of si.
+
+    The `handlers` map the names of the actions to the callables taking
+    si and the JSON body of the request, and returning the JSON-able
+    result of the job. At most `history` finished jobs are remembered. The
+    inventory index trusts its misses for `miss_ttl` seconds after a sweep.
+    """
+
+    def __init__(self, si, handlers, keepalive=600, history=1000,
+                 miss_ttl=60):
+        self.si = si
+        self.handlers = handlers
+        self.keepalive = keepalive
+        self.history = history
+        self.miss_ttl = miss_ttl
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._jobs = {}
+        self._stopped = threading.Event()
+
+    def warm_up(self):
+        """Sweep the inventory into the index before the first job."""
+        index = ac.inventory_index(self.si)
+        index.miss_ttl = self.miss_ttl
+        index.find('')
+
+    def submit(self, action, request):
+        """Start a job of the action, returning it."""
+        if action not in self.handlers:
+            raise KeyError(action)
+        with self._lock:
+            job = Job(next(self._ids), action, request)
+            self._jobs[job.id] = job
+        thread = threading.Thread(target=self._run, args=(job,),
+                                  name='job-{}'.format(job.id))
+        thread.daemon = True
+        thread.start()
+        return job
+
+    def _run(self, job):
+        LOG.info("Job %d of %s started.", job.id, job.action)
+        try:
+            job.result = self.handlers[job.action](self.si, job.request)
+            job.state = 'done'
+        except Exception as ex:
+            LOG.exception("Job %d of %s failed.", job.id, job.action)
+            job.error = str(ex) or type(ex).__name__
+            job.state = 'failed'
+        job.finish_time = time.time()
+        LOG.info("Job %d of %s %s in %.1f s.", job.id, job.action, job.state,
+                 job.finish_time - job.start_time)
+        self._forget_old()
+
+    def _forget_old(self):
+        with self._lock:
+            finished = sorted((job for job in self._jobs.values()
+                               if job.finish_time is not None),
+                              key=lambda job: job.finish_time)
+            for job in finished[:max(0, len(finished) - self.history)]:
+                del self._jobs[job.id]
+
+    def job(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def status(self):
+        with self._lock:
+            jobs = list(self._jobs.values())
+        return {
+            'running': [job.id for job in jobs if job.state == 'running'],
+            'finished': len([job for job in jobs
+                             if job.state != 'running']),
+            'failed': len([job for job in jobs if job.state == 'failed']),
+            'pending_tasks': ac.task_monitor(self.si).pending(),
+        }
+
+    def _keep_alive(self):
+        while not self._stopped.wait(self.keepalive):
+            try:
+                self.si.CurrentTime()
+            except Exception:
+                LOG.exception("The keepalive of the session failed.")
+
+    def serve(self, address=None, unix_socket=None):
+        """Serve the API on the (host, port) address or the Unix socket
+        path until interrupted.
+        """
+        if unix_socket:
+            if os.path.exists(unix_socket):
+                os.remove(unix_socket)
+            server = _ThreadingUnixHTTPServer(unix_socket, _Handler)
+        else:
+            server = _ThreadingHTTPServer(address, _Handler)
+        server.daemon = self
+        keepalive = threading.Thread(target=self._keep_alive,
+                                     name='keepalive')
+        keepalive.daemon = True
+        keepalive.start()
+        LOG.info("Serving on %s.", unix_socket or '{}:{}'.format(*address))
+        try:
+            server.serve_forever()
+        finally:
+            self._stopped.set()
+            server.server_close()
+            if unix_socket:
+                os.remove(unix_socket)
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _ThreadingUnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def address_string(self):
+        # The clients of a Unix socket have no address.
+        return self.client_address and self.client_address[0] or 'unix'
+
+    def log_message(self, format, *args):
+        LOG.debug("%s %s", self.address_string(), format % args)
+
+    def _reply(self, code, body):
+        data = json.dumps(body, sort_keys=True).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        daemon = self.server.daemon
+        parts = self.path.strip('/').split('/')
+        if parts == ['status']:
+            self._reply(200, daemon.status())
+        elif len(parts) == 2 and parts[0] == 'jobs' and parts[1].isdigit():
+            job = daemon.job(int(parts[1]))
+            if job is None:
+                self._reply(404, {'error': 'No job {}.'.format(parts[1])})
+            else:
+                self._reply(200, job.as_dict())
+        else:
+            self._reply(404, {'error': 'No {}.'.format(self.path)})
+
+    def do_POST(self):
+        daemon = self.server.daemon
+        action = self.path.strip('/')
+        if action not in daemon.handlers:
+            self._reply(404, {'error': 'No action {}.'.format(action)})
+            return
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            request = json.loads(self.rfile.read(length).decode('utf-8')
+                                 if length else '{}')
+        except ValueError as ex:
+            self._reply(400, {'error': 'Not JSON: {}'.format(ex)})
+            return
+        job = daemon.submit(action, request)
+        self._reply(202, job.as_dict())
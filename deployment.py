@@ -16,126 +16,158 @@
 # You should have received a copy of the GNU General Public License
 # along with pyvmomi ansible more.  If not, see <http://www.gnu.org/licenses/>.
 
-try:
-    from oslo.config import cfg
-except ImportError:
-    from oslo_config import cfg
-from pyVim import connect
+from pyVmomi import vim
 
 import actions as ac
+from deployment_cli import CONF
+from deployment_cli import vcenter_opts
+import fanout
+import metrics
+import planner
+import session
+import teardown
+import thumbprints
 
-opts = [
-    cfg.StrOpt('esxi_host_address', required=True),
-    cfg.StrOpt('esxi_host_username', required=True),
-    cfg.StrOpt('esxi_host_password', required=True, secret=True),
-    cfg.StrOpt('esxi_datastore_name', default='datastore1'),
-    cfg.StrOpt('esxi_cluster_name', default='test'),
-    cfg.StrOpt('dvswitch_name', default="test_dvswitch"),
-    cfg.StrOpt('dvswitch_portgroup_name', default="test_dvswitch"),
-    cfg.IntOpt('dvswitch_portgroup_vlan', default=100),
-    cfg.StrOpt('vm_name', default='test'),
-    cfg.StrOpt('vm_network', default='br100'),
-    cfg.StrOpt('vm_mac', default="11:22:33:44:55:66"),
-    cfg.StrOpt('vm_cluster_name', default='foo'),
-    cfg.StrOpt('template_name', default="rhel-guest-image-template2"),
-]
-
-vcenter_opts = [
-    cfg.StrOpt('host', required=True,
-               help='The address of the vcenter.'),
-    cfg.StrOpt('user', default='root'),
-    cfg.StrOpt('password', required=True, secret=True),
-]
-
-
-CONF = cfg.ConfigOpts()
-CONF.register_opts(opts)
-CONF.register_opts(vcenter_opts, group="vcenter")
+
+def _has_mac(mac):
+    def check(devices):
+        return any(getattr(device, 'macAddress', None) == mac
+                   for device in devices or [])
+    return check
+
+
+def _has_vlan(vlan):
+    def check(port_config):
+        return port_config is not None and port_config.vlan.vlanId == vlan
+    return check
+
+
+def desired_state(si):
+    network = "New Datacenter/network"
+    switch_path = "{}/{}".format(network, CONF.dvswitch_name)
+    portgroup_path = "{}/{}".format(network, CONF.dvswitch_portgroup_name)
+    cluster_path = 'New Datacenter/host/{}'.format(CONF.esxi_cluster_name)
+    vm_path = 'New Datacenter/vm/{}'.format(CONF.vm_name)
+    store = thumbprints.ThumbprintStore(CONF.thumbprint_store)
+
+    return [
+        planner.Want(
+            switch_path,
+            create=lambda: ac.CreateDVSwitch(si)
+            .name(CONF.dvswitch_name)
+            .target(network),
+            type_=vim.DistributedVirtualSwitch),
+        # The port group can have the name of its switch in the folder.
+        planner.Want(
+            portgroup_path,
+            create=lambda: ac.CreateDVSwitchPortGroup(si)
+            .target(switch_path)
+            .name(CONF.dvswitch_portgroup_name)
+            .vlan(CONF.dvswitch_portgroup_vlan),
+            props={'config.defaultPortConfig':
+                   _has_vlan(CONF.dvswitch_portgroup_vlan)},
+            fix=lambda obj, differing: ac.ReconfigureDVSwitchPortGroup(si)
+            .ref(obj)
+            .vlan(CONF.dvswitch_portgroup_vlan),
+            type_=vim.dvs.DistributedVirtualPortgroup),
+        planner.Want(
+            cluster_path,
+            create=lambda: ac.CreateCluster(si)
+            .name(CONF.esxi_cluster_name)
+            .host_folder('New Datacenter/host')),
+        planner.Want(
+            '{}/{}'.format(cluster_path, CONF.esxi_host_address),
+            create=lambda: ac.CreateHost(si)
+            .name(CONF.esxi_host_address)
+            .cluster_path(cluster_path)
+            .creds(CONF.esxi_host_username, CONF.esxi_host_password)
+            .thumbprint(ac.CreateHost.ANY_THUMBPRINT)
+            .thumbprint_store(store)),
+        planner.Want(
+            vm_path,
+            create=lambda: ac.CreateVm(si).name(CONF.vm_name)
+            .vm_folder_path('New Datacenter/vm/')
+            .host_path('New Datacenter/host/{}'.format(CONF.vm_cluster_name))
+            .datastore_name(CONF.esxi_datastore_name)
+            .network(CONF.vm_network, CONF.vm_mac)
+            .disk(1e6, CONF.vm_disk_provisioning)
+            .disk(2e6, CONF.vm_disk_provisioning)
+            .scsi(),
+            props={'config.hardware.device': _has_mac(CONF.vm_mac)},
+            fix=lambda obj, differing: ac.ChangeMAC(si)
+            .path(vm_path)
+            .mac(CONF.vm_mac)),
+        planner.Want(
+            vm_path + "_from_template",
+            create=lambda: ac.CloneVm(si)
+            .name(CONF.vm_name + "_from_template")
+            .to_template(False)
+            .mode(CONF.clone_mode)
+            .vm_folder_path("New Datacenter/vm")
+            .source_path("New Datacenter/vm/{}".format(CONF.template_name))
+            .resource_pool_path('New Datacenter/host/{}/Resources'.format(
+                CONF.vm_cluster_name))),
+    ]
 
 
 def state_present(si):
-    ac.CreateDVSwitch(si)\
-        .name(CONF.dvswitch_name)\
-        .target("New Datacenter/network")\
-        .make_so()
-
-    ac.CreateDVSwitchPortGroup(si)\
-        .target("New Datacenter/network/{}".format(CONF.dvswitch_name))\
-        .name(CONF.dvswitch_portgroup_name)\
-        .vlan(CONF.dvswitch_portgroup_vlan)\
-        .make_so()
-
-    ac.CreateCluster(si)\
-        .name(CONF.esxi_cluster_name)\
-        .host_folder('New Datacenter/host')\
-        .make_so()
-
-    ac.CreateHost(si)\
-        .name(CONF.esxi_host_address)\
-        .cluster_path('New Datacenter/host/{}'.format(CONF.esxi_cluster_name))\
-        .creds(CONF.esxi_host_username, CONF.esxi_host_password)\
-        .thumbprint(ac.CreateHost.ANY_THUMBPRINT)\
-        .make_so()
-
-    ac.CreateVm(si).name(CONF.vm_name)\
-        .vm_folder_path('New Datacenter/vm/')\
-        .host_path('New Datacenter/host/{}'.format(CONF.vm_cluster_name))\
-        .datastore_name(CONF.esxi_datastore_name)\
-        .network(CONF.vm_network, CONF.vm_mac)\
-        .disk(1e6)\
-        .disk(2e6)\
-        .scsi()\
-        .make_so()
-
-    ac.CloneVm(si)\
-        .name(CONF.vm_name + "_from_template")\
-        .to_template(False)\
-        .vm_folder_path("New Datacenter/vm")\
-        .source_path("New Datacenter/vm/{}".format(CONF.template_name))\
-        .resource_pool_path('New Datacenter/host/{}/Resources'.format(
-            CONF.vm_cluster_name))\
-        .make_so()
+    for build in planner.plan(si, desired_state(si)):
+        build().make_so()
 
 
 def state_absent(si):
-    ac.DestroyVM(si).path(
-        'New Datacenter/vm/{}'.format(CONF.vm_name), False).make_so()
-    ac.DestroyVM(si).path(
-        'New Datacenter/vm/{}'.format(CONF.vm_name + '_from_template'), False) \
-        .make_so()
-    ac.DisconnectHost(si).path(
-        'New Datacenter/host/{}/{}'.format(
-            CONF.esxi_cluster_name, CONF.esxi_host_address), False).make_so()
-    ac.DestroyHost(si).path(
-        'New Datacenter/host/{}/{}'.format(
-            CONF.esxi_cluster_name, CONF.esxi_host_address), False).make_so()
-    ac.DestroyCluster(si).path('New Datacenter/host/{}'.format(
-        CONF.esxi_cluster_name), False).make_so()
-    ac.DestroyDVSwitch(si).path(
-        'New Datacenter/network/{}'.format("test_dswitch"), False).make_so()
-
-
-def add_actions(subparsers):
-    subparsers.add_parser('present')
-    subparsers.add_parser('absent')
-
-
-def cli_main():
-    import logging
-    logging.basicConfig(level=logging.DEBUG)
-    CONF.register_cli_opt(cfg.SubCommandOpt('action', handler=add_actions))
-    CONF(project="vomit", prog="deployment")
+    index = ac.inventory_index(si)
+    vms = [index.find('New Datacenter/vm/{}'.format(name))
+           for name in (CONF.vm_name, CONF.vm_name + '_from_template')]
+    teardown.destroy(si, teardown.describe(si, [vm for vm in vms if vm]),
+                     ac.BatchExecutor())
+
+    host_path = 'New Datacenter/host/{}/{}'.format(
+        CONF.esxi_cluster_name, CONF.esxi_host_address)
+    with ac.BatchExecutor() as be:
+        step = be.submit(ac.DisconnectHost(si).path(host_path, False))
+        step = be.submit(ac.DestroyHost(si).path(host_path, False),
+                         after=step)
+        be.submit(ac.DestroyCluster(si).path('New Datacenter/host/{}'.format(
+            CONF.esxi_cluster_name), False), after=step)
+        be.submit(ac.DestroyDVSwitch(si).ref(index.find_typed(
+            'New Datacenter/network/{}'.format(CONF.dvswitch_name),
+            vim.DistributedVirtualSwitch)))
+
+
+def _write_metrics(recorder, group):
+    if CONF.metrics_json:
+        recorder.write_json(CONF.metrics_json.format(vcenter=group))
+    if CONF.metrics_textfile:
+        recorder.write_textfile(CONF.metrics_textfile.format(vcenter=group))
+
+
+def run_on(group):
+    """Run the action against the vCenter of the option group."""
+    vcenter = CONF[group]
     with ac.disconnecting(
-        connect.SmartConnect(host=CONF.vcenter.host,
-                             user=CONF.vcenter.user,
-                             pwd=CONF.vcenter.password)) as si:
+            session.connect(host=vcenter.host,
+                            user=vcenter.user,
+                            pwd=vcenter.password,
+                            cache_path=vcenter.session_cache),
+            logout=not vcenter.session_cache) as si:
+        ac.task_monitor(si).timeout = vcenter.task_timeout
+        recorder = metrics.instrument(si, {'vcenter': vcenter.host})
 
         action = CONF.action.name
-        globals().get("state_" + action)(si)
-
-
-def list_opts():
-    return [
-        ['DEFAULT', opts],
-        ['vcenter', vcenter_opts]
-    ]
+        try:
+            globals().get("state_" + action)(si)
+        finally:
+            _write_metrics(recorder, group)
+
+
+def main():
+    """Run the action of the parsed command line on the vCenters."""
+    if not CONF.vcenters:
+        run_on('vcenter')
+        return
+
+    for group in CONF.vcenters:
+        CONF.register_opts(vcenter_opts, group=group)
+    if not fanout.log_report(fanout.run(run_on, CONF.vcenters)):
+        return 1
@@ -0,0 +1,117 @@
+#!/usr/bin/python
+
+# Copyright (C) 2015  Jaroslav Henner
+#
+# This file is part of pyvmomi ansible module.
+#
+# pyvmomi ansible module is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+#
+# pyvmomi ansible module is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pyvmomi ansible more.  If not, see <http://www.gnu.org/licenses/>.
+
+"""The options and the command line of deployment.
+
+Parsing them, for the sample config or a --help, needs no pyVmomi, whose
+types take a while to load; the deployment module, which does, gets
+imported only once the command line has been parsed.
+"""
+
+import logging
+
+try:
+    from oslo.config import cfg
+except ImportError:
+    from oslo_config import cfg
+
+opts = [
+    cfg.StrOpt('esxi_host_address', required=True),
+    cfg.StrOpt('esxi_host_username', required=True),
+    cfg.StrOpt('esxi_host_password', required=True, secret=True),
+    cfg.StrOpt('thumbprint_store',
+               help='A file to remember the SSL thumbprints of the ESXi '
+                    'hosts in, trusting them on first use. Only for the '
+                    'run if unset.'),
+    cfg.StrOpt('esxi_datastore_name', default='datastore1'),
+    cfg.StrOpt('esxi_cluster_name', default='test'),
+    cfg.StrOpt('dvswitch_name', default="test_dvswitch"),
+    cfg.StrOpt('dvswitch_portgroup_name', default="test_dvswitch"),
+    cfg.IntOpt('dvswitch_portgroup_vlan', default=100),
+    cfg.StrOpt('vm_name', default='test'),
+    cfg.StrOpt('vm_network', default='br100'),
+    cfg.StrOpt('vm_mac', default="11:22:33:44:55:66"),
+    cfg.StrOpt('vm_disk_provisioning', default='lazy',
+               choices=['thin', 'lazy', 'eager'],
+               help='Allocate the disks of the VM on use, or up front '
+                    'zeroing them on first write or right away.'),
+    cfg.StrOpt('vm_cluster_name', default='foo'),
+    cfg.StrOpt('template_name', default="rhel-guest-image-template2"),
+    cfg.StrOpt('clone_mode', default='full',
+               choices=['full', 'linked'],
+               help='Copy the template disks, or create delta disks on top '
+                    'of its snapshot, which the template needs to have.'),
+]
+
+fanout_opts = [
+    cfg.ListOpt('vcenters', default=[],
+                help='Sections with the vcenter options of the vCenters to '
+                     'deploy to at once, the vcenter section if unset.'),
+]
+
+metrics_opts = [
+    cfg.StrOpt('metrics_json',
+               help='A file to write the SOAP calls of the run to as JSON. '
+                    'A {vcenter} in it is replaced by the section of the '
+                    'vCenter.'),
+    cfg.StrOpt('metrics_textfile',
+               help='A file to write the SOAP calls of the run to in the '
+                    'Prometheus text format. A {vcenter} in it is replaced '
+                    'by the section of the vCenter.'),
+]
+
+vcenter_opts = [
+    cfg.StrOpt('host', required=True,
+               help='The address of the vcenter.'),
+    cfg.StrOpt('user', default='root'),
+    cfg.StrOpt('password', required=True, secret=True),
+    cfg.IntOpt('task_timeout',
+               help='Seconds to wait for a vCenter task before failing, '
+                    'forever if unset.'),
+    cfg.StrOpt('session_cache',
+               help='A file to keep the session in between the runs, '
+                    'logging in and out on every run if unset.'),
+]
+
+
+CONF = cfg.ConfigOpts()
+CONF.register_opts(opts)
+CONF.register_opts(fanout_opts)
+CONF.register_opts(metrics_opts)
+CONF.register_opts(vcenter_opts, group="vcenter")
+
+
+def add_actions(subparsers):
+    subparsers.add_parser('present')
+    subparsers.add_parser('absent')
+
+
+def cli_main():
+    logging.basicConfig(level=logging.DEBUG)
+    CONF.register_cli_opt(cfg.SubCommandOpt('action', handler=add_actions))
+    CONF(project="vomit", prog="deployment")
+
+    import deployment
+    return deployment.main()
+
+
+def list_opts():
+    return [
+        ['DEFAULT', opts + fanout_opts + metrics_opts],
+        ['vcenter', vcenter_opts]
+    ]
@@ -0,0 +1,78 @@
+#!/usr/bin/python
+
+# Copyright (C) 2015  Jaroslav Henner
+#
+# This file is part of pyvmomi ansible module.
+#
+# pyvmomi_ansible module is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+#
+# pyvmomi ansible module is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pyvmomi ansible more.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Running the same deployment against several vCenters at once.
+
+Each target runs in a process of its own, with its own connection. The
+processes are forked whatever the default start method of the platform,
+so they inherit the parsed configuration.
+"""
+
+import logging
+import multiprocessing
+import time
+import traceback
+
+
+LOG = logging.getLogger(__name__)
+
+
+def _run_target(args):
+    func, target = args
+    start = time.time()
+    try:
+        func(target)
+    except Exception as ex:
+        LOG.debug(traceback.format_exc())
+        # The faults of pyVmomi do not always survive pickling.
+        error = '{}: {}'.format(type(ex).__name__, ex)
+    else:
+        error = None
+    return {'target': target,
+            'seconds': time.time() - start,
+            'error': error}
+
+
+def run(func, targets, processes=None):
+    """Call func(target) for each of the targets in a pool of processes,
+    returning a result per target, with the time it took and the error it
+    failed with, if any.
+    """
+    pool = multiprocessing.get_context('fork').Pool(
+        processes or len(targets))
+    try:
+        return pool.map(_run_target, [(func, target) for target in targets],
+                        chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def log_report(results):
+    """Log the results of run, returning whether all the targets passed."""
+    for result in results:
+        if result['error']:
+            LOG.error("%(target)s failed after %(seconds).1f s: %(error)s",
+                      result)
+        else:
+            LOG.info("%(target)s finished in %(seconds).1f s.", result)
+    failed = [result for result in results if result['error']]
+    LOG.info("%d of %d vCenters finished, the slowest took %.1f s.",
+             len(results) - len(failed), len(results),
+             max(result['seconds'] for result in results))
+    return not failed
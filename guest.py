@@ -0,0 +1,142 @@
+#!/usr/bin/python
+
+# Copyright (C) 2015  Jaroslav Henner
+#
+# This file is part of pyvmomi ansible module.
+#
+# pyvmomi_ansible module is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+#
+# pyvmomi ansible module is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pyvmomi ansible more.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Waiting for the guests of powered on VMs to get ready.
+
+A guest is ready once its VMware Tools run and it has an IP address. The
+guests of a whole batch of VMs are followed by a single property filter
+on a private property collector, traversing a ListView of the VMs, and
+one WaitForUpdatesEx loop, instead of polling each VM.
+"""
+
+import logging
+import math
+import time
+
+from pyVmomi import vim
+from pyVmomi import vmodl
+
+import actions as ac
+import metrics
+
+
+LOG = logging.getLogger(__name__)
+
+PATHS = ['guest.toolsRunningStatus', 'guest.ipAddress', 'guest.net']
+
+
+class GuestTimeout(Exception):
+    """The guests of the `pending` VMs did not get ready in time, while
+    the ones in `ready` did.
+    """
+
+    def __init__(self, message, ready, pending):
+        super(GuestTimeout, self).__init__(message)
+        self.ready = ready
+        self.pending = pending
+
+
+def addresses(props):
+    """Return the IP addresses of the guest properties, the primary one
+    first.
+    """
+    found = []
+    for address in [props.get('guest.ipAddress')] + [
+            address for nic in props.get('guest.net') or []
+            for address in nic.ipAddress or []]:
+        if address and address not in found:
+            found.append(address)
+    return found
+
+
+def is_ready(props):
+    return (props.get('guest.toolsRunningStatus') ==
+            vim.vm.GuestInfo.ToolsRunningStatus.guestToolsRunning and
+            bool(props.get('guest.ipAddress')))
+
+
+def wait_ready(si, vms, timeout=None, ready=None):
+    """Wait for the guests of the VMs to get ready, returning the IP
+    addresses of each of them as {vm: [address]}.
+
+    The ready callback gets called with each VM and its addresses as soon
+    as its guest gets ready. Raises GuestTimeout when not all of them do
+    in timeout seconds.
+    """
+    vms = list(vms)
+    if not vms:
+        return {}
+    with metrics.attributed('GuestReadiness'):
+        content = ac.service_content(si)
+        pc = vmodl.query.PropertyCollector
+        collector = content.propertyCollector.CreatePropertyCollector()
+        view = content.viewManager.CreateListView(vms)
+        try:
+            collector.CreateFilter(pc.FilterSpec(
+                objectSet=[pc.ObjectSpec(
+                    obj=view, skip=True,
+                    selectSet=[pc.TraversalSpec(type=vim.view.ListView,
+                                                path='view', skip=False)])],
+                propSet=[pc.PropertySpec(type=vim.VirtualMachine,
+                                         pathSet=PATHS)]), True)
+            return _wait(collector, view, vms, timeout, ready)
+        finally:
+            collector.Destroy()
+            view.Destroy()
+
+
+def _wait(collector, view, vms, timeout, ready):
+    props = dict((vm._moId, {}) for vm in vms)
+    by_moid = dict((vm._moId, vm) for vm in vms)
+    found = {}
+    deadline = None if timeout is None else time.time() + timeout
+    version = None
+    while len(found) < len(vms):
+        max_wait_seconds = 10
+        if deadline is not None:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                pending = [vm for vm in vms if vm not in found]
+                raise GuestTimeout(
+                    "The guests of {} VMs did not get ready in {} "
+                    "s.".format(len(pending), timeout), found, pending)
+            max_wait_seconds = max(1, min(10, int(math.ceil(remaining))))
+        update = collector.WaitForUpdatesEx(
+            version, vmodl.query.PropertyCollector.WaitOptions(
+                maxWaitSeconds=max_wait_seconds))
+        if update is None:
+            continue
+        version = update.version
+        newly_ready = []
+        for filter_set in update.filterSet:
+            for obj_set in filter_set.objectSet:
+                moid = obj_set.obj._moId
+                if moid not in props or by_moid[moid] in found:
+                    continue
+                for change in obj_set.changeSet:
+                    props[moid][change.name] = change.val
+                if is_ready(props[moid]):
+                    newly_ready.append(by_moid[moid])
+        if newly_ready:
+            view.ModifyListView(remove=newly_ready)
+        for vm in newly_ready:
+            found[vm] = addresses(props[vm._moId])
+            LOG.debug("The guest of %s is ready at %s.", vm, found[vm])
+            if ready:
+                ready(vm, found[vm])
+    return found
@@ -0,0 +1,116 @@
+#!/usr/bin/python
+
+# Copyright (C) 2015  Jaroslav Henner
+#
+# This file is part of pyvmomi ansible module.
+#
+# pyvmomi_ansible module is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+#
+# pyvmomi ansible module is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pyvmomi ansible more.  If not, see <http://www.gnu.org/licenses/>.
+
+"""An append-only journal of the actions of a run, to resume it.
+
+Each line is a JSON record of the key of an action, its state and, once
+started, the morefs of its tasks:
+
+    {"key": "clone New Datacenter/vm/lab/compute-1", "state": "started",
+     "tasks": ["task-1234"]}
+    {"key": "clone New Datacenter/vm/lab/compute-1", "state": "done"}
+
+A run resuming from the journal skips the actions it has done, and
+follows the tasks of the ones it has started instead of starting them
+again. The last record of a key wins; a line cut short by the run dying
+while writing it is ignored.
+
+Each record gets flushed as it is written, so a run dying loses none of
+them, and synced by sync, which BatchExecutor calls once per pass of its
+loop, so the records also survive a crash of the machine.
+"""
+
+import json
+import logging
+import os
+
+
+LOG = logging.getLogger(__name__)
+
+STARTED = 'started'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class Journal(object):
+    """The journal in the file at the path, replayed if resuming, started
+    anew otherwise.
+    """
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        self._records = {}
+        self._cut = False
+        self._unsynced = False
+        if resume:
+            self._replay()
+        self._file = open(path, 'a' if resume else 'w')
+        if self._cut:
+            # The next record starts a line of its own.
+            self._file.write('\n')
+
+    def _replay(self):
+        try:
+            journal_file = open(self.path)
+        except (IOError, OSError):
+            LOG.info("No journal %s to resume from.", self.path)
+            return
+        with journal_file:
+            for line in journal_file:
+                self._cut = not line.endswith('\n')
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                self._records[record['key']] = record
+        LOG.info("Resuming %d actions from the journal %s.",
+                 len(self._records), self.path)
+
+    def done(self, key):
+        """Return whether an earlier run finished the action of the key."""
+        return self._records.get(key, {}).get('state') == DONE
+
+    def started_tasks(self, key):
+        """Return the morefs of the tasks an earlier run started for the
+        action of the key without seeing them finish, if any.
+        """
+        record = self._records.get(key, {})
+        if record.get('state') != STARTED:
+            return []
+        return record.get('tasks', [])
+
+    def record(self, key, state, tasks=None):
+        record = {'key': key, 'state': state}
+        if tasks is not None:
+            record['tasks'] = tasks
+        self._records[key] = record
+        # A line at a time, so a run dying loses at most the one it was
+        # writing.
+        self._file.write(json.dumps(record, sort_keys=True) + '\n')
+        self._file.flush()
+        self._unsynced = True
+
+    def sync(self):
+        """Write the records since the last sync through to the disk."""
+        if self._unsynced:
+            os.fsync(self._file.fileno())
+            self._unsynced = False
+
+    def close(self):
+        self.sync()
+        self._file.close()
@@ -0,0 +1,238 @@
+#!/usr/bin/python
+
+# Copyright (C) 2015  Jaroslav Henner
+#
+# This file is part of pyvmomi ansible module.
+#
+# pyvmomi_ansible module is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+#
+# pyvmomi ansible module is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pyvmomi ansible more.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Counting the SOAP calls of a connection.
+
+    recorder = metrics.instrument(si)
+    ...
+    recorder.write_json('calls.json')
+    recorder.write_textfile('/var/lib/node_exporter/vomit.prom')
+
+Every call through the stub adapter of the service instance is recorded
+with its latency and, with the SOAP stub adapter, the bytes sent and
+received. The lazy property reads of the managed objects are calls too,
+recorded as the property of the managed object type. The calls are
+attributed to the action running them in the calling thread, see
+attributed.
+"""
+
+from contextlib import contextmanager
+import json
+import os
+import threading
+import time
+import weakref
+
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_RECORDERS = weakref.WeakKeyDictionary()
+_local = threading.local()
+
+
+@contextmanager
+def attributed(owner):
+    """Attribute the calls made by the thread meanwhile to the owner."""
+    previous = getattr(_local, 'owner', None)
+    _local.owner = owner
+    try:
+        yield
+    finally:
+        _local.owner = previous
+
+
+class _Call(object):
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.buckets = [0] * len(BUCKETS)
+        self.sent_bytes = 0
+        self.received_bytes = 0
+
+    def add(self, seconds, failed, sent_bytes, received_bytes):
+        self.count += 1
+        self.errors += failed
+        self.seconds += seconds
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+        self.sent_bytes += sent_bytes
+        self.received_bytes += received_bytes
+
+
+class SoapMetrics(object):
+    """The calls of one connection, by the owner, kind and name of the
+    call. The kind is either method or property.
+    """
+
+    def __init__(self, labels=None):
+        self.labels = labels or {}
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def record(self, owner, kind, name, seconds, failed=False,
+               sent_bytes=0, received_bytes=0):
+        key = (owner or '', kind, name)
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = _Call()
+            call.add(seconds, failed, sent_bytes, received_bytes)
+
+    def as_dicts(self):
+        with self._lock:
+            return [{'owner': owner, 'kind': kind, 'name': name,
+                     'count': call.count, 'errors': call.errors,
+                     'seconds': call.seconds,
+                     'buckets': dict(zip(BUCKETS, call.buckets)),
+                     'sent_bytes': call.sent_bytes,
+                     'received_bytes': call.received_bytes}
+                    for (owner, kind, name), call
+                    in sorted(self._calls.items())]
+
+    def write_json(self, path):
+        _write(path, json.dumps({'labels': self.labels,
+                                 'calls': self.as_dicts()},
+                                indent=2, sort_keys=True))
+
+    def write_textfile(self, path):
+        """Write the calls in the text format of Prometheus, to be picked
+        up by the textfile collector of the node exporter.
+        """
+        lines = [
+            '# HELP vomit_soap_call_seconds Latency of the SOAP calls.',
+            '# TYPE vomit_soap_call_seconds histogram',
+        ]
+        calls = self.as_dicts()
+        for call in calls:
+            labels = self._labels(call)
+            for bound in BUCKETS:
+                lines.append('vomit_soap_call_seconds_bucket{{{},le="{}"}} '
+                             '{}'.format(labels, bound,
+                                         call['buckets'][bound]))
+            lines.append('vomit_soap_call_seconds_bucket{{{},le="+Inf"}} '
+                         '{}'.format(labels, call['count']))
+            lines.append('vomit_soap_call_seconds_sum{{{}}} {}'.format(
+                labels, call['seconds']))
+            lines.append('vomit_soap_call_seconds_count{{{}}} {}'.format(
+                labels, call['count']))
+        for metric, field, help_text in [
+                ('vomit_soap_call_errors_total', 'errors',
+                 'SOAP calls which failed.'),
+                ('vomit_soap_sent_bytes_total', 'sent_bytes',
+                 'Bytes of the SOAP requests.'),
+                ('vomit_soap_received_bytes_total', 'received_bytes',
+                 'Bytes of the SOAP responses.')]:
+            lines.append('# HELP {} {}'.format(metric, help_text))
+            lines.append('# TYPE {} counter'.format(metric))
+            for call in calls:
+                lines.append('{}{{{}}} {}'.format(
+                    metric, self._labels(call), call[field]))
+        _write(path, '\n'.join(lines) + '\n')
+
+    def _labels(self, call):
+        labels = dict(self.labels, owner=call['owner'], kind=call['kind'],
+                      call=call['name'])
+        return ','.join('{}="{}"'.format(
+            name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+            for name, value in sorted(labels.items()))
+
+
+def _write(path, text):
+    # The collectors must not read a half written file.
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as tmp_file:
+        tmp_file.write(text)
+    os.rename(tmp_path, path)
+
+
+def _wrap_connection(stub):
+    get_connection = stub.GetConnection
+
+    def counting_read(read):
+        def wrapper(*args):
+            data = read(*args)
+            _local.received_bytes = (getattr(_local, 'received_bytes', 0) +
+                                     len(data))
+            return data
+        return wrapper
+
+    def getresponse(connection_getresponse):
+        def wrapper(*args, **kwargs):
+            response = connection_getresponse(*args, **kwargs)
+            response.read = counting_read(response.read)
+            return response
+        return wrapper
+
+    def wrapper():
+        connection = get_connection()
+        if not getattr(connection, '_vomit_counted', False):
+            connection.getresponse = getresponse(connection.getresponse)
+            connection._vomit_counted = True
+        return connection
+    stub.GetConnection = wrapper
+
+
+def _count_request(request):
+    _local.sent_bytes = getattr(_local, 'sent_bytes', 0) + len(request)
+    return request
+
+
+def instrument(si, labels=None):
+    """Record the calls of the connection of the service instance,
+    returning the SoapMetrics, the same ones for every call.
+    """
+    stub = si._stub
+    if stub in _RECORDERS:
+        return _RECORDERS[stub]
+    recorder = _RECORDERS[stub] = SoapMetrics(labels)
+
+    def timed(kind, invoke, name):
+        def wrapper(mo, info, *args, **kwargs):
+            # The SOAP stub adapter reads the properties by a nested call.
+            if getattr(_local, 'in_call', False):
+                return invoke(mo, info, *args, **kwargs)
+            _local.in_call = True
+            _local.sent_bytes = _local.received_bytes = 0
+            start = time.time()
+            failed = True
+            try:
+                result = invoke(mo, info, *args, **kwargs)
+                failed = False
+                return result
+            finally:
+                _local.in_call = False
+                recorder.record(getattr(_local, 'owner', None), kind,
+                                name(mo, info), time.time() - start, failed,
+                                _local.sent_bytes, _local.received_bytes)
+        return wrapper
+
+    stub.InvokeMethod = timed(
+        'method', stub.InvokeMethod,
+        lambda mo, info: '{}.{}'.format(mo._wsdlName, info.wsdlName))
+    stub.InvokeAccessor = timed(
+        'property', stub.InvokeAccessor,
+        lambda mo, info: '{}.{}'.format(mo._wsdlName, info.name))
+    # The bytes go over the sessions of a session.PooledStub.
+    for session_stub in getattr(stub, 'stubs', [stub]):
+        if hasattr(session_stub, 'requestModifierList'):
+            session_stub.requestModifierList.append(_count_request)
+        if hasattr(session_stub, 'GetConnection'):
+            _wrap_connection(session_stub)
+    return recorder
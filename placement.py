@@ -0,0 +1,240 @@
+#!/usr/bin/python
+
+# Copyright (C) 2015  Jaroslav Henner
+#
+# This file is part of pyvmomi ansible module.
+#
+# pyvmomi_ansible module is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+#
+# pyvmomi ansible module is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pyvmomi ansible more.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Placing clones on the datastores and hosts of a cluster by their load.
+
+    engine = placement.Placement(si, cluster)
+    ac.CloneVm(si)...placement(engine)
+
+The free space and provisioning of the datastores of the cluster and the
+CPU and memory load of its hosts come from one RetrieveContents call, on
+the first placement. Each placement then charges the datastore and the
+host it picked, so the clones of a batch spread over the cluster instead
+of all going to the same least loaded ones. A clone failing gets its
+charge released.
+"""
+
+import logging
+import threading
+
+from pyVmomi import vim
+from pyVmomi import vmodl
+
+import actions as ac
+
+
+LOG = logging.getLogger(__name__)
+
+
+class NoPlacement(Exception):
+    pass
+
+
+class DatastoreLoad(object):
+    def __init__(self, obj, props):
+        self.obj = obj
+        self.name = props.get('summary.name')
+        self.capacity = props.get('summary.capacity') or 0
+        self.free = props.get('summary.freeSpace') or 0
+        self.uncommitted = props.get('summary.uncommitted') or 0
+        self.usable = (props.get('summary.accessible', False) and
+                       props.get('summary.maintenanceMode') in
+                       (None, 'normal'))
+
+    @property
+    def provisioned(self):
+        return self.capacity - self.free + self.uncommitted
+
+    def charge(self, size):
+        self.free -= size
+
+
+class HostLoad(object):
+    def __init__(self, obj, props):
+        self.obj = obj
+        self.name = props.get('name')
+        self.datastores = set(
+            datastore._moId for datastore in props.get('datastore') or [])
+        cores = props.get('summary.hardware.numCpuCores') or 0
+        self.cpu_mhz = cores * (props.get('summary.hardware.cpuMhz') or 0)
+        self.cpu_used_mhz = (
+            props.get('summary.quickStats.overallCpuUsage') or 0)
+        self.memory_mb = (
+            props.get('summary.hardware.memorySize') or 0) // 2 ** 20
+        self.memory_used_mb = (
+            props.get('summary.quickStats.overallMemoryUsage') or 0)
+        self.usable = (
+            props.get('runtime.connectionState') == 'connected' and
+            not props.get('runtime.inMaintenanceMode'))
+
+    def charge(self, memory_mb):
+        self.memory_used_mb += memory_mb
+
+
+class SpreadPolicy(object):
+    """Prefers the datastores with the most free space left, and the hosts
+    with the most headroom of their busier resource.
+
+    A datastore left with less than `min_free_ratio` of its capacity free,
+    or provisioned over `max_provisioned` times its capacity, is not a
+    candidate; neither is a host without the memory for the clone.
+    """
+
+    def __init__(self, min_free_ratio=0.05, max_provisioned=2.0):
+        self.min_free_ratio = min_free_ratio
+        self.max_provisioned = max_provisioned
+
+    def datastore_score(self, datastore, size):
+        """Return how good a place the datastore is for a clone of the
+        size in bytes, the higher the better, None for no place at all.
+        """
+        if not datastore.usable or not datastore.capacity:
+            return None
+        free = datastore.free - size
+        if (free < self.min_free_ratio * datastore.capacity or
+                datastore.provisioned + size >
+                self.max_provisioned * datastore.capacity):
+            return None
+        return float(free) / datastore.capacity
+
+    def host_score(self, host, memory_mb):
+        """Return how good a place the host is for a clone of the memory,
+        the higher the better, None for no place at all.
+        """
+        if not host.usable or not host.memory_mb:
+            return None
+        memory = float(host.memory_used_mb + memory_mb) / host.memory_mb
+        if memory > 1:
+            return None
+        cpu = (float(host.cpu_used_mhz) / host.cpu_mhz if host.cpu_mhz
+               else 0)
+        return 1 - max(cpu, memory)
+
+
+class Placement(object):
+    """Picks a datastore and a host of the cluster for each clone."""
+
+    DATASTORE_PATHS = ['summary.name', 'summary.capacity',
+                       'summary.freeSpace', 'summary.uncommitted',
+                       'summary.accessible', 'summary.maintenanceMode']
+    HOST_PATHS = ['name', 'datastore', 'runtime.connectionState',
+                  'runtime.inMaintenanceMode',
+                  'summary.hardware.numCpuCores',
+                  'summary.hardware.cpuMhz', 'summary.hardware.memorySize',
+                  'summary.quickStats.overallCpuUsage',
+                  'summary.quickStats.overallMemoryUsage']
+
+    def __init__(self, si, cluster, policy=None):
+        self.si = si
+        self.cluster = cluster
+        self.policy = policy or SpreadPolicy()
+        # The loads are charged under the lock, and retrieved under the
+        # loading lock, once for all the threads placing clones at once.
+        self._lock = threading.Lock()
+        self._loading = threading.Lock()
+        self._datastores = None
+        self._hosts = None
+        self._footprints = {}
+
+    def refresh(self):
+        """Retrieve the load of the datastores and the hosts again."""
+        pc = vmodl.query.PropertyCollector
+        filter_spec = pc.FilterSpec(
+            objectSet=[pc.ObjectSpec(
+                obj=self.cluster, skip=True,
+                selectSet=[pc.TraversalSpec(type=vim.ComputeResource,
+                                            path=path, skip=False)
+                           for path in ('host', 'datastore')])],
+            propSet=[pc.PropertySpec(type=vim.Datastore,
+                                     pathSet=self.DATASTORE_PATHS),
+                     pc.PropertySpec(type=vim.HostSystem,
+                                     pathSet=self.HOST_PATHS)])
+        datastores, hosts = [], []
+        for content in ac.service_content(
+                self.si).propertyCollector.RetrieveContents([filter_spec]):
+            props = dict((prop.name, prop.val) for prop in content.propSet)
+            if isinstance(content.obj, vim.Datastore):
+                datastores.append(DatastoreLoad(content.obj, props))
+            else:
+                hosts.append(HostLoad(content.obj, props))
+        with self._lock:
+            self._datastores, self._hosts = datastores, hosts
+        LOG.debug("Placing over %d datastores and %d hosts.",
+                  len(datastores), len(hosts))
+
+    def footprint(self, vm):
+        """Return the committed bytes and the memory MB of the VM."""
+        with self._loading:
+            if vm not in self._footprints:
+                props = ac.retrieve_properties(
+                    self.si, [vm], {vim.VirtualMachine: [
+                        'summary.storage.committed',
+                        'summary.config.memorySizeMB']})[vm]
+                self._footprints[vm] = (
+                    props.get('summary.storage.committed') or 0,
+                    props.get('summary.config.memorySizeMB') or 0)
+            return self._footprints[vm]
+
+    def place(self, size=0, memory_mb=0):
+        """Return the datastore and the host of the best score for a clone
+        of the size in bytes and the memory, charging them with it.
+        """
+        if self._datastores is None:
+            with self._loading:
+                if self._datastores is None:
+                    self.refresh()
+        with self._lock:
+            datastores = self._best(
+                self._datastores,
+                lambda datastore: self.policy.datastore_score(datastore,
+                                                              size))
+            for datastore in datastores:
+                hosts = self._best(
+                    [host for host in self._hosts
+                     if datastore.obj._moId in host.datastores],
+                    lambda host: self.policy.host_score(host, memory_mb))
+                if hosts:
+                    host = hosts[0]
+                    datastore.charge(size)
+                    host.charge(memory_mb)
+                    LOG.debug("Placing a clone on %s and %s.",
+                              datastore.name, host.name)
+                    return datastore.obj, host.obj
+        raise NoPlacement("No datastore and host of {} can take a clone of "
+                          "{} bytes and {} MB.".format(
+                              self.cluster, size, memory_mb))
+
+    def release(self, datastore, host, size=0, memory_mb=0):
+        """Take the charge of a clone of the size in bytes and the memory,
+        which failed, off the datastore and the host place gave it.
+        """
+        with self._lock:
+            for load in self._datastores or []:
+                if load.obj._moId == datastore._moId:
+                    load.charge(-size)
+            for load in self._hosts or []:
+                if load.obj._moId == host._moId:
+                    load.charge(-memory_mb)
+
+    @staticmethod
+    def _best(candidates, score):
+        scored = [(score(candidate), i, candidate)
+                  for i, candidate in enumerate(candidates)]
+        return [candidate for _, _, candidate in sorted(
+            (item for item in scored if item[0] is not None),
+            key=lambda item: (-item[0], item[1]))]
@@ -0,0 +1,95 @@
+#!/usr/bin/python
+
+# Copyright (C) 2015  Jaroslav Henner
+#
+# This file is part of pyvmomi ansible module.
+#
+# pyvmomi_ansible module is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+#
+# pyvmomi ansible module is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pyvmomi ansible more.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Planning only the actions which bring the inventory to a desired state.
+
+The existence of the wanted entities comes from the inventory index, and
+the properties to compare from one RetrieveContents call, so planning an
+already converged deployment costs a few round trips.
+"""
+
+import functools
+import logging
+
+import actions as ac
+
+
+LOG = logging.getLogger(__name__)
+
+
+class Want(object):
+    """An entity of the desired state.
+
+    The `create` callable builds the action creating the entity at the
+    inventory `path` when it is missing. An entity at the path which is
+    not of the `type_`, if given, does not count. The `props` map property
+    paths of the entity to their wanted values, or to predicates the values
+    have to pass. When some do not, `fix` builds the action reconciling
+    them, given the managed object and the paths of the differing
+    properties.
+    """
+
+    def __init__(self, path, create, props=None, fix=None, type_=None):
+        self.path = path
+        self.create = create
+        self.props = props or {}
+        self.fix = fix
+        self.type_ = type_
+
+    def find(self, index):
+        if self.type_ is None:
+            return index.find(self.path)
+        return index.find_typed(self.path, self.type_)
+
+
+def _matches(value, wanted):
+    if callable(wanted):
+        return wanted(value)
+    return value == wanted
+
+
+def plan(si, wants):
+    """Return builders of the actions bringing the inventory to the wanted
+    state, in the order of the wants.
+    """
+    index = ac.inventory_index(si)
+    found = [(want, want.find(index)) for want in wants]
+
+    compared = [(want, obj) for want, obj in found if obj and want.props]
+    current = {}
+    if compared:
+        path_sets = {}
+        for want, obj in compared:
+            path_sets.setdefault(type(obj), set()).update(want.props)
+        current = ac.retrieve_properties(
+            si, [obj for _, obj in compared], path_sets)
+
+    builders = []
+    for want, obj in found:
+        if not obj:
+            LOG.info("%s is missing.", want.path)
+            builders.append(want.create)
+            continue
+        differing = [path for path, wanted in want.props.items()
+                     if not _matches(current[obj].get(path), wanted)]
+        if differing:
+            LOG.info("%s differs in %s.", want.path, ', '.join(differing))
+            builders.append(functools.partial(want.fix, obj, differing))
+        else:
+            LOG.debug("%s is as wanted.", want.path)
+    return builders
@@ -0,0 +1,206 @@
+#!/usr/bin/python
+
+# Copyright (C) 2015  Jaroslav Henner
+#
+# This file is part of pyvmomi ansible module.
+#
+# pyvmomi_ansible module is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+#
+# pyvmomi ansible module is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pyvmomi ansible more.  If not, see <http://www.gnu.org/licenses/>.
+
+"""A warm pool of powered off clones of a template, claimed instead of
+cloning.
+
+The pool is a folder of clones of the template, kept full by fill. A VM
+of a deployment claims one of them by renaming it and setting its memory
+and MAC by one reconfigure, then moves it to its folder, which leaves a
+reconfigure, a move and a power on to wait for instead of a whole clone.
+
+The claims are exclusive. The runs over one connection, like the jobs of
+the daemon, never take the same member, and the reconfigure of a claim
+fails once another run, over any connection, claimed the member first,
+see ClaimVm.
+"""
+
+import logging
+import random
+import threading
+import uuid
+
+from pyVmomi import vim
+from pyVmomi import vmodl
+
+import actions as ac
+
+
+LOG = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+
+
+class Exhausted(Exception):
+    pass
+
+
+class ClaimLost(ac.LostRace):
+    pass
+
+
+class _Claims(object):
+    """The members of one pool folder taken over one connection."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._taken = set()
+
+    def take(self, found):
+        with self._lock:
+            while found:
+                vm, change_version = found.pop()
+                if vm._moId not in self._taken:
+                    self._taken.add(vm._moId)
+                    return vm, change_version
+        return None
+
+    def listed(self, moids):
+        # The members gone from the folder are not worth remembering.
+        with self._lock:
+            self._taken &= set(moids)
+
+
+def _claims(si, folder):
+    state = ac.session_state(si)
+    with _lock:
+        return state.setdefault('pool_claims', {}).setdefault(
+            folder._moId, _Claims())
+
+
+class Members(object):
+    """The powered off VMs of a pool folder as listed by a run, for its
+    claims to take one by one.
+    """
+
+    def __init__(self, found, claims):
+        self._found = found
+        self._claims = claims
+
+    def __len__(self):
+        return len(self._found)
+
+    def take(self):
+        """Return the next VM and the changeVersion of its config, None when
+        there are no more the other runs over the connection did not take.
+        """
+        return self._claims.take(self._found)
+
+
+def members(si, folder):
+    """Return the Members of the pool folder, shuffled so that the runs
+    over other connections claiming from the same pool at once rarely pick
+    the same ones.
+    """
+    pc = vmodl.query.PropertyCollector
+    filter_spec = pc.FilterSpec(
+        objectSet=[pc.ObjectSpec(
+            obj=folder, skip=True,
+            selectSet=[pc.TraversalSpec(type=vim.Folder, path='childEntity',
+                                        skip=False)])],
+        propSet=[pc.PropertySpec(
+            type=vim.VirtualMachine,
+            pathSet=['config.template', 'config.changeVersion',
+                     'runtime.powerState'])])
+    found, moids = [], []
+    for content in ac.service_content(
+            si).propertyCollector.RetrieveContents([filter_spec]):
+        if not isinstance(content.obj, vim.VirtualMachine):
+            continue
+        moids.append(content.obj._moId)
+        props = dict((prop.name, prop.val) for prop in content.propSet)
+        if not props.get('config.template') and \
+                props.get('runtime.powerState') == \
+                vim.VirtualMachinePowerState.poweredOff:
+            found.append((content.obj, props.get('config.changeVersion')))
+    random.shuffle(found)
+    claims = _claims(si, folder)
+    claims.listed(moids)
+    return Members(found, claims)
+
+
+class ClaimVm(ac.ReconfigureVm):
+    """Claims a member of the pool by renaming it and setting its memory
+    and MAC by one reconfigure.
+
+    The reconfigure carries the changeVersion the member was listed with,
+    so it fails with ConcurrentAccess when another run reconfigured the
+    member, claiming it, first. The claim then fails with ClaimLost, for
+    BatchExecutor to build a claim of the next member, given the claim as
+    a callable building it.
+    """
+
+    _attached = False
+
+    def members(self, members):
+        """Claim the next of the Members, raising Exhausted with none left.
+        """
+        member = members.take()
+        if member is None:
+            raise Exhausted("No member of the pool left to claim.")
+        self.entity, self._change_version = member
+        return self
+
+    def name(self, name):
+        self.name_ = name
+        return self
+
+    def _spec(self):
+        cs = ac.ReconfigureVm._spec(self)
+        cs.name = self.name_
+        cs.changeVersion = self._change_version
+        return cs
+
+    def attach(self, tasks):
+        # The tasks of an earlier run claim a member of its own.
+        self._attached = True
+        return ac.ReconfigureVm.attach(self, tasks)
+
+    def wait(self, timeout=None):
+        try:
+            ac.ReconfigureVm.wait(self, timeout)
+        except vim.fault.ConcurrentAccess:
+            raise ClaimLost("Another run claimed {} first.".format(
+                self.entity._moId))
+        if self._attached:
+            self.entity = self.tasks[0].info.entity
+        ac.inventory_index(self.si).moved(self.entity, name=self.name_)
+
+
+def fill(si, folder_path, template_path, resource_pool_path, size, executor,
+         mode=ac.CloneVm.FULL):
+    """Clone the template into the pool folder until it has `size` members,
+    by the executor, returning how many clones it took.
+    """
+    folder = ac.inventory_index(si).find(folder_path)
+    if folder is None:
+        raise ac.NotFound(folder_path)
+    missing = max(0, size - len(members(si, folder)))
+    LOG.info("Cloning %d VMs to fill the pool %s.", missing, folder_path)
+    template_name = template_path.rstrip('/').rpartition('/')[2]
+    with executor as be:
+        for _ in range(missing):
+            be.submit(
+                ac.CloneVm(si)
+                .name('{}-pool-{}'.format(template_name, uuid.uuid4().hex[:8]))
+                .to_template(False)
+                .mode(mode)
+                .vm_folder_path(folder_path)
+                .source_path(template_path)
+                .resource_pool_path(resource_pool_path))
+    return missing
@@ -0,0 +1,167 @@
+#!/usr/bin/python
+
+# Copyright (C) 2015  Jaroslav Henner
+#
+# This file is part of pyvmomi ansible module.
+#
+# pyvmomi_ansible module is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+#
+# pyvmomi ansible module is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pyvmomi ansible more.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Connecting to the vCenter, optionally reusing a cached session.
+
+The session cache is a JSON file readable only by its owner, mapping
+user@host to the API version and the vmware_soap_session cookie of the
+last login. A cached session still alive saves the version discovery and
+the login of SmartConnect.
+
+A service instance of connect_pool makes its calls over several sessions
+at once, see PooledStub.
+"""
+
+import itertools
+import json
+import logging
+import os
+import threading
+
+from pyVim import connect as pyvim_connect
+from pyVmomi import SoapAdapter
+from pyVmomi.StubAdapterAccessorImpl import StubAdapterAccessorMixin
+from pyVmomi import vim
+from pyVmomi import vmodl
+
+
+LOG = logging.getLogger(__name__)
+
+
+def _load(cache_path):
+    try:
+        with open(cache_path) as cache_file:
+            return json.load(cache_file)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def _store(cache_path, sessions):
+    directory = os.path.dirname(os.path.abspath(cache_path))
+    if not os.path.isdir(directory):
+        os.makedirs(directory, 0o700)
+    tmp_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as cache_file:
+        json.dump(sessions, cache_file)
+    os.rename(tmp_path, cache_path)
+
+
+def _resume(host, cached):
+    stub = SoapAdapter.SoapStubAdapter(host=host, port=443,
+                                       version=cached['version'])
+    stub.cookie = cached['cookie']
+    si = vim.ServiceInstance("ServiceInstance", stub)
+    try:
+        if si.content.sessionManager.currentSession is not None:
+            return si
+    except (vim.fault.NotAuthenticated, IOError, OSError) as ex:
+        LOG.debug("The cached session is not usable: %s", ex)
+    return None
+
+
+def connect(host, user, pwd, cache_path=None, slot=0):
+    """Return the service instance of a session of the user at the host.
+
+    With the cache_path, a cached session gets reused when still alive, and
+    the new one gets cached otherwise. The sessions of the other slots than
+    0 get cached apart, for a pool of them.
+    """
+    key = '{}@{}'.format(user, host)
+    if slot:
+        key = '{}#{}'.format(key, slot)
+    sessions = _load(cache_path) if cache_path else {}
+    if key in sessions:
+        si = _resume(host, sessions[key])
+        if si is not None:
+            LOG.info("Reusing the cached session of %s.", key)
+            return si
+
+    si = pyvim_connect.SmartConnect(host=host, user=user, pwd=pwd)
+    if cache_path:
+        sessions[key] = {'version': si._stub.version,
+                         'cookie': si._stub.cookie}
+        _store(cache_path, sessions)
+    return si
+
+
+class PooledStub(StubAdapterAccessorMixin):
+    """The stub adapter of a service instance spreading its calls over the
+    sessions of the stubs.
+
+    Each thread makes its calls over a session of its own, assigned in turn
+    on its first call, so the threads submitting the actions at once do not
+    queue up behind one session. The objects living in a session, like the
+    property collectors, their filters and the views, live in the first
+    one, and so all their calls go there. The managed objects returned by
+    any of the sessions belong to the pooled stub.
+    """
+
+    SESSION_TYPES = (vmodl.query.PropertyCollector,
+                     vmodl.query.PropertyCollector.Filter,
+                     vim.view.View,
+                     vim.view.ViewManager,
+                     vim.HistoryCollector,
+                     vim.SessionManager,
+                     vim.TaskManager)
+
+    def __init__(self, stubs):
+        self.stubs = list(stubs)
+        self.version = getattr(self.stubs[0], 'version', None)
+        self._turns = itertools.count()
+        self._local = threading.local()
+
+    def __deepcopy__(self, memo):
+        # Like the SOAP stub adapter, the copies share the sessions.
+        return self
+
+    def _stub_of(self, mo):
+        if isinstance(mo, self.SESSION_TYPES):
+            return self.stubs[0]
+        stub = getattr(self._local, 'stub', None)
+        if stub is None:
+            stub = self._local.stub = self.stubs[
+                next(self._turns) % len(self.stubs)]
+        return stub
+
+    def InvokeMethod(self, mo, info, args):
+        status, obj = self._stub_of(mo).InvokeMethod(mo, info, args,
+                                                     outerStub=self)
+        if status != 200:
+            raise obj
+        return obj
+
+
+def connect_pool(host, user, pwd, size, cache_path=None):
+    """Return the service instance of `size` sessions of the user at the
+    host, see PooledStub, or of one session as connect does.
+    """
+    if size <= 1:
+        return connect(host, user, pwd, cache_path)
+    stubs = [connect(host, user, pwd, cache_path, slot)._stub
+             for slot in range(size)]
+    LOG.info("Pooled %d sessions of %s@%s.", size, user, host)
+    return vim.ServiceInstance("ServiceInstance", PooledStub(stubs))
+
+
+def sessions(si):
+    """Return the service instances of each session of si."""
+    stubs = getattr(si._stub, 'stubs', None)
+    if stubs is None:
+        return [si]
+    return [vim.ServiceInstance("ServiceInstance", stub) for stub in stubs]
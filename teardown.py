@@ -0,0 +1,97 @@
+#!/usr/bin/python
+
+# Copyright (C) 2015  Jaroslav Henner
+#
+# This file is part of pyvmomi ansible module.
+#
+# pyvmomi_ansible module is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+#
+# pyvmomi ansible module is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pyvmomi ansible more.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tearing down VMs in one pass.
+
+The VMs to tear down, and whether they are powered on, come from a single
+retrieval, either of the VMs given or of the whole inventory filtered by
+a name pattern and an age. Each VM then gets powered off, unless it is
+off already, and destroyed right after, concurrently with the others.
+"""
+
+import collections
+import datetime
+import fnmatch
+import logging
+
+from pyVmomi import vim
+
+import actions as ac
+
+
+LOG = logging.getLogger(__name__)
+
+PATHS = ['name', 'runtime.powerState', 'config.createDate',
+         'config.template', 'runtime.host', 'datastore']
+
+Doomed = collections.namedtuple(
+    'Doomed', 'vm name power_state create_date host datastores')
+
+
+class _UTC(datetime.tzinfo):
+    def utcoffset(self, dt):
+        return datetime.timedelta(0)
+
+    def dst(self, dt):
+        return datetime.timedelta(0)
+
+
+def _doomed(found):
+    return [Doomed(vm, props.get('name'), props.get('runtime.powerState'),
+                   props.get('config.createDate'), props.get('runtime.host'),
+                   props.get('datastore'))
+            for vm, props in found.items()
+            if not props.get('config.template')]
+
+
+def describe(si, vms):
+    """Return the Doomed of the VMs, skipping the templates."""
+    if not vms:
+        return []
+    return _doomed(ac.retrieve_properties(
+        si, vms, {vim.VirtualMachine: PATHS}))
+
+
+def scan(si, pattern, older_than=None):
+    """Return the Doomed of the VMs of the inventory with the names
+    matching the shell pattern, created at least `older_than` seconds ago
+    if given, skipping the templates.
+    """
+    doomed = [vm for vm in _doomed(
+        ac.retrieve_all(si, vim.VirtualMachine, PATHS))
+        if fnmatch.fnmatchcase(vm.name or '', pattern)]
+    if older_than is not None:
+        oldest = (datetime.datetime.now(_UTC()) -
+                  datetime.timedelta(seconds=older_than))
+        doomed = [vm for vm in doomed
+                  if vm.create_date is not None and vm.create_date <= oldest]
+    LOG.info("Found %d VMs to tear down matching %s.", len(doomed), pattern)
+    return doomed
+
+
+def destroy(si, doomed, executor):
+    """Power off and destroy the Doomed VMs by the executor."""
+    cache = ac.hardware_cache(si)
+    with executor as be:
+        for vm in doomed:
+            # The power offs load the hosts the VMs were described on.
+            cache.note(vm.vm, vm.host, list(vm.datastores or []))
+            step = None
+            if vm.power_state != vim.VirtualMachinePowerState.poweredOff:
+                step = be.submit(ac.PowerOffVm(si).vm_ref(vm.vm))
+            be.submit(ac.DestroyVM(si).ref(vm.vm), after=step)
@@ -0,0 +1,34 @@
+# Copyright (C) 2015  Jaroslav Henner
+#
+# This file is part of pyvmomi ansible module.
+#
+# pyvmomi_ansible module is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+#
+# pyvmomi ansible module is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pyvmomi ansible more.  If not, see <http://www.gnu.org/licenses/>.
+
+import pytest
+
+from bench.fakevc import FakeVCenter
+
+
+@pytest.fixture
+def vcenter():
+    """A fake vCenter of a cluster of two hosts and eight VMs, spread over
+    the hosts.
+    """
+    vc = FakeVCenter()
+    vc.add_datacenter('dc', datastores=2)
+    cluster = vc.add_cluster('dc', 'cluster', hosts=2)
+    hosts = cluster.props['host']
+    for number in range(8):
+        vm = vc.add_vm('dc/vm', 'vm-{}'.format(number))
+        vm.props['runtime'].host = hosts[number % len(hosts)]
+    return vc
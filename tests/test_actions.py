@@ -0,0 +1,177 @@
+# Copyright (C) 2015  Jaroslav Henner
+#
+# This file is part of pyvmomi ansible module.
+#
+# pyvmomi_ansible module is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+#
+# pyvmomi ansible module is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pyvmomi ansible more.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+
+import pytest
+from pyVmomi import vim
+
+import actions as ac
+import journal
+
+from bench.fakevc import FakeVCenter
+
+
+def _power_on(si, number):
+    return ac.PowerOnVm(si).vm_path('dc/vm/vm-{}'.format(number))
+
+
+def _power_off(si, number):
+    return ac.PowerOffVm(si).vm_path('dc/vm/vm-{}'.format(number))
+
+
+class _FlakyVCenter(FakeVCenter):
+    """Fails the first `failures` power ons with TaskInProgress."""
+
+    def __init__(self, failures):
+        FakeVCenter.__init__(self)
+        self.failures = failures
+        self.power_on_times = []
+
+    def _PowerOnVM_Task(self, vm, host=None):
+        self.power_on_times.append(time.time())
+        failing = len(self.power_on_times) <= self.failures
+        self.busy_rates = {'PowerOnVM_Task': 1.0 if failing else 0.0}
+        return FakeVCenter._PowerOnVM_Task(self, vm, host)
+
+
+def test_retry_delay_backs_off_to_the_cap():
+    policy = ac.RetryPolicy(base=1.0, cap=5.0, jitter=0)
+    error = vim.fault.TaskInProgress()
+    assert [policy.delay(error, retries) for retries in range(4)] == \
+        [1.0, 2.0, 4.0, 5.0]
+    assert policy.delay(error, 5) is None
+    assert policy.delay(vim.fault.InvalidPowerState(), 0) is None
+
+
+def test_transient_fault_retried_after_backoff():
+    vc = _FlakyVCenter(failures=2)
+    vc.add_datacenter('dc')
+    vc.add_cluster('dc', 'cluster')
+    vc.add_vm('dc/vm', 'vm-0')
+    si = vc.service_instance()
+
+    with ac.BatchExecutor(retry=ac.RetryPolicy(base=0.05,
+                                               jitter=0)) as be:
+        step = be.submit(_power_on(si, 0))
+
+    assert step.error is None
+    assert step.retries == 2
+    assert vc.find('dc/vm/vm-0').props['runtime'].powerState == 'poweredOn'
+    times = vc.power_on_times
+    assert len(times) == 3
+    assert times[1] - times[0] >= 0.05
+    assert times[2] - times[1] >= 0.1
+
+
+def test_retries_exhausted_fail_the_batch():
+    vc = _FlakyVCenter(failures=10)
+    vc.add_datacenter('dc')
+    vc.add_cluster('dc', 'cluster')
+    vc.add_vm('dc/vm', 'vm-0')
+    si = vc.service_instance()
+    retry = ac.RetryPolicy(faults={vim.fault.TaskInProgress: 1}, base=0.01)
+
+    with pytest.raises(vim.fault.TaskInProgress):
+        with ac.BatchExecutor(retry=retry) as be:
+            be.submit(_power_on(si, 0))
+
+    assert len(vc.power_on_times) == 2
+
+
+def test_limit_caps_running_actions(vcenter):
+    si = vcenter.service_instance()
+
+    with ac.BatchExecutor(limit=3) as be:
+        for number in range(8):
+            be.submit(_power_on(si, number))
+
+    assert be.report()['peak_running'] == 3
+    assert be.report()['actions'] == 8
+
+
+def test_per_resource_limit_caps_running_actions_per_host(vcenter):
+    si = vcenter.service_instance()
+
+    with ac.BatchExecutor(per_resource_limits={'host': 1}) as be:
+        for number in range(8):
+            be.submit(_power_on(si, number))
+
+    assert be.report()['peak_running'] == 2
+    assert all(vcenter.find('dc/vm/vm-{}'.format(number))
+               .props['runtime'].powerState == 'poweredOn'
+               for number in range(8))
+
+
+def test_dependents_skipped_after_failure(vcenter):
+    si = vcenter.service_instance()
+    # Powering off a VM which is off fails.
+    first = ac.PowerOffVm(si).vm_path('dc/vm/vm-0')
+
+    with pytest.raises(vim.fault.InvalidPowerState):
+        with ac.BatchExecutor() as be:
+            step = be.submit(first)
+            step = be.submit(lambda: _power_on(si, 0), after=step)
+            be.submit(lambda: _power_off(si, 0), after=step)
+            other = be.submit(_power_on(si, 1))
+
+    assert be.report()['failed'] == 1
+    assert all(step.finished for step in be.steps)
+    assert other.error is None
+    assert vcenter.calls['PowerOnVM_Task'] == 1
+    assert vcenter.find('dc/vm/vm-0').props['runtime'].powerState == \
+        'poweredOff'
+
+
+def test_journal_resume_skips_done_actions(vcenter, tmp_path):
+    si = vcenter.service_instance()
+    path = str(tmp_path / 'journal.jsonl')
+
+    run = journal.Journal(path)
+    with ac.BatchExecutor(journal=run) as be:
+        for number in range(4):
+            be.submit(_power_on(si, number), key='power-on {}'.format(number))
+    run.close()
+
+    resumed = journal.Journal(path, resume=True)
+    with ac.BatchExecutor(journal=resumed) as be:
+        for number in range(6):
+            be.submit(lambda number=number: _power_on(si, number),
+                      key='power-on {}'.format(number))
+    resumed.close()
+
+    assert be.report()['resumed'] == 4
+    assert be.report()['actions'] == 2
+    assert vcenter.calls['PowerOnVM_Task'] == 6
+
+
+def test_journal_resume_follows_started_tasks(vcenter, tmp_path):
+    si = vcenter.service_instance()
+    path = str(tmp_path / 'journal.jsonl')
+    task = si.RetrieveContent().searchIndex.FindByInventoryPath(
+        'dc/vm/vm-0').PowerOn()
+    with open(path, 'w') as journal_file:
+        journal_file.write('{{"key": "power-on", "state": "started", '
+                           '"tasks": ["{}"]}}\n'.format(task._moId))
+
+    resumed = journal.Journal(path, resume=True)
+    with ac.BatchExecutor(journal=resumed) as be:
+        be.submit(_power_on(si, 0), key='power-on')
+    resumed.close()
+
+    assert be.report()['resumed'] == 1
+    assert vcenter.calls['PowerOnVM_Task'] == 1
+    assert resumed.done('power-on')
@@ -0,0 +1,65 @@
+# Copyright (C) 2015  Jaroslav Henner
+#
+# This file is part of pyvmomi ansible module.
+#
+# pyvmomi_ansible module is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+#
+# pyvmomi ansible module is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pyvmomi ansible more.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+
+import journal
+
+
+def test_replay_keeps_the_last_record_of_a_key(tmp_path):
+    path = str(tmp_path / 'journal.jsonl')
+    run = journal.Journal(path)
+    run.record('clone a', journal.STARTED, ['task-1'])
+    run.record('clone b', journal.STARTED, ['task-2'])
+    run.record('clone a', journal.DONE)
+    run.close()
+
+    resumed = journal.Journal(path, resume=True)
+    resumed.close()
+    assert resumed.done('clone a')
+    assert not resumed.done('clone b')
+    assert resumed.started_tasks('clone a') == []
+    assert resumed.started_tasks('clone b') == ['task-2']
+
+
+def test_resume_after_a_cut_line(tmp_path):
+    path = str(tmp_path / 'journal.jsonl')
+    with open(path, 'w') as journal_file:
+        journal_file.write('{"key": "clone a", "state": "done"}\n'
+                           '{"key": "clone b", "sta')
+
+    resumed = journal.Journal(path, resume=True)
+    resumed.record('clone b', journal.DONE)
+    resumed.close()
+
+    with open(path) as journal_file:
+        lines = journal_file.read().splitlines()
+    assert json.loads(lines[-1]) == {'key': 'clone b', 'state': 'done'}
+    again = journal.Journal(path, resume=True)
+    again.close()
+    assert again.done('clone a') and again.done('clone b')
+
+
+def test_new_journal_forgets_the_old_one(tmp_path):
+    path = str(tmp_path / 'journal.jsonl')
+    run = journal.Journal(path)
+    run.record('clone a', journal.DONE)
+    run.close()
+
+    journal.Journal(path).close()
+    resumed = journal.Journal(path, resume=True)
+    resumed.close()
+    assert not resumed.done('clone a')
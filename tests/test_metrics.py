@@ -0,0 +1,73 @@
+# Copyright (C) 2015  Jaroslav Henner
+#
+# This file is part of pyvmomi ansible module.
+#
+# pyvmomi_ansible module is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+#
+# pyvmomi ansible module is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pyvmomi ansible more.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+
+import metrics
+
+
+def test_instrument_counts_the_calls(vcenter):
+    si = vcenter.service_instance()
+    recorder = metrics.instrument(si, labels={'run': 'test'})
+    assert metrics.instrument(si) is recorder
+
+    with metrics.attributed('PowerOnVm'):
+        si.RetrieveContent().searchIndex.FindByInventoryPath('dc/vm/vm-0')
+
+    calls = dict(((call['owner'], call['name']), call)
+                 for call in recorder.as_dicts())
+    call = calls[('PowerOnVm', 'SearchIndex.FindByInventoryPath')]
+    assert call['count'] == 1
+    assert call['errors'] == 0
+    assert sum(call['buckets'].values()) >= 1
+
+
+def test_write_textfile(tmp_path):
+    recorder = metrics.SoapMetrics(labels={'run': 'a "quoted" run'})
+    recorder.record('CloneVm', 'method', 'VirtualMachine.Clone', 0.02)
+    recorder.record('CloneVm', 'method', 'VirtualMachine.Clone', 3.0,
+                    failed=True, sent_bytes=100, received_bytes=50)
+    path = str(tmp_path / 'vomit.prom')
+    recorder.write_textfile(path)
+
+    with open(path) as textfile:
+        lines = textfile.read().splitlines()
+    labels = ('call="VirtualMachine.Clone",kind="method",owner="CloneVm",'
+              'run="a \\"quoted\\" run"')
+    assert 'vomit_soap_call_seconds_bucket{{{},le="0.025"}} 1'.format(
+        labels) in lines
+    assert 'vomit_soap_call_seconds_bucket{{{},le="5"}} 2'.format(
+        labels) in lines
+    assert 'vomit_soap_call_seconds_bucket{{{},le="+Inf"}} 2'.format(
+        labels) in lines
+    assert 'vomit_soap_call_seconds_count{{{}}} 2'.format(labels) in lines
+    assert 'vomit_soap_call_errors_total{{{}}} 1'.format(labels) in lines
+    assert 'vomit_soap_sent_bytes_total{{{}}} 100'.format(labels) in lines
+    assert 'vomit_soap_received_bytes_total{{{}}} 50'.format(
+        labels) in lines
+    assert not list(tmp_path.glob('*.tmp'))
+
+
+def test_write_json(tmp_path):
+    recorder = metrics.SoapMetrics()
+    recorder.record(None, 'property', 'VirtualMachine.name', 0.001)
+    path = str(tmp_path / 'calls.json')
+    recorder.write_json(path)
+
+    with open(path) as json_file:
+        calls = json.load(json_file)['calls']
+    assert [(call['owner'], call['name'], call['count'])
+            for call in calls] == [('', 'VirtualMachine.name', 1)]
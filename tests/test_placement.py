@@ -0,0 +1,97 @@
+# Copyright (C) 2015  Jaroslav Henner
+#
+# This file is part of pyvmomi ansible module.
+#
+# pyvmomi_ansible module is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+#
+# pyvmomi ansible module is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pyvmomi ansible more.  If not, see <http://www.gnu.org/licenses/>.
+
+import pytest
+from pyVmomi import vim
+
+import actions as ac
+import placement
+
+
+def _engine(vcenter):
+    si = vcenter.service_instance()
+    return placement.Placement(
+        si, ac.inventory_index(si).find('dc/host/cluster'))
+
+
+def test_datastore_score_prefers_free_space():
+    policy = placement.SpreadPolicy(min_free_ratio=0.1)
+    emptier = placement.DatastoreLoad(None, {
+        'summary.capacity': 100, 'summary.freeSpace': 80,
+        'summary.accessible': True})
+    fuller = placement.DatastoreLoad(None, {
+        'summary.capacity': 100, 'summary.freeSpace': 40,
+        'summary.accessible': True})
+    assert policy.datastore_score(emptier, 10) > \
+        policy.datastore_score(fuller, 10)
+    assert policy.datastore_score(fuller, 35) is None
+
+
+def test_host_score_rejects_a_host_out_of_memory():
+    policy = placement.SpreadPolicy()
+    host = placement.HostLoad(None, {
+        'runtime.connectionState': 'connected',
+        'summary.hardware.memorySize': 4096 * 2 ** 20,
+        'summary.quickStats.overallMemoryUsage': 1024})
+    assert policy.host_score(host, 1024) == 0.5
+    assert policy.host_score(host, 4096) is None
+
+
+def test_place_spreads_the_clones(vcenter):
+    engine = _engine(vcenter)
+    placed = [engine.place(2 ** 30, 1024) for _ in range(4)]
+    assert len(set(datastore._moId for datastore, _ in placed)) == 2
+    assert len(set(host._moId for _, host in placed)) == 2
+
+
+def test_place_fails_without_room(vcenter):
+    with pytest.raises(placement.NoPlacement):
+        _engine(vcenter).place(2 ** 41)
+
+
+def _clone(si, engine):
+    return (ac.CloneVm(si).name('clone').to_template(False)
+            .source_path('dc/vm/vm-0').vm_folder_path('dc/vm')
+            .resource_pool_path('dc/host/cluster/Resources')
+            .placement(engine))
+
+
+def test_clone_charges_its_place(vcenter):
+    engine = _engine(vcenter)
+    engine.refresh()
+    memory = sum(host.memory_used_mb for host in engine._hosts)
+
+    with ac.BatchExecutor() as be:
+        be.submit(_clone(vcenter.service_instance(), engine))
+
+    assert sum(host.memory_used_mb for host in engine._hosts) == \
+        memory + 512
+
+
+def test_failed_clone_releases_its_charge(vcenter):
+    vcenter.busy_rates = {'CloneVM_Task': 1.0}
+    engine = _engine(vcenter)
+    engine.refresh()
+    free = [datastore.free for datastore in engine._datastores]
+    memory = [host.memory_used_mb for host in engine._hosts]
+    si = vcenter.service_instance()
+
+    with pytest.raises(vim.fault.TaskInProgress):
+        with ac.BatchExecutor(per_resource_limits={'host': 1}) as be:
+            be.submit(_clone(si, engine))
+
+    assert [datastore.free for datastore in engine._datastores] == free
+    assert [host.memory_used_mb for host in engine._hosts] == memory
@@ -0,0 +1,55 @@
+# Copyright (C) 2015  Jaroslav Henner
+#
+# This file is part of pyvmomi ansible module.
+#
+# pyvmomi_ansible module is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+#
+# pyvmomi ansible module is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pyvmomi ansible more.  If not, see <http://www.gnu.org/licenses/>.
+
+import pytest
+
+import topology
+
+
+def test_nodes_number_the_roles_of_more_nodes():
+    nodes = list(topology.nodes({
+        'folder': 'lab',
+        'roles': [
+            {'role': 'controller', 'memory': 8192,
+             'mac': '52:54:00:00:00:01'},
+            {'role': 'compute', 'count': 3, 'memory': 4096,
+             'mac_range': '52:54:00:00:00:ff', 'folder': 'lab/compute'},
+        ]}, prefix='ci-', template='rhel'))
+
+    assert nodes[0] == topology.Node('ci-controller', 8192,
+                                     '52:54:00:00:00:01', 'lab', 'rhel')
+    assert [(node.name, node.mac, node.folder) for node in nodes[1:]] == [
+        ('ci-compute-1', '52:54:00:00:00:ff', 'lab/compute'),
+        ('ci-compute-2', '52:54:00:00:01:00', 'lab/compute'),
+        ('ci-compute-3', '52:54:00:00:01:01', 'lab/compute'),
+    ]
+
+
+def test_nodes_without_macs():
+    nodes = list(topology.nodes({'roles': [{'role': 'vm', 'count': 2}]}))
+    assert [node.mac for node in nodes] == [None, None]
+
+
+def test_nodes_with_too_few_macs():
+    with pytest.raises(ValueError):
+        list(topology.nodes({'roles': [
+            {'role': 'vm', 'count': 2, 'macs': ['52:54:00:00:00:01']}]}))
+
+
+def test_load_json(tmp_path):
+    path = tmp_path / 'topology.json'
+    path.write_text('{"roles": [{"role": "vm"}]}')
+    assert topology.load(str(path)) == {'roles': [{'role': 'vm'}]}
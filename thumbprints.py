@@ -0,0 +1,140 @@
+#!/usr/bin/python
+
+# Copyright (C) 2015  Jaroslav Henner
+#
+# This file is part of pyvmomi ansible module.
+#
+# pyvmomi_ansible module is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+#
+# pyvmomi ansible module is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pyvmomi ansible more.  If not, see <http://www.gnu.org/licenses/>.
+
+"""The SSL thumbprints of the ESXi hosts, trusted on first use.
+
+The thumbprint of a host not seen before comes from a TLS handshake with
+it, and gets remembered by the store, so later adds of the host use the
+remembered one. A host whose certificate changed since then fails to be
+added with an SSLVerifyFault instead of being trusted again. A host the
+handshake cannot reach, like behind a firewall only the vCenter passes,
+gets the thumbprint the vCenter reads instead, see actions.CreateHost.
+"""
+
+import concurrent.futures
+import hashlib
+import json
+import logging
+import os
+import socket
+import ssl
+import threading
+
+
+LOG = logging.getLogger(__name__)
+
+
+def fetch(host, port=443, timeout=10):
+    """Return the SHA-1 thumbprint of the certificate the host presents,
+    as the colon separated hex digits vCenter expects.
+    """
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    sock = socket.create_connection((host, port), timeout)
+    try:
+        tls_sock = context.wrap_socket(sock)
+        try:
+            certificate = tls_sock.getpeercert(binary_form=True)
+        finally:
+            tls_sock.close()
+    finally:
+        sock.close()
+    digest = hashlib.sha1(certificate).hexdigest().upper()
+    return ':'.join(digest[i:i + 2] for i in range(0, len(digest), 2))
+
+
+class ThumbprintStore(object):
+    """The thumbprints of the hosts, kept in a JSON file readable only by
+    its owner, or in memory only without a path.
+    """
+
+    def __init__(self, path=None, port=443, workers=16):
+        self.path = path
+        self.port = port
+        self.workers = workers
+        self._lock = threading.Lock()
+        self._thumbprints = self._load() if path else {}
+        self._failed = {}
+
+    def _load(self):
+        try:
+            with open(self.path) as store_file:
+                return json.load(store_file)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _store(self):
+        tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as store_file:
+            json.dump(self._thumbprints, store_file, indent=2,
+                      sort_keys=True)
+        os.rename(tmp_path, self.path)
+
+    def lookup(self, hosts):
+        """Return the thumbprints of the hosts, by the host.
+
+        The hosts not known yet get their thumbprint by handshakes in
+        parallel, which is then trusted and remembered. A failed handshake
+        gets raised once the thumbprints of the other hosts are remembered,
+        and again by the later lookups of the host, without another try.
+        """
+        with self._lock:
+            known = dict((host, self._thumbprints[host]) for host in hosts
+                         if host in self._thumbprints)
+            failed = [self._failed[host] for host in hosts
+                      if host in self._failed and host not in known]
+            unknown = [host for host in hosts
+                       if host not in known and host not in self._failed]
+        if not unknown:
+            if failed:
+                raise failed[0]
+            return known
+
+        workers = min(self.workers, len(unknown))
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            futures = [(host, executor.submit(fetch, host, self.port))
+                       for host in unknown]
+        fetched = dict((host, future.result()) for host, future in futures
+                       if future.exception() is None)
+        for host, thumbprint in sorted(fetched.items()):
+            LOG.warning("Trusting thumbprint '%s' of host %s on first use.",
+                        thumbprint, host)
+        with self._lock:
+            self._thumbprints.update(fetched)
+            if self.path:
+                self._store()
+            for host, future in futures:
+                if future.exception() is not None:
+                    self._failed[host] = future.exception()
+                    failed.append(future.exception())
+        if failed:
+            raise failed[0]
+        known.update(fetched)
+        return known
+
+    def remember(self, host, thumbprint):
+        """Trust and remember the thumbprint of the host got otherwise."""
+        LOG.warning("Trusting thumbprint '%s' of host %s on first use.",
+                    thumbprint, host)
+        with self._lock:
+            self._thumbprints[host] = thumbprint
+            self._failed.pop(host, None)
+            if self.path:
+                self._store()
@@ -0,0 +1,103 @@
+#!/usr/bin/python
+
+# Copyright (C) 2015  Jaroslav Henner
+#
+# This file is part of pyvmomi ansible module.
+#
+# pyvmomi_ansible module is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+#
+# pyvmomi ansible module is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pyvmomi ansible more.  If not, see <http://www.gnu.org/licenses/>.
+
+"""The nodes of a deployment, described by roles in a topology file.
+
+The file is JSON, or YAML when PyYAML is installed:
+
+    folder: lab
+    template: rhel-guest-image
+    roles:
+      - role: controller
+        memory: 8192
+        mac: 52:54:00:00:00:01
+      - role: compute
+        count: 50
+        memory: 4096
+        mac_range: 52:54:00:00:01:00
+        folder: lab/compute
+
+A role of one node names it by the role, the nodes of a role of more get
+numbered, compute-1 to compute-50 here. A role gives the MACs of its nodes
+either as a list in `macs`, one in `mac`, or as the first of consecutive
+ones in `mac_range`. The folder and the template default to the ones of
+the topology, and those to the ones given to nodes.
+"""
+
+import collections
+import json
+import os
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+
+Node = collections.namedtuple('Node', 'name memory mac folder template')
+
+
+def load(path):
+    """Return the topology of the file at the path."""
+    with open(path) as topology_file:
+        if os.path.splitext(path)[1] in ('.yaml', '.yml'):
+            if yaml is None:
+                raise ValueError("Reading the topology {} needs "
+                                 "PyYAML.".format(path))
+            return yaml.safe_load(topology_file)
+        return json.load(topology_file)
+
+
+def _macs(role):
+    if 'macs' in role:
+        return iter(role['macs'])
+    if 'mac' in role:
+        return iter([role['mac']])
+    if 'mac_range' in role:
+        return _mac_range(role['mac_range'])
+    return None
+
+
+def _mac_range(first):
+    value = int(first.replace(':', ''), 16)
+    while value < 2 ** 48:
+        digits = '{:012x}'.format(value)
+        yield ':'.join(digits[i:i + 2] for i in range(0, 12, 2))
+        value += 1
+
+
+def nodes(topology, prefix='', folder=None, template=None):
+    """Generate the nodes of the topology, one at a time."""
+    folder = topology.get('folder', folder)
+    template = topology.get('template', template)
+    for role in topology['roles']:
+        count = role.get('count', 1)
+        macs = _macs(role)
+        for index in range(1, count + 1):
+            name = '{}{}'.format(prefix, role['role'])
+            if count > 1:
+                name = '{}-{}'.format(name, index)
+            mac = None
+            if macs is not None:
+                mac = next(macs, None)
+                if mac is None:
+                    raise ValueError("The role {} has fewer MACs than its {} "
+                                     "nodes.".format(role['role'], count))
+            yield Node(name, role.get('memory'), mac,
+                       role.get('folder', folder),
+                       role.get('template', template))